@@ -0,0 +1,582 @@
+'''benchmarks of lilsumthing.
+
+speedup: runs the original and the rewritten version of each piece of code
+in a corpus (the examples of README.md, the snippets of test_lilsumthing.py,
+and python modules) over a sweep of input sizes, and reports how much faster
+the rewritten code is.
+
+scaling: runs the optimizer itself on generated loops that grow along a few
+axes, and reports how its time, memory and output grow with them.
+'''
+import argparse
+import ast
+import builtins
+import csv
+import gc
+import json
+import math
+import os
+import signal
+import sys
+import time
+import tracemalloc
+
+import lilsumthing
+
+CORPUS = ('README.md', 'test_lilsumthing.py', 'example.py')
+
+SIZES = (0, 1, 10, 100, 1000, 10 ** 4, 10 ** 5, 10 ** 6)
+
+FIELDS = ('case', 'target', 'loops', 'size', 'original', 'rewritten',
+          'speedup', 'equal', 'error')
+
+class Timeout(BaseException):
+    # not an Exception, so that lilsumthing.outcome() doesn't take it for
+    # something the code raised
+    pass
+
+def raise_timeout(signum, frame):
+    raise Timeout()
+
+def markdown_sources(filename):
+    '''the (line number, source) of the python and diff code blocks of the
+    markdown file (filename); for a diff, the source is what it removes
+    from, i.e. its context and - lines'''
+    with open(filename) as f:
+        lines = f.read().split('\n')
+    block = kind = None
+    for number, line in enumerate(lines, 1):
+        if block is None:
+            if line.startswith('```'):
+                block, kind, start = [], line[3:].strip(), number + 1
+            continue
+        if not line.startswith('```'):
+            block.append(line)
+            continue
+        if kind == 'python':
+            yield start, '\n'.join(block)
+        elif kind == 'diff':
+            yield start, '\n'.join(l[1:] for l in block if l[:1] in ' -'
+                                   and not l.startswith('---'))
+        block = None
+
+def test_sources(filename):
+    '''the (line number, source) of the string constants in the test
+    functions of (filename), which is where test_lilsumthing.py keeps the
+    code it rewrites'''
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    for function in tree.body:
+        if isinstance(function, ast.FunctionDef) \
+           and function.name.startswith('test'):
+            for node in ast.walk(function):
+                if isinstance(node, ast.Constant) \
+                   and isinstance(node.value, str):
+                    yield node.lineno, node.value
+
+def corpus(filenames):
+    '''the (name, source) of the pieces of code in (filenames): the code
+    blocks of .md files, the snippets of test_*.py files, and other .py
+    files as a whole. the same code is only yielded once.'''
+    seen = set()
+    for filename in filenames:
+        base = filename.replace('\\', '/').rsplit('/', 1)[-1]
+        if base.endswith('.md'):
+            sources = markdown_sources(filename)
+        elif base.startswith('test_'):
+            sources = test_sources(filename)
+        else:
+            with open(filename) as f:
+                sources = [(1, f.read())]
+        for number, source in sources:
+            try:
+                key = ast.dump(ast.parse(source))
+            except (SyntaxError, ValueError):
+                continue
+            if key not in seen:
+                seen.add(key)
+                yield '%s:%d' % (filename, number), source
+
+def free_names(tree):
+    '''the names (tree) uses that it may not bind before, and that aren't
+    builtins, modules or functions: these are what we set to the size'''
+    bound = set(dir(builtins))
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound.update((a.asname or a.name).split('.')[0]
+                         for a in node.names)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                               ast.ClassDef)):
+            bound.add(node.name)
+    return sorted({node.id for node in ast.walk(tree)
+                   if isinstance(node, ast.Name)} - bound)
+
+def result_names(tree):
+    '''the names the module (tree) assigns, other than the loop variables,
+    whose final value the closed forms don't bother with'''
+    stored, targets = set(), set()
+    for statement in tree.body:
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                  ast.ClassDef)):
+            continue
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                stored.add(node.id)
+            elif isinstance(node, (ast.For, ast.comprehension)):
+                targets.update(n.id for n in ast.walk(node.target)
+                               if isinstance(n, ast.Name))
+    return sorted(stored - targets)
+
+class Version:
+    '''the compiled module (tree), and the calls of its (targets) for a size:
+    '<module>' runs the module with its free names set to the size, and
+    returns the values of the names it assigns, and a function is called
+    with each of its parameters without a default set to the size'''
+    def __init__(self, tree, names, results, name):
+        self.code = compile(tree, name, 'exec')
+        self.names = names
+        self.results = results
+    def run(self, size):
+        env = dict.fromkeys(self.names, size)
+        env['__name__'] = 'benchmark'
+        exec(self.code, env)
+        return env
+    def call(self, target, size):
+        '''a function that calls (target) with (size)'''
+        if target == '<module>':
+            def module():
+                env = self.run(size)
+                return {name: env.get(name) for name in self.results}
+            return module
+        function = self.run(size)[target]
+        code = function.__code__
+        count = code.co_argcount - len(function.__defaults__ or ())
+        args = (size,) * count
+        return lambda: function(*args)
+
+def targets(tree):
+    '''the target of each node of the module (tree): the function defined at
+    its top level that it is in, or <module>'''
+    owner = {}
+    for statement in tree.body:
+        target = '<module>'
+        if isinstance(statement, ast.FunctionDef):
+            target = statement.name
+        for node in ast.walk(statement):
+            owner[id(node)] = target
+    return owner
+
+def strip_expressions(tree):
+    '''drops the expression statements at the top level of the module
+    (tree), like the print() calls of example.py: they'd run the original
+    loops at every size'''
+    tree.body = [s for s in tree.body if not isinstance(s, ast.Expr)] \
+        or [ast.Pass()]
+    return tree
+
+def timed(func, timeout):
+    '''(outcome of func(), seconds it took), or None if it takes longer than
+    (timeout) seconds'''
+    previous = signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        start = time.perf_counter()
+        result = lilsumthing.outcome(func, ())
+        return result, time.perf_counter() - start
+    except Timeout:
+        return None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def best_time(func, first, repeat=3, min_time=0.01):
+    '''the seconds a call of (func) takes, the best of (repeat) rounds of
+    enough calls to take (min_time), with the garbage collector off like
+    timeit. a first call that took (first) seconds, more than (min_time),
+    is measurement enough.'''
+    if first >= min_time:
+        return first
+    number = max(1, int(min_time / max(first, 1e-7)))
+    best = first
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            best = min(best, (time.perf_counter() - start) / number)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+def speedup(name, source, sizes=SIZES, partial=False, guard=False,
+            timeout=2.0, repeat=3, min_time=0.01):
+    '''the result rows of the benchmark of (source), for each target and
+    size: the seconds a call of the original and the rewritten version take
+    and their ratio, whether they return the same, and the exception both
+    raise, if they do. the sizes of a target go up until either version
+    takes longer than (timeout).'''
+    try:
+        original = strip_expressions(ast.parse(source))
+        tree = strip_expressions(ast.parse(source))
+    except (SyntaxError, ValueError):
+        return []
+    owner = targets(tree)
+    # some code takes the optimizer itself too long:
+    rewritten = timed(lambda: lilsumthing.rewrite_module(
+        tree, partial=partial, guard=guard), timeout)
+    if rewritten is None:
+        row = dict.fromkeys(FIELDS)
+        row.update(case=name, error='timeout rewriting')
+        return [row]
+    (outcome, pw), _ = rewritten
+    if outcome == 'raises' or not pw.replacements:
+        return []
+    names, results = free_names(original), result_names(original)
+    versions = [Version(t, names, results, name) for t in (original, tree)]
+    loops = {}
+    for node, new in pw.replacements:
+        loops[owner[id(node)]] = loops.get(owner[id(node)], 0) + 1
+    rows = []
+    for target in sorted(loops):
+        for size in sizes:
+            row = dict.fromkeys(FIELDS)
+            row.update(case=name, target=target, loops=loops[target],
+                       size=size)
+            rows.append(row)
+            # a function target runs the module first, which may take long
+            # as well:
+            prepared = [timed(lambda v=v: v.call(target, size), timeout)
+                        for v in versions]
+            if None in prepared:
+                row['error'] = 'timeout'
+                break
+            (original_call, _), (rewritten_call, _) = prepared
+            if 'raises' in (original_call[0], rewritten_call[0]):
+                row['equal'] = original_call == rewritten_call
+                row['error'] = (original_call if original_call[0] == 'raises'
+                                else rewritten_call)[1].__name__
+                break
+            calls = [original_call[1], rewritten_call[1]]
+            outcomes = [timed(call, timeout) for call in calls]
+            if None in outcomes:
+                # a lower bound of the time of the one that took too long
+                row['original'], row['rewritten'] = [
+                    timeout if o is None else o[1] for o in outcomes]
+                row['speedup'] = row['original'] / row['rewritten']
+                row['error'] = 'timeout'
+                break
+            (original_outcome, first), (rewritten_outcome, second) = outcomes
+            row['equal'] = original_outcome == rewritten_outcome
+            if original_outcome[0] == 'raises':
+                row['error'] = original_outcome[1].__name__
+                continue
+            row['original'] = best_time(calls[0], first, repeat, min_time)
+            row['rewritten'] = best_time(calls[1], second, repeat, min_time)
+            row['speedup'] = row['original'] / row['rewritten']
+    return rows
+
+def write_report(rows, filename, fields=FIELDS, extra={}):
+    '''writes (rows) to (filename) as CSV if it ends in .csv, otherwise as
+    JSON, along with (extra); to stdout if (filename) is -'''
+    f = sys.stdout if filename == '-' else open(filename, 'w', newline='')
+    try:
+        if filename.endswith('.csv'):
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(dict({'version': lilsumthing.tool_version(),
+                            'python': sys.version.split()[0],
+                            'results': rows}, **extra), f, indent=1)
+            f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def print_summary(rows, min_speedup):
+    '''prints the range of speedups of each target to stderr, marking the
+    ones slower than (min_speedup) and those that don't return what the
+    original does; returns whether there are any'''
+    failed = False
+    keys = []
+    for row in rows:
+        if (row['case'], row['target']) not in keys:
+            keys.append((row['case'], row['target']))
+    for key in keys:
+        own = [r for r in rows if (r['case'], r['target']) == key]
+        speedups = [r['speedup'] for r in own if r['speedup'] is not None]
+        slower = [r['size'] for r in own if r['speedup'] is not None
+                  and r['speedup'] < min_speedup]
+        differs = [r['size'] for r in own if r['equal'] is False]
+        line = '%s:' % key[0]
+        if key[1]:
+            line = '%s %s (%d loops):' % (key[0], key[1], own[0]['loops'])
+        if speedups:
+            line += ' %.3gx to %.3gx' % (min(speedups), max(speedups))
+        errors = sorted({r['error'] for r in own if r['error']})
+        if errors:
+            line += ' %s' % ', '.join(errors)
+        if slower:
+            line += ' SLOWER at size %s' % ', '.join(map(str, slower))
+        if differs:
+            line += ' DIFFERS at size %s' % ', '.join(map(str, differs))
+        failed = failed or bool(slower or differs)
+        print(line, file=sys.stderr)
+    return failed
+
+# the axes of the scaling benchmark, and the values each takes: the
+# optimize() axes rewrite the modules of synthetic(), while fold and power
+# time fold_constant_factors() and the expansion of a Polynomial ** on
+# their own, see workload()
+AXES = {
+    'depth': (1, 2, 4, 8, 16, 32, 64),
+    'addends': (1, 2, 4, 8, 16, 32, 64, 128),
+    'exponent': (1, 2, 4, 8, 12, 16, 24),
+    'variables': (1, 2, 3, 4, 5, 6),
+    'functions': (1, 2, 4, 8, 16, 32, 64),
+    'fold': (1, 4, 16, 64, 256, 1024),
+    'power': (1, 2, 4, 8, 16, 32, 64),
+}
+
+SCALING_FIELDS = ('axis', 'value', 'seconds', 'peak', 'terms', 'error')
+
+METRICS = ('seconds', 'peak', 'terms')
+
+BASELINE = 'benchmark_scaling.json'
+
+def synthetic(axis, value):
+    '''the source of a module with summation loops that grow with (value)
+    along (axis):
+    depth: an addend in (value) levels of parentheses, of degree 1 in i
+    addends: (value) addends, no two with the same variables
+    exponent: (i + n) ** (value)
+    variables: (i + a0 + a1 + ...) ** 3, with (value) names besides i
+    functions: (value) functions, each with a loop of its own'''
+    if axis == 'functions':
+        return ''.join(
+            'def f%d(n):\n    S = 0\n    for i in range(n):\n'
+            '        S += (i + n) ** 3 + %d * i\n    return S\n\n' % (k, k)
+            for k in range(value))
+    if axis == 'depth':
+        addend = 'i'
+        for k in range(value):
+            addend = '(%s + i * %d - n) * %d' % (addend, k + 1, k + 2)
+    elif axis == 'addends':
+        addend = ' + '.join('%d * i ** %d * n ** %d' % (k + 1, k % 4, k // 4)
+                            for k in range(value))
+    elif axis == 'exponent':
+        addend = '(i + n) ** %d' % value
+    elif axis == 'variables':
+        addend = '(i + %s) ** 3' % ' + '.join('a%d' % k for k in range(value))
+    else:
+        raise ValueError('no synthetic module for %s' % axis)
+    return 'S = 0\nfor i in range(n):\n    S += %s\n' % addend
+
+def workload(axis, value):
+    '''a function doing the work of (axis) at (value), and returning the
+    number of terms it comes up with: the addends of the closed forms for
+    the optimize() axes'''
+    if axis == 'fold':
+        # (value) products, with a variable factor in common by fours
+        names = max(1, value // 4)
+        products = [[ast.Name('x%d' % (k % names)), ast.Constant(k + 1)]
+                    for k in range(value)]
+        return lambda: len(lilsumthing.fold_constant_factors(products))
+    if axis == 'power':
+        # three terms, expanded by repeated squaring
+        poly = lilsumthing.Polynomial.from_expr(
+            ast.parse('i + n + 1', mode='eval').body)
+        return lambda: len((poly ** value).terms)
+    source = synthetic(axis, value)
+    def optimize():
+        tree = lilsumthing.optimize(source, verbose=False)
+        return sum(isinstance(node, ast.BinOp)
+                   and isinstance(node.op, (ast.Add, ast.Sub))
+                   for node in ast.walk(tree)) + 1
+    return optimize
+
+def measure(axis, value, repeat=3):
+    '''the row of the scaling benchmark of (axis) at (value): the best
+    seconds of (repeat) runs of its workload(), the peak of the memory
+    traced by tracemalloc during another run, and the number of terms'''
+    row = dict.fromkeys(SCALING_FIELDS)
+    row.update(axis=axis, value=value)
+    work = workload(axis, value)
+    try:
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            terms = work()
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            work()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    except RecursionError as e:
+        row['error'] = type(e).__name__
+        return row
+    row.update(seconds=min(seconds), peak=peak, terms=terms)
+    return row
+
+def growth(rows, metric):
+    '''the exponent k of the value ** k that (metric) of (rows), the rows
+    of one axis, grows like over the upper half of its values: the slope of
+    the least squares line through their logarithms, or None without two
+    points to draw it through'''
+    points = [(math.log(r['value']), math.log(r[metric])) for r in rows
+              if r[metric]]
+    points = points[min(len(points) // 2, max(len(points) - 2, 0)):]
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, y in points) / len(points)
+    my = sum(y for x, y in points) / len(points)
+    sxx = sum((x - mx) ** 2 for x, y in points)
+    return sum((x - mx) * (y - my) for x, y in points) / sxx
+
+def scaling(axes=AXES, repeat=3, max_seconds=5.0):
+    '''the rows of the scaling benchmark of (axes), {axis: values}, and the
+    growth() of each metric along each axis. the values of an axis stop
+    after one that takes longer than (max_seconds), or fails.'''
+    rows, growths = [], {}
+    for axis, values in axes.items():
+        own = []
+        for value in values:
+            row = measure(axis, value, repeat)
+            own.append(row)
+            if row['error'] or row['seconds'] > max_seconds:
+                break
+        rows += own
+        growths[axis] = {metric: growth([r for r in own if not r['error']],
+                                        metric) for metric in METRICS}
+    return rows, growths
+
+def regressions(growths, baseline, tolerance):
+    '''the (axis, metric, exponent, baseline exponent) of the metrics
+    that grow faster along an axis in (growths) than in (baseline) by more
+    than (tolerance) in the exponent'''
+    found = []
+    for axis, exponents in growths.items():
+        for metric, exponent in exponents.items():
+            before = baseline.get(axis, {}).get(metric)
+            if exponent is not None and before is not None \
+               and exponent > before + tolerance:
+                found.append((axis, metric, exponent, before))
+    return found
+
+def print_growth(growths, baseline):
+    '''prints how each metric grows along each axis to stderr, with the
+    exponents of the (baseline) in parentheses'''
+    for axis, exponents in growths.items():
+        parts = []
+        for metric, exponent in exponents.items():
+            if exponent is None:
+                continue
+            part = '%s ~ %s^%.2f' % (metric, axis, exponent)
+            before = baseline.get(axis, {}).get(metric)
+            if before is not None:
+                part += ' (%.2f)' % before
+            parts.append(part)
+        print('%s: %s' % (axis, ', '.join(parts)), file=sys.stderr)
+
+def main(argv=None):
+    aparser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Benchmarks of lilsumthing')
+    commands = aparser.add_subparsers(dest='command', required=True)
+    sparser = commands.add_parser(
+        'speedup',
+        help='time the original and the rewritten code over input sizes',
+        description='Time the original and the rewritten version of the'
+        ' code blocks of .md files, the snippets of test_*.py files, and'
+        ' python modules, with the free names of the code and the'
+        ' parameters of its functions set to each of the sizes')
+    sparser.add_argument('-p', '--partial', action='store_true',
+                         default=False, help='rewrite with --partial')
+    sparser.add_argument('-g', '--guard', action='store_true', default=False,
+                         help='rewrite with --guard')
+    sparser.add_argument('-s', '--sizes', metavar='N,...',
+                         type=lambda s: [int(n) for n in s.split(',')],
+                         default=SIZES,
+                         help='the input sizes (default: %s)' % ','.join(
+                             map(str, SIZES)))
+    sparser.add_argument('-t', '--timeout', type=float, default=2.0,
+                         metavar='SECONDS',
+                         help='stop at the size where a call takes longer'
+                         ' than SECONDS (default: %(default)s)')
+    sparser.add_argument('-r', '--repeat', type=int, default=3,
+                         help='rounds of calls to take the best time of'
+                         ' (default: %(default)s)')
+    sparser.add_argument('--min-time', type=float, default=0.01,
+                         metavar='SECONDS',
+                         help='make each round take at least SECONDS'
+                         ' (default: %(default)s)')
+    sparser.add_argument('--min-speedup', type=float, default=0.0,
+                         metavar='X',
+                         help='fail if the rewritten code is not X times as'
+                         ' fast as the original at every size')
+    sparser.add_argument('-o', '--output', metavar='FILE', default='-',
+                         help='where to write the results, as CSV if FILE'
+                         ' ends in .csv, otherwise as JSON (default: stdout)')
+    sparser.add_argument('filenames', metavar='FILE', nargs='*',
+                         default=CORPUS,
+                         help='the .md, test_*.py and other python files to'
+                         ' take the code from (default: %s)' % ' '.join(
+                             CORPUS))
+    cparser = commands.add_parser(
+        'scaling',
+        help='time the optimizer on generated code along growing axes',
+        description='Time optimize() on generated summation loops along'
+        ' each axis, and fold_constant_factors() and the expansion of'
+        ' Polynomial ** on their own, recording the peak memory and the'
+        ' number of terms, and compare how they grow with a baseline')
+    cparser.add_argument('-a', '--axis', action='append', choices=AXES,
+                         help='only benchmark along AXIS (default: all)')
+    cparser.add_argument('-r', '--repeat', type=int, default=3,
+                         help='runs to take the best time of'
+                         ' (default: %(default)s)')
+    cparser.add_argument('--max-seconds', type=float, default=5.0,
+                         metavar='SECONDS',
+                         help='stop an axis after a value that takes longer'
+                         ' than SECONDS (default: %(default)s)')
+    cparser.add_argument('--baseline', metavar='FILE', default=BASELINE,
+                         help='the JSON results to compare the growth with,'
+                         ' if the file exists (default: %(default)s)')
+    cparser.add_argument('--tolerance', type=float, default=0.25,
+                         metavar='K',
+                         help='fail if something grows like value ** K'
+                         ' faster than in the baseline'
+                         ' (default: %(default)s)')
+    cparser.add_argument('-o', '--output', metavar='FILE', default='-',
+                         help='where to write the results, as CSV if FILE'
+                         ' ends in .csv, otherwise as JSON (default: stdout)')
+    args = aparser.parse_args(argv)
+    if args.command == 'scaling':
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)['growth']
+        rows, growths = scaling(
+            {axis: AXES[axis] for axis in args.axis or AXES},
+            repeat=args.repeat, max_seconds=args.max_seconds)
+        write_report(rows, args.output, SCALING_FIELDS, {'growth': growths})
+        print_growth(growths, baseline)
+        found = regressions(growths, baseline, args.tolerance)
+        for axis, metric, exponent, before in found:
+            print('%s grows like %s^%.2f along %s, instead of ^%.2f' % (
+                metric, axis, exponent, axis, before), file=sys.stderr)
+        return bool(found)
+    rows = []
+    for name, source in corpus(args.filenames):
+        rows += speedup(name, source, sizes=args.sizes, partial=args.partial,
+                        guard=args.guard, timeout=args.timeout,
+                        repeat=args.repeat, min_time=args.min_time)
+    write_report(rows, args.output)
+    return print_summary(rows, args.min_speedup)
+
+if '__main__' == __name__:
+    sys.exit(main())
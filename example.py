@@ -47,3 +47,32 @@ print(sum3(1)) # 1562500437500023125000099999985
 print(sum4(1)) # -1500000999995500002000000
 print(sum5(1)) # -1992345801500
 print(sum6(1)) # 83333374242399409069909088371592889091851724438624266050494179242504844093050000000
+
+def sum7(n):
+    S = 0
+    for i in range(n):
+        S += i * i
+    return S
+
+print(sum7(100)) # 328350
+
+def sum8(W, H):
+    S = 0
+    for x in range(W):
+        for y in range(H):
+            S += x * y
+    return S
+
+print(sum8(640, 480)) # 23507020800
+
+def sum9(n):
+    count = 0
+    total = 0
+    squares = 0
+    for i in range(n):
+        count += 1
+        total += i
+        squares += i * i
+    return count, total, squares
+
+print(sum9(100)) # (100, 4950, 328350)
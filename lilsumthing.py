@@ -1,9 +1,31 @@
 import ast
 import itertools
-from functools import reduce
+import math
+import operator
+from fractions import Fraction
+from functools import lru_cache, reduce
 
 import argparse
+import functools
+import inspect
+import textwrap
+import types
+import warnings
+import concurrent.futures
 import difflib
+import fnmatch
+import hashlib
+import importlib.machinery
+import importlib.util
+import io
+import json
+import marshal
+import os
+import re
+import shutil
+import signal
+import sys
+import tokenize
 
 # the from_to(a,b+1) variants below exploit this equivalence:
 # b    b    a-1
@@ -98,7 +120,7 @@ def power_from_to_4(f,t):
     # n=1
     '''
     return ((t*(t-1))*(2*(t-1)+1)*(3*(t-1)**2 + 3*(t-1) -1)//30
-            - (f*(f-1))*(2*f)*(3*(f-1)**2 + 3*(f-1) -1)//30)
+            - (f*(f-1))*(2*(f-1)+1)*(3*(f-1)**2 + 3*(f-1) -1)//30)
 def power_from_to_5(f,t):
     '''
     # n
@@ -107,7 +129,7 @@ def power_from_to_5(f,t):
     # note that Faulhaber's formula gives a potentially nicer solution: (4*a**3-a**2)//3 where a is n*(n+1)//2
     '''
     t -= 1
-    f = max(f-1, 0)
+    f -= 1
     return ((t**2 * (t+1)**2 * (2*t**2 + 2*t -1)) // 12
         - (f**2 * (f+1)**2 * (2*f**2 + 2*f -1)) // 12)
 def power_from_to_6(f,t):
@@ -117,7 +139,7 @@ def power_from_to_6(f,t):
     # 1          1
     '''
     t -= 1
-    f = max(f-1, 0)
+    f -= 1
     return (
         (6*t**7 +21*t**6 + 21*t**5 -7*t**3 + t)//42
         - (6*f**7 +21*f**6 + 21*f**5 -7*f**3 + f)//42
@@ -129,7 +151,7 @@ def power_from_to_7(f,t):
     # 1
     '''
     t -= 1
-    f = max(f-1, 0)
+    f -= 1
     return ((3*t**8 + 12*t**7 + 14*t**6 -7*t**4 +2*t**2)//24
             - (3*f**8 + 12*f**7 + 14*f**6 -7*f**4 +2*f**2)//24)
 def power_from_to_8(f,t):
@@ -139,7 +161,7 @@ def power_from_to_8(f,t):
     # 1
     '''
     t -= 1
-    f = max(f-1, 0)
+    f -= 1
     return ((10*t**9 + 45*t**8 + 60*t**7  -42*t**5 +20*t**3 -3*t)//90
             - (10*f**9 + 45*f**8 + 60*f**7  -42*f**5 +20*f**3 -3*f)//90)
 def power_from_to_9(f,t):
@@ -149,7 +171,7 @@ def power_from_to_9(f,t):
     # 1
     '''
     t -= 1
-    f = max(f-1, 0)
+    f -= 1
     return ((2*t**10 + 10*t**9 +15*t**8 -14*t**6 +10*t**4 -3*t**2)//20
             - (2*f**10 + 10*f**9 +15*f**8 -14*f**6 +10*f**4 -3*f**2)//20)
 def power_from_to_10(f,t):
@@ -159,7 +181,7 @@ def power_from_to_10(f,t):
     # 1
     '''
     t -= 1
-    f = max(f-1, 0)
+    f -= 1
     return ((6*t**11 + 33*t**10 +55*t**9 - 66*t**7 +66*t**5 - 33*t**3 +5*t)//66
             - (6*f**11 + 33*f**10 +55*f**9 - 66*f**7 +66*f**5 - 33*f**3 +5*f)//66)
 def power_from_to_11(f,t):
@@ -170,38 +192,873 @@ def power_from_to_11(f,t):
     # 1
     '''
     t -= 1
-    f = max(f-1, 0)
+    f -= 1
     a_t = t*(t+1)//2
     a_f = f*(f+1)//2
     return ((16*a_t**6-32*a_t**5 + 34*a_t**4 -20*a_t**3 + 5*a_t**2) // 3
             - (16*a_f**6-32*a_f**5 + 34*a_f**4 -20*a_f**3 + 5*a_f**2) // 3)
 
-def is_add(n):
-    return type(n) == ast.BinOp and type(getattr(n,'op',None)) == ast.Add
+@lru_cache(maxsize=None)
+def bernoulli(m):
+    '''the m'th Bernoulli number, using the B_1 = -1/2 convention, from the
+    recurrence:
+     m
+     ⅀ comb(m+1, j) * B_j == 0
+    j=0
+    '''
+    if m == 0:
+        return Fraction(1)
+    return -sum(math.comb(m+1, j) * bernoulli(j) for j in range(m)) / (m+1)
+
+@lru_cache(maxsize=None)
+def faulhaber(k):
+    '''Faulhaber's formula for the sum of i**k.
+    returns (numerators, denominator) such that
+     n-1                   k+1
+      ⅀ i**k  <=>  (        ⅀ numerators[j] * n**j) // denominator
+     i=0                   j=0
+    where the division is exact. the coefficients are:
+                   1
+     n**(k+1-j) * --- * comb(k+1, j) * B_j
+                  k+1
+    '''
+    coefficients = [Fraction(0)] * (k+2)
+    for j in range(k+1):
+        coefficients[k+1-j] = math.comb(k+1, j) * bernoulli(j) / (k+1)
+    denominator = math.lcm(*(c.denominator for c in coefficients))
+    return (tuple(int(c * denominator) for c in coefficients),
+            denominator)
+
+def power_to(k, t):
+    '''equivalent to sum(i**k for i in range(t)), for any k >= 0.'''
+    numerators, denominator = faulhaber(k)
+    acc = 0
+    for c in reversed(numerators): # Horner's method
+        acc = acc * t + c
+    return acc // denominator
+
+# the hand-written formulas are kept as a fast path for the common exponents:
+POWER_FROM_TO = {
+    1: range_from_to,
+    2: square_from_to,
+    3: cube_from_to,
+    4: power_from_to_4,
+    5: power_from_to_5,
+    6: power_from_to_6,
+    7: power_from_to_7,
+    8: power_from_to_8,
+    9: power_from_to_9,
+    10: power_from_to_10,
+    11: power_from_to_11,
+}
+
+def power_from_to(k, f, t):
+    '''equivalent to sum(i**k for i in range(f,t)), for any k >= 0 and f <= t'''
+    if k in POWER_FROM_TO:
+        return POWER_FROM_TO[k](f, t)
+    return power_to(k, t) - power_to(k, f)
 
 def is_int(n):
     return type(n) == ast.Constant and type(n.value) is int
 
+def uses_true_division(n):
+    '''whether the expression (n) contains a /, or a closed form of one'''
+    return any(type(node) == ast.BinOp and type(node.op) == ast.Div
+               or getattr(node, 'true_division', False)
+               for node in ast.walk(n))
+
+def is_len(n):
+    return type(n) == ast.Call and type(n.func) == ast.Name and n.func.id == 'len'
+
+def is_atom(n):
+    '''expressions we treat as opaque variables in a Polynomial:
+    names, attributes like self.n, and len() of those.
+    they must be cheap and free of side effects, since the closed form
+    may evaluate them several times.'''
+    if type(n) == ast.Name:
+        return True
+    if type(n) == ast.Attribute:
+        return is_atom(n.value)
+    if is_len(n):
+        return len(n.args) == 1 and not n.keywords and is_atom(n.args[0])
+    return False
+
+def dotted_name(n):
+    '''"functools.reduce" for functools.reduce, or None'''
+    if type(n) == ast.Name:
+        return n.id
+    if type(n) == ast.Attribute and type(n.value) == ast.Name:
+        return n.value.id + '.' + n.attr
+    return None
+
+def reduction_call(node):
+    '''recognizes the calls that add up or multiply the elements of a
+    comprehension: sum(gen, start), math.prod(gen, start=...) and
+    functools.reduce(operator.mul, gen, initial).
+    returns (comprehension, initial value, multiplicative, non_empty), or
+    None. reduce() without an initial value raises TypeError for an empty
+    sequence, so it is only (non_empty) when we can tell that it isn't.'''
+    if type(node) != ast.Call:
+        return None
+    func = dotted_name(node.func)
+    args, keywords = node.args, node.keywords
+    multiplicative = func in ('prod', 'math.prod', 'reduce', 'functools.reduce')
+    non_empty = False
+    if func in ('reduce', 'functools.reduce'):
+        if len(args) not in (2, 3) or keywords \
+           or dotted_name(args[0]) not in ('mul', 'operator.mul'):
+            return None
+        gen = args[1]
+        initial_value = args[2] if len(args) == 3 else ast.Constant(1)
+        non_empty = len(args) == 2
+    elif func in ('sum', 'prod', 'math.prod') and len(args) == 1 \
+         and len(keywords) == 1 and keywords[0].arg == 'start':
+        gen, initial_value = args[0], keywords[0].value
+    elif func in ('sum', 'prod', 'math.prod') and len(args) == 1 \
+         and not keywords:
+        gen, initial_value = args[0], ast.Constant(int(multiplicative))
+    elif func == 'sum' and len(args) == 2 and not keywords:
+        gen, initial_value = args
+    else:
+        return None
+    if type(gen) not in (ast.ListComp, ast.GeneratorExp):
+        return None
+    return gen, initial_value, multiplicative, non_empty
+
 class StateMachine():
-    def __init__(self, for_target, for_range, node_iter, replacement_target, accumulating_exprs=[], initial_value=ast.Constant(0)):
+    def __init__(self, loops, replacement_target, node_iters, facts=(),
+                 initial_value=ast.Constant(0), multiplicative=False):
+        # the start value of sum() or math.prod():
         self.initial_value = initial_value
+        # whether this is a math.prod() rather than a sum():
+        self.multiplicative = multiplicative
         # the ast node to eventually be replaced (e.g ast.For or sum()):
         self.replacement_target = replacement_target
-        # (i) in 'for i in range..':
-        self.for_target : ast.Name = for_target
-        # the range(..) in 'for i in range(..)'
-        self.node_iter = node_iter
-        # the dictionary with the parsed information:
-        self.for_range = for_range
-        # computed optimization to replace the ast.For loop with:
-        self.for_replacement : ast.AST = None
-        # abort optimizing this For loop:
+        # the (loop variable name, RangeSums) pairs we sum over, outermost first:
+        # (i) and range(..) in 'for i in range(..)'
+        self.loops = loops
+        # the range(..) nodes in 'for i in range(..)', which we don't visit:
+        self.node_iters = node_iters
+        # the counters incremented in the loop body, mapped to the Polynomial
+        # they are incremented by in each iteration. in a for-loop these
+        # come from the += (ast.AugAssign) statements, including the sums
+        # of the loops nested in it:
+        self.accumulations = {}
+        # the counters with addends that aren't polynomials, which stay
+        # in a loop when ProductWalker is (partial):
+        self.residual_counters = set()
+        # the counters multiplied in the loop body (P *= ...), mapped to the
+        # (base, exponent) Polynomial pairs they are multiplied by in each
+        # iteration; see product_factors():
+        self.products = {}
+        # the if statements around the node being visited in the loop body,
+        # see ProductWalker.indicator():
+        self.conditions = []
+        # the variables known to hold ints; see Polynomial.to_ast():
+        self.integers = set()
+        # the bounds on the loop variables in the loop body,
+        # see provably_nonnegative():
+        self.facts = list(facts)
+        for var, p_range in loops:
+            self.integers |= p_range.integers
+            self.facts += p_range.facts(var)
+        # the counters incremented by the result of a true division, which
+        # makes them floats; see Polynomial.to_ast():
+        self.floats = set()
+        # for ProductWalker.guard: the Polynomials the closed forms assume
+        # are non-negative (see provably_nonnegative()), and the names and
+        # attributes they assume are ints (see int_operands()):
+        self.assumptions = []
+        self.int_operands = []
+        # abort optimizing this loop:
         self.dont_optimize = False
-        # these are the nodes that capture the results of the summation.
-        # in a for-loop it could be the += (ast.AugAssign);
-        # or ast.ListComp.elt; or ast.GeneratorExpr.elt
-        self.accumulating_exprs = accumulating_exprs
-        assert isinstance(self.accumulating_exprs, list) # TODO typecheck
+
+def mul_monomials(a, b):
+    '''multiplies two monomials, each a tuple of (name, exponent) pairs
+    sorted by name:
+    ((i, 1), (n, 2)) * ((i, 2),) == ((i, 3), (n, 2))
+    '''
+    if not a: return b
+    if not b: return a
+    # merge the two sorted tuples:
+    ret = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        (name_a, exp_a), (name_b, exp_b) = a[i], b[j]
+        if name_a == name_b:
+            ret.append((name_a, exp_a + exp_b))
+            i += 1
+            j += 1
+        elif name_a < name_b:
+            ret.append(a[i])
+            i += 1
+        else:
+            ret.append(b[j])
+            j += 1
+    return (*ret, *a[i:], *b[j:])
+
+def pow_monomial(mono, exponent):
+    '''((i, 1), (n, 2)) ** 3 == ((i, 3), (n, 6))'''
+    if not exponent: return ()
+    return tuple((name, exp * exponent) for name, exp in mono)
+
+class Polynomial():
+    '''sparse multivariate polynomial with exact int or Fraction coefficients.
+    terms maps monomials to their coefficient, where a monomial is a
+    tuple of (variable name, exponent) pairs sorted by variable name.
+    the constant term is keyed by the empty monomial ():
+    3*i*i*n + 7  <=>  {(('i', 2), ('n', 1)): 3, (): 7}
+    zero coefficients are never stored, so the zero polynomial has no terms.
+    '''
+    __slots__ = ('terms',)
+
+    def __init__(self, terms=None):
+        self.terms = {mono: coeff for mono, coeff in (terms or {}).items()
+                      if coeff}
+
+    @classmethod
+    def constant(cls, value):
+        return cls({(): value})
+
+    @classmethod
+    def of(cls, value):
+        '''(value) as a Polynomial; numbers are constant polynomials'''
+        if isinstance(value, Polynomial):
+            return value
+        return cls.constant(value)
+
+    @classmethod
+    def variable(cls, name):
+        return cls({((name, 1),): 1})
+
+    @classmethod
+    def from_ast(cls, node):
+        '''the polynomial for a leaf node (an atom or an int ast.Constant),
+        or the .poly already computed for an inner node by ProductWalker.
+        returns None when (node) is not something we can represent.'''
+        poly = getattr(node, 'poly', None)
+        if poly is not None:
+            return poly
+        if is_int(node):
+            return cls.constant(node.value)
+        if type(node) == ast.Name:
+            return cls.variable(node.id)
+        if is_atom(node):
+            return cls.variable(ast.unparse(node))
+        return None
+
+    @classmethod
+    def from_expr(cls, node, closed_form=False):
+        '''like from_ast(), but converts a whole expression tree built with
+        +, -, * and ** by constants, e.g. the arguments of range(n+1).
+        (closed_form) is for parsing the expressions in our own closed
+        forms, where calls like max(n, 0) are variables too, and // by a
+        constant only ever divides exactly; see Polynomial.to_ast().'''
+        if type(node) == ast.BinOp:
+            left = cls.from_expr(node.left, closed_form)
+            right = cls.from_expr(node.right, closed_form)
+            if left is None or right is None:
+                return None
+            if type(node.op) == ast.Add: return left + right
+            if type(node.op) == ast.Sub: return left - right
+            if type(node.op) == ast.Mult: return left * right
+            if type(node.op) == ast.Pow and is_int(node.right) \
+               and node.right.value >= 0:
+                return left ** node.right.value
+            if type(node.op) == ast.FloorDiv and closed_form and right.as_int():
+                return left * Fraction(1, right.as_int())
+            return None
+        if type(node) == ast.UnaryOp:
+            operand = cls.from_expr(node.operand, closed_form)
+            if operand is None:
+                return None
+            if type(node.op) == ast.USub: return -operand
+            if type(node.op) == ast.UAdd: return operand
+            return None
+        if closed_form and type(node) == ast.Call:
+            return cls.variable(ast.unparse(node))
+        return cls.from_ast(node)
+
+    def variables(self):
+        return {var for mono in self.terms for var, _ in mono}
+
+    def mentions(self, name):
+        '''whether any of the variables is, or refers to, (name)'''
+        return any(variable_mentions(var, name) for var in self.variables())
+
+    def as_int(self):
+        '''the value of a constant polynomial with an integer value, or None'''
+        if not self.terms:
+            return 0
+        if len(self.terms) == 1 and () in self.terms \
+           and self.terms[()].denominator == 1:
+            return int(self.terms[()])
+        return None
+
+    def is_integral(self):
+        '''whether all the coefficients are integers'''
+        return all(coeff.denominator == 1 for coeff in self.terms.values())
+
+    def substitute(self, name, value):
+        '''replaces the variable (name) by the Polynomial (value):
+        (i*i + n).substitute('i', n + 1) == n*n + 3*n + 1
+        '''
+        return Polynomial.sum_of(coefficient * value ** exp for exp, coefficient
+                                 in self.collect(name).items())
+
+    def derivative(self, name):
+        '''the partial derivative with respect to the variable (name)'''
+        return Polynomial.sum_of(
+            coefficient * exp * Polynomial.variable(name) ** (exp - 1)
+            for exp, coefficient in self.collect(name).items() if exp)
+
+    def evaluate(self, values):
+        '''the value of the polynomial when each variable (name) is
+        replaced by the number values[name]'''
+        result = 0
+        for mono, coeff in self.terms.items():
+            for var, exp in mono:
+                coeff *= values[var] ** exp
+            result += coeff
+        return result
+
+    def integer_valued(self):
+        '''whether the polynomial takes integer values whenever its
+        variables do, like (n*n - n)/2. Such a polynomial is a sum of
+        integer multiples of products of comb(var, k), so it is enough to
+        check every point where each variable is between 0 and its degree.
+        returns False if there are too many of those points to check.'''
+        if self.is_integral():
+            return True
+        degrees = {}
+        for mono in self.terms:
+            for var, exp in mono:
+                degrees[var] = max(degrees.get(var, 0), exp)
+        if math.prod(d + 1 for d in degrees.values()) > 4096:
+            return False
+        names = list(degrees)
+        for point in itertools.product(*(range(degrees[var] + 1)
+                                         for var in names)):
+            if Fraction(self.evaluate(dict(zip(names, point)))).denominator != 1:
+                return False
+        return True
+
+    @classmethod
+    def from_products(cls, lst):
+        '''constructs the sum of a list of products of ast.Name/ast.Constant
+        nodes, like [[i; 15; 2]; [i; 40]; 14]. empty products are ignored.'''
+        terms = []
+        for product in lst:
+            if type(product) != list:
+                product = [product]
+            if not product:
+                continue
+            term = cls.constant(1)
+            for factor in product:
+                term = term * cls.from_ast(factor)
+            terms.append(term)
+        return cls.sum_of(terms)
+
+    @classmethod
+    def sum_of(cls, polys):
+        '''the sum of the Polynomials and numbers in (polys), merged into a
+        single dict: adding them up with + copies the terms of the sum so
+        far for each one, which is quadratic in the number of terms'''
+        terms = {}
+        for poly in polys:
+            for mono, coeff in cls.of(poly).terms.items():
+                terms[mono] = terms.get(mono, 0) + coeff
+        return cls(terms)
+
+    def _coerce(self, other):
+        if isinstance(other, Polynomial):
+            return other
+        if isinstance(other, (int, Fraction)):
+            return Polynomial.constant(other)
+        return NotImplemented
+
+    def __add__(self, other):
+        other = self._coerce(other)
+        if other is NotImplemented: return other
+        terms = dict(self.terms)
+        for mono, coeff in other.terms.items():
+            terms[mono] = terms.get(mono, 0) + coeff
+        return Polynomial(terms)
+    __radd__ = __add__
+
+    def __neg__(self):
+        return Polynomial({mono: -coeff for mono, coeff in self.terms.items()})
+
+    def __sub__(self, other):
+        other = self._coerce(other)
+        if other is NotImplemented: return other
+        return self + -other
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        other = self._coerce(other)
+        if other is NotImplemented: return other
+        terms = {}
+        for mono_a, coeff_a in self.terms.items():
+            for mono_b, coeff_b in other.terms.items():
+                mono = mul_monomials(mono_a, mono_b)
+                terms[mono] = terms.get(mono, 0) + coeff_a * coeff_b
+        return Polynomial(terms)
+    __rmul__ = __mul__
+
+    def __pow__(self, exponent):
+        '''expands (self)**exponent without producing the k**exponent
+        intermediate products of the naive expansion:
+        a single term is raised directly, two terms are expanded with the
+        binomial theorem, and anything larger by repeated squaring, merging
+        like terms after each multiplication.'''
+        if not isinstance(exponent, int) or exponent < 0:
+            return NotImplemented
+        if exponent == 0:
+            return Polynomial.constant(1)
+        if len(self.terms) == 1:
+            (mono, coeff), = self.terms.items()
+            return Polynomial({pow_monomial(mono, exponent): coeff ** exponent})
+        if len(self.terms) == 2:
+            # (a+b)**y <=> ⅀ comb(y,j) * a**j * b**(y-j)
+            (mono_a, coeff_a), (mono_b, coeff_b) = self.terms.items()
+            terms = {}
+            for j in range(exponent + 1):
+                mono = mul_monomials(pow_monomial(mono_a, j),
+                                     pow_monomial(mono_b, exponent - j))
+                terms[mono] = terms.get(mono, 0) + (
+                    math.comb(exponent, j) * coeff_a ** j * coeff_b ** (exponent - j))
+            return Polynomial(terms)
+        result = None
+        square = self
+        while exponent:
+            if exponent & 1:
+                result = square if result is None else result * square
+            exponent >>= 1
+            if exponent:
+                square = square * square
+        return result
+
+    def __eq__(self, other):
+        other = self._coerce(other)
+        if other is NotImplemented: return other
+        return self.terms == other.terms
+    __hash__ = None
+
+    def __bool__(self):
+        return bool(self.terms)
+
+    def __str__(self):
+        return ast.unparse(self.to_ast())
+
+    def __repr__(self):
+        return f'Polynomial({self.terms!r})'
+
+    def collect(self, name):
+        '''groups the terms by the exponent of (name), returning a dict
+        mapping each exponent to the polynomial it is multiplied by:
+        i*i*n + 3*i + 5 ==> {2: n, 1: 3, 0: 5}
+        '''
+        groups = {}
+        for mono, coeff in self.terms.items():
+            exp = 0
+            rest = []
+            for var, var_exp in mono:
+                if var == name: exp = var_exp
+                else: rest.append((var, var_exp))
+            group = groups.setdefault(exp, {})
+            group[tuple(rest)] = coeff
+        return {exp: Polynomial(terms) for exp, terms in groups.items()}
+
+    def to_products(self):
+        '''the inverse of from_products(): a list of products of ast nodes,
+        where each product lists its variables followed by its coefficient,
+        unless that coefficient is 1.'''
+        ret = []
+        for mono, coeff in self.terms.items():
+            product = [ast.Name(id=var, ctx=ast.Load())
+                       for var, exp in mono for _ in range(exp)]
+            if coeff != 1 or not product:
+                product.append(ast.Constant(coeff))
+            ret.append(product)
+        return ret
+
+    def to_ast(self, integers=frozenset(), true_division=False):
+        '''constructs an expression, emitting the terms in order of
+        increasing degree, with the constant term first:
+        {(('n', 2),): -3, (('n', 1),): 5, (): 7} ==> 7 + n * 5 - n ** 2 * 3
+        for rational coefficients, (integers) names the variables known to
+        hold ints (the range bounds; see integer_variable()), and the terms
+        are grouped by their remaining factors. each group that is an
+        integer-valued polynomial is computed exactly with //:
+        {(('n', 2),): 1/2, (('n', 1),): -1/2, (('n', 1), ('x', 1)): 3}
+        ==> n * x * 3 + (-n + n ** 2) // 2  (for integers={'n'})
+        and any other group with a single true division. when all the
+        variables hold ints, the polynomial stands for a sum of ints, so
+        it can be computed with a single // even when it isn't
+        integer-valued for all ints.
+        with (true_division) the whole expression is a float, like the
+        sum of the results of / it stands for:
+        ==> (-n + n ** 2 + n * x * 6) / 2
+        '''
+        if true_division:
+            denominator = math.lcm(*(coeff.denominator
+                                     for coeff in self.terms.values()))
+            term = terms_ast({mono: int(coeff * denominator)
+                              for mono, coeff in self.terms.items()})
+            if denominator == 1:
+                return ast.Call(func=ast.Name(id='float', ctx=ast.Load()),
+                                args=[term], keywords=[])
+            return ast.BinOp(left=term, op=ast.Div(),
+                             right=ast.Constant(denominator))
+        if self.is_integral():
+            return terms_ast({mono: int(coeff)
+                              for mono, coeff in self.terms.items()})
+        groups = {}
+        for mono, coeff in self.terms.items():
+            outer = tuple(p for p in mono
+                          if not integer_variable(p[0], integers))
+            inner = tuple(p for p in mono
+                          if integer_variable(p[0], integers))
+            groups.setdefault(outer, {})[inner] = coeff
+        if list(groups) == [()] and not self.integer_valued():
+            # like (3 ** n - 1) / 2, where 3 ** n is always odd:
+            denominator = math.lcm(*(coeff.denominator
+                                     for coeff in self.terms.values()))
+            return ast.BinOp(
+                left=terms_ast({mono: int(coeff * denominator)
+                                for mono, coeff in self.terms.items()}),
+                op=ast.FloorDiv(), right=ast.Constant(denominator))
+        expr = None
+        for outer, group in sorted(groups.items(), key=monomial_order):
+            denominator = math.lcm(*(coeff.denominator for coeff in group.values()))
+            term = terms_ast({mono: int(coeff * denominator)
+                              for mono, coeff in group.items()})
+            if denominator != 1:
+                exact = Polynomial(group).integer_valued()
+                term = ast.BinOp(left=term,
+                                 op=exact and ast.FloorDiv() or ast.Div(),
+                                 right=ast.Constant(denominator))
+            if outer:
+                term = ast.BinOp(left=monomial_ast(outer), op=ast.Mult(),
+                                 right=term)
+            expr = term if expr is None else ast.BinOp(
+                left=expr, op=ast.Add(), right=term)
+        return expr
+
+def monomial_order(term):
+    '''sort key for (monomial, coefficient) pairs: by degree, then by name'''
+    return (sum(e for _, e in term[0]), term[0])
+
+def var_ast(name):
+    '''the expression for a Polynomial variable: either a plain name,
+    or the source of an atom like len(xs) or max(n, 0)'''
+    if name.isidentifier():
+        return ast.Name(id=name, ctx=ast.Load())
+    return ast.parse(name, mode='eval').body
+
+@lru_cache(maxsize=None)
+def variable_mentions(var, name):
+    '''whether the Polynomial variable (var) is, or refers to, (name):
+    both n and max(n, 0) mention n'''
+    if var.isidentifier():
+        return var == name
+    return any(type(n) == ast.Name and n.id == name
+               for n in ast.walk(var_ast(var)))
+
+def mod_atom(poly, modulus):
+    '''the Polynomial for (poly) % (modulus), where (poly) has integer
+    coefficients and variables, and (modulus) is a non-zero int: a variable
+    holding the source of the expression, or a constant when the remainder
+    is the same for every value of the variables modulo (modulus), like
+    (i*i + i) % 2 == 0.'''
+    names = sorted(poly.variables())
+    if abs(modulus) ** len(names) <= 4096:
+        remainders = {poly.evaluate(dict(zip(names, point))) % modulus
+                      for point in itertools.product(range(abs(modulus)),
+                                                     repeat=len(names))}
+        if len(remainders) == 1:
+            return Polynomial.constant(int(remainders.pop()))
+    return Polynomial.variable(ast.unparse(ast.BinOp(
+        left=poly.to_ast(), op=ast.Mod(), right=ast.Constant(modulus))))
+
+@lru_cache(maxsize=None)
+def parse_mod_atom(var):
+    '''the (Polynomial, modulus) pair of a variable made by mod_atom(),
+    or None for other variables'''
+    if var.isidentifier():
+        return None
+    node = var_ast(var)
+    if type(node) != ast.BinOp or type(node.op) != ast.Mod:
+        return None
+    poly = Polynomial.from_expr(node.left, closed_form=True)
+    modulus = Polynomial.from_expr(node.right)
+    if poly is None or modulus is None or not modulus.as_int():
+        return None
+    return poly, modulus.as_int()
+
+def power_atom(base, exponent, integers=frozenset()):
+    '''the Polynomial for (base) ** (exponent), for Polynomials with integer
+    coefficients, or an (exponent) that is a sum of ints in the variables
+    (integers), see Polynomial.to_ast(): a constant when both are constants
+    and (exponent) is not negative, and otherwise a variable holding the
+    source of the power.'''
+    value = exponent.as_int()
+    if value == 0:
+        return Polynomial.constant(1)
+    if value == 1:
+        return base
+    if value is not None and value > 0 and base.as_int() is not None:
+        return Polynomial.constant(base.as_int() ** value)
+    # a base of -2 is -(2), which unparses as (-2) ** i, see int_ast():
+    left = base.to_ast()
+    return Polynomial.variable(ast.unparse(ast.BinOp(
+        left=left, op=ast.Pow(), right=exponent.to_ast(integers=integers))))
+
+@lru_cache(maxsize=None)
+def parse_power_atom(var):
+    '''the (base, exponent) Polynomials of a variable made by power_atom(),
+    or None for other variables'''
+    if var.isidentifier():
+        return None
+    node = var_ast(var)
+    if type(node) != ast.BinOp or type(node.op) != ast.Pow:
+        return None
+    base = Polynomial.from_expr(node.left, closed_form=True)
+    exponent = Polynomial.from_expr(node.right, closed_form=True)
+    if base is None or exponent is None:
+        return None
+    return base, exponent
+
+@lru_cache(maxsize=None)
+def parse_geometric(var, name):
+    '''for a power_atom() c ** (u*name + w) with c and w not depending on
+    (name) and a non-zero int u, returns (c, u, w), and otherwise None'''
+    power = parse_power_atom(var)
+    if power is None:
+        return None
+    base, exponent = power
+    groups = exponent.collect(name)
+    if base.mentions(name) or not set(groups) <= {0, 1}:
+        return None
+    u = groups.get(1, Polynomial()).as_int()
+    w = groups.get(0, Polynomial())
+    if not u or w.mentions(name):
+        return None
+    return base, u, w
+
+def threshold_atom(name, op, bound):
+    '''the Polynomial variable for the condition (name) >= (bound) or
+    (name) < (bound), where (op) is '>=' or '<' and (bound) is a Polynomial
+    with integer coefficients and variables that doesn't mention (name).
+    as a number it is 1 or 0, and RangeSums.sum_over() sums it by
+    splitting the range at (bound).'''
+    return Polynomial.variable(ast.unparse(ast.Compare(
+        left=ast.Name(id=name, ctx=ast.Load()),
+        ops=[op == '>=' and ast.GtE() or ast.Lt()],
+        comparators=[bound.to_ast()])))
+
+@lru_cache(maxsize=None)
+def parse_threshold(var):
+    '''the (name, op, bound) of a variable made by threshold_atom(),
+    or None for other variables'''
+    if var.isidentifier():
+        return None
+    node = var_ast(var)
+    if type(node) != ast.Compare or len(node.ops) != 1 \
+       or type(node.ops[0]) not in (ast.GtE, ast.Lt) \
+       or type(node.left) != ast.Name:
+        return None
+    bound = Polynomial.from_expr(node.comparators[0], closed_form=True)
+    if bound is None:
+        return None
+    return node.left.id, type(node.ops[0]) == ast.GtE and '>=' or '<', bound
+
+COMPARISONS = {ast.Eq: operator.eq, ast.NotEq: operator.ne,
+               ast.Lt: operator.lt, ast.LtE: operator.le,
+               ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+# indicator() interpolates over at most this many combinations of values:
+MAX_INDICATOR_POINTS = 64
+
+def finite_values(var):
+    '''the values of the Polynomial variable (var) when there are only a
+    few: a remainder, or a condition; otherwise None'''
+    if parse_threshold(var) is not None:
+        return range(2)
+    mod = parse_mod_atom(var)
+    if mod is None:
+        return None
+    if mod[1] > 0:
+        return range(mod[1])
+    return range(mod[1] + 1, 1)
+
+def indicator(poly, test):
+    '''the Polynomial that is 1 where test(value of (poly)) holds and
+    0 elsewhere, like 1 - (i % 2) for i % 2 == 0, or None. the variables
+    must all be finite_values(), and the Polynomial is interpolated over
+    their values with the Lagrange basis polynomials.'''
+    names = sorted(poly.variables())
+    domains = [finite_values(name) for name in names]
+    if None in domains or math.prod(map(len, domains)) > MAX_INDICATOR_POINTS:
+        return None
+    result = Polynomial()
+    for point in itertools.product(*domains):
+        if not test(poly.evaluate(dict(zip(names, point)))):
+            continue
+        basis = Polynomial.constant(1)
+        for name, domain, value in zip(names, domains, point):
+            for other in domain:
+                if other != value:
+                    basis *= (Polynomial.variable(name) - other) \
+                        * Fraction(1, value - other)
+        result += basis
+    return result
+
+def integer_variable(var, integers):
+    '''whether the Polynomial variable (var) always holds an int:
+    the names in (integers), lengths, factorials, conditions, and remainders,
+    powers with non-negative exponents, max() and min() of those.'''
+    if var in integers or var.startswith(('len(', 'math.factorial(',
+                                          'math.perm(', 'math.ceil(',
+                                          'math.floor(')) \
+       or parse_threshold(var) is not None:
+        return True
+    node = var_ast(var)
+    if type(node) == ast.Call and dotted_name(node.func) in ('max', 'min'):
+        args = [Polynomial.from_expr(arg, closed_form=True)
+                for arg in node.args]
+        return None not in args and all(
+            arg.is_integral() and all(integer_variable(v, integers)
+                                      for v in arg.variables())
+            for arg in args)
+    mod = parse_mod_atom(var)
+    if mod is not None:
+        return all(integer_variable(v, integers) for v in mod[0].variables())
+    power = parse_power_atom(var)
+    return power is not None and power[0].is_integral() \
+        and all(integer_variable(v, integers) for v in power[0].variables()) \
+        and provably_nonnegative(power[1])
+
+def product_factors(node):
+    '''the (base, exponent) Polynomial pairs whose powers multiply to the
+    expression (node), like [(x, 1), (2, i)] for x * 2 ** i, or None when
+    (node) is not a product of powers of integral polynomials'''
+    if type(node) == ast.BinOp and type(node.op) == ast.Mult:
+        left = product_factors(node.left)
+        right = product_factors(node.right)
+        if left is None or right is None:
+            return None
+        return left + right
+    if type(node) == ast.BinOp and type(node.op) == ast.Pow:
+        left = product_factors(node.left)
+        exponent = Polynomial.from_ast(node.right)
+        if left is None or exponent is None or not exponent.is_integral():
+            return None
+        return [(base, e * exponent) for base, e in left]
+    poly = Polynomial.from_ast(node)
+    if poly is None or not poly.is_integral():
+        return None
+    return monomial_factors(poly)
+
+def signed_addends(node, sign=1):
+    '''the (sign, addend) pairs of the sum (node), like
+    [(1, a), (-1, b), (1, c)] for a - b + c'''
+    if getattr(node, 'poly', None) is None and type(node) == ast.BinOp \
+       and type(node.op) in (ast.Add, ast.Sub):
+        right_sign = type(node.op) == ast.Add and sign or -sign
+        return signed_addends(node.left, sign) \
+            + signed_addends(node.right, right_sign)
+    return [(sign, node)]
+
+def split_addends(node):
+    '''splits the sum (node) into its polynomial addends and the rest,
+    for peeling the closed form out of a loop that can't be rewritten
+    completely. returns (Polynomial, [the polynomial addends], the rest as
+    an expression or None), or None when the rest assigns names or
+    yields, since that must happen in the same order as before.'''
+    poly, polynomial, residual = Polynomial(), [], None
+    for sign, addend in signed_addends(node):
+        addend_poly = Polynomial.from_ast(addend)
+        if addend_poly is not None:
+            poly += addend_poly * sign
+            polynomial.append(addend)
+            continue
+        if any(type(n) in (ast.NamedExpr, ast.Yield, ast.YieldFrom,
+                           ast.Await) for n in ast.walk(addend)):
+            return None
+        if residual is None and sign < 0:
+            residual = ast.UnaryOp(op=ast.USub(), operand=addend)
+        elif residual is None:
+            residual = addend
+        else:
+            residual = ast.BinOp(left=residual, right=addend,
+                                 op=sign < 0 and ast.Sub() or ast.Add())
+    return poly, polynomial, residual
+
+def factors_str(factors):
+    return ' * '.join(f'({base}) ** ({exponent})' for base, exponent in factors)
+
+def monomial_factors(poly):
+    '''product_factors() of a Polynomial: the powers in (poly) when it is a
+    single term, so that c ** i * c ** j becomes c ** (i + j)'''
+    if len(poly.terms) != 1:
+        return [(poly, Polynomial.constant(1))]
+    (mono, coeff), = poly.terms.items()
+    factors = []
+    if coeff != 1 or not mono:
+        factors.append((Polynomial.constant(coeff), Polynomial.constant(1)))
+    for var, exp in mono:
+        power = parse_power_atom(var)
+        if power is None:
+            power = Polynomial.variable(var), Polynomial.constant(1)
+        factors.append((power[0], power[1] * exp))
+    return factors
+
+def monomial_ast(mono):
+    factors = []
+    for var, exp in mono:
+        factor = var_ast(var)
+        if exp != 1:
+            factor = ast.BinOp(left=factor, op=ast.Pow(),
+                               right=ast.Constant(exp))
+        factors.append(factor)
+    return reduce(lambda a, b: ast.BinOp(left=a, op=ast.Mult(), right=b),
+                  factors)
+
+def int_ast(value):
+    '''the expression for the int (value): -55 is -(55), as the parser sees
+    it, so that it unparses as (-55) ** 2 and (-55).real where it needs to'''
+    if value < 0:
+        return ast.UnaryOp(op=ast.USub(), operand=ast.Constant(-value))
+    return ast.Constant(value)
+
+def terms_ast(terms):
+    '''see Polynomial.to_ast(); (terms) must have integer coefficients'''
+    expr = None
+    for mono, coeff in sorted(terms.items(), key=monomial_order):
+        negate = expr is not None and coeff < 0
+        if negate:
+            coeff = -coeff
+        if not mono:
+            term = int_ast(coeff)
+        else:
+            term = monomial_ast(mono)
+            if coeff == -1:
+                term = ast.UnaryOp(op=ast.USub(), operand=term)
+            elif coeff != 1:
+                term = ast.BinOp(left=term, op=ast.Mult(),
+                                 right=int_ast(coeff))
+        if expr is None:
+            expr = term
+        else:
+            expr = ast.BinOp(left=expr, op=negate and ast.Sub() or ast.Add(),
+                             right=term)
+    if expr is None:
+        return ast.Constant(0)
+    return expr
 
 def fold_constant_factors(lst):
     '''given a list like
@@ -218,50 +1075,10 @@ def fold_constant_factors(lst):
         [14]; [15;2];       == [44]
         [x; 5]            == [x; 5]
         [z; 2+3]          == [z; 5]
+    ProductWalker itself works on Polynomial directly; this converts
+    to and from the list-of-products representation.
     '''
-    partitions = {}
-    for product in lst: # maybe get rid of enumerate()
-        constants , wo_constants = [], []
-        if type(product) != list:
-            product = [product]
-        for x in product:
-            if type(x) != ast.Constant: wo_constants.append(x)
-            else: constants.append(x)
-            # ordering doesn't matter, but [i;i] and [i] go in
-            # separate partitions:
-        wo_constants.sort(key=lambda x: x.id)
-        name_hash = ','.join(x.id for x in wo_constants)
-        # now we do constant folding for each shard, computing the
-        # product of (constants) and storing the running sum:
-        this_sum = 0
-        if constants:
-            this_sum = reduce(int.__mul__, (x.value for x in constants), 1)
-        elif wo_constants:
-            this_sum = 1
-        # note that we have to be careful not to add a zero 'sum'
-        # by accident. unless a constant above is 0,
-        # this_sum will be nonzero because it's initialized with 1.
-        # if there are no constants, it will be 1, so we retain the
-        # property that [i]+[i] turns into [i;2] and not [i;0]:
-        if this_sum:
-            partitions[name_hash] = partitions.get(name_hash, {
-                'sum': 0, # identity of addition
-                'wo_constants': wo_constants
-            })
-            partitions[name_hash]['sum'] += this_sum
-            if not partitions[name_hash]['sum']:
-                # [[i, 1], [i, -1]] ("i*1+i*-1" = "i-i" = "0"):
-                # these cancel out, so we remove them:
-                del partitions[name_hash]
-        # and finally we reconstruct the original format:
-        ret = []
-    for pdict in partitions.values():
-        assert pdict['sum'] != 0, pdict
-        if pdict['sum'] == 1 and pdict['wo_constants']:
-            ret += [[*pdict['wo_constants']]]
-        else:
-            ret += [[*pdict['wo_constants'], ast.Constant(pdict['sum'])]]
-    return ret
+    return Polynomial.from_products(lst).to_products()
 
 def pp(lstlst):
     '''pretty-prints ast nodes, and nested iterables of ast nodes'''
@@ -278,15 +1095,27 @@ def pp(lstlst):
 
 
 class ProductWalker(ast.NodeTransformer):
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, partial=False, guard=False,
+                 rebound=()):
         self.verbose = verbose
+        # peel the polynomial addends out of loops that can't be rewritten
+        # completely, keeping a loop over the rest; see accumulate():
+        self.partial = partial
+        # keep the original loops for the inputs the closed forms may not
+        # hold for, behind an if statement; see guard_tests():
+        self.guard = guard
+        # the names bound in the enclosing scopes, with whether each is a
+        # class, and those that (rebound) binds around the module; see
+        # shadowed_builtins():
+        self.scopes = []
+        self.rebound = set(rebound)
+        self.math_shadowed = False # see shadows_math()
         self.level = 0
         self.node_id = 0
-        self.states = [] # stack of state machine states for ast.For loops
-        # dict of (potential) accumulator variables. note that this does
-        # not get cleaned up, and it doesn't care about scope. TODO:
-        self.local_counters = {}
-        self.allowed_name_refs = set() # allowed refs to the accumulator
+        self.states = [] # stack of state machine states for ast.For loops and sum()
+        self.constants = {} # see module_constants()
+        # the loops and sum() calls we replaced, and what with; see splice():
+        self.replacements = []
         super().__init__()
     def pl(self, *a):
         '''print with indentation based on current nesting level in the tree'''
@@ -296,369 +1125,1487 @@ class ProductWalker(ast.NodeTransformer):
                 print('', pp(arg), end='')
             print('')
 
-    def visit_Assign(self, node):
-        '''BFS visit of ast.Assign nodes, where we try to identify the
-        counter variables used in the for loops. Since we do not track
-        the steps between Assign and For, we cannot safely replace *this* node,
-        instead we should replace the ast.For node in order to handle cases
-        like:
-        S = 123              # ast.Assign (this node)
-        b = S + 10
-        for i in range(10):  # ast.For that we can rewrite
-          S += b + i         # ast.AugAssign
-        TODO unless we use self.node_id to ensure that's not the case;
-        in that case we can eliminate the Assign node...
-        but on a second pass over the AST?
-        '''
-        for target in node.targets:
-            if type(target) == ast.Name and \
-               is_int(node.value):
-                # TODO should try to check that it's a numerical constant?
-                # or at least complain if it is clearly not
-                self.pl('identified potential counter', target.id)
-                self.allowed_name_refs.add(target)
-                self.local_counters[target.id] = {
-                    'value': node.value
-                }
-        return node
+    def fail(self, *reason):
+        '''abort optimizing the innermost loop, if any'''
+        if self.states:
+            self.pl('not optimizing because', *reason)
+            self.states[-1].dont_optimize = True
+
+    def unhandled(self, *reason):
+        '''an expression that isn't a polynomial, which is the end of
+        optimizing the innermost loop unless it is (partial)'''
+        if self.partial:
+            self.pl('not a polynomial:', *reason)
+        else:
+            self.fail(*reason)
+
+    def assumptions(self):
+        '''the list collecting what the innermost loop assumes, with (guard);
+        see provably_nonnegative()'''
+        if self.guard and self.states:
+            return self.states[-1].assumptions
+        return None
 
-    def postprocess_expr(self, node):
+    def guard_tests(self, state, counters):
+        '''the tests that the closed forms of (state) hold for the input,
+        which a guarded rewrite checks before them: the int_operands() and
+        the (counters) are ints, and the assumptions are non-negative.
+        returns None if those can't be checked before the loops.'''
+        loop_vars = {var for s in self.states + [state] for var, _ in s.loops}
+        if any(assumption.mentions(var) or assumption.as_int() is not None
+               for assumption in state.assumptions for var in loop_vars):
+            # (a constant we couldn't show is non-negative is negative)
+            return None
+        tests = [ast.Compare(
+            left=ast.Call(func=ast.Name(id='type', ctx=ast.Load()),
+                          args=[operand], keywords=[]),
+            ops=[ast.Is()], comparators=[ast.Name(id='int', ctx=ast.Load())])
+                 for operand in state.int_operands + [
+                         ast.Name(id=name, ctx=ast.Load())
+                         for name in sorted(counters)]]
+        integers = frozenset(self.state_integers(state))
+        for assumption in state.assumptions:
+            # k - 1 >= 0 reads better as k >= 1:
+            constant = Polynomial.constant(assumption.terms.get((), 0))
+            tests.append(ast.Compare(
+                left=(assumption - constant).to_ast(integers=integers),
+                ops=[ast.GtE()],
+                comparators=[(-constant).to_ast(integers=integers)]))
+        unique = {}
+        for test in tests:
+            unique.setdefault(ast.unparse(test), test)
+        return list(unique.values())
+
+    def guarded(self, state, counters, replacement, node):
+        '''(replacement) for (node), checking guard_tests() first with
+        (guard): an if statement for the statements replacing a For loop,
+        and a conditional expression for an expression; None if the tests
+        can't be checked'''
+        if not self.guard:
+            return replacement
+        tests = self.guard_tests(state, counters)
+        if tests is None or state.floats:
+            # the sums of floats in the loops may round differently:
+            return None
+        if not tests:
+            return replacement
+        test = len(tests) == 1 and tests[0] or ast.BoolOp(op=ast.And(),
+                                                          values=tests)
+        if type(replacement) == list:
+            guarded = ast.If(test=test, body=replacement, orelse=[node])
+        else:
+            guarded = ast.IfExp(test=test, body=replacement, orelse=node)
+            guarded.poly = getattr(replacement, 'poly', None)
+        guarded.guarded = True
+        return guarded
+
+    def shadowed_builtins(self, *trees):
+        '''the CLOSED_FORM_BUILTINS and GUARD_BUILTINS that (trees) use,
+        but that the scopes we are in bind to something else: the module,
+        the enclosing functions and the class whose body we are in, if
+        any. with (guard), a star import may bind any of them.'''
+        names = set()
+        for nth, (is_class, bound) in enumerate(self.scopes):
+            if not is_class or nth == len(self.scopes) - 1:
+                names |= bound
+        return sorted({n.id for tree in trees for n in ast.walk(tree)
+                       if type(n) == ast.Name and type(n.ctx) == ast.Load
+                       and n.id in CLOSED_FORM_BUILTINS + GUARD_BUILTINS
+                       and (n.id in names or self.guard and '*' in names)})
+
+    def facts(self):
+        '''the bounds on the loop variables in the innermost loop,
+        like (i, i) and (i, n - 1 - i) inside 'for i in range(n)'.
         '''
-        computes the final optimized version of an expression.
-        works on e.g. ast.AugAssign.value or ast.ListComp.elt
+        if self.states:
+            return self.states[-1].facts
+        return []
+
+    def known_integers(self):
+        '''the variables known to hold ints: the loop variables and the
+        range bounds of all the enclosing loops'''
+        names = set()
+        for state in self.states:
+            names |= state.integers
+            names.update(var for var, _ in state.loops)
+        return names
+
+    def known_value(self, stmt, name):
+        '''Looks at the statements preceding (stmt) in the same block for
+        the constant value of the counter (name), so that we can replace:
+        S = 123              # ast.Assign
+        b = 10
+        for i in range(10):  # ast.For that we can rewrite (stmt)
+          S += b + i         # ast.AugAssign
+        with S = 123 + (10*b + 45) rather than S += 10*b + 45.
+        We give up at anything that might change (name) behind our back,
+        like function calls, and return None.
         '''
-        adds = getattr(node, 'adds', [node])
-        for lst in adds:
-            for x in (type(lst) is list and lst or [lst]):
-                if type(x) == ast.Constant: continue
-                if type(x) == ast.Name: continue
-                self.pl('postprocess: not rewriting because our adds is not Constant/Name:',
-                        type(x), x, )
-                self.states[-1].dont_optimize = True
+        prev = getattr(stmt, 'previous', None)
+        while prev is not None:
+            if type(prev) == ast.Assign and len(prev.targets) == 1 \
+               and type(prev.targets[0]) == ast.Name and prev.targets[0].id == name:
+                value = Polynomial.from_expr(prev.value)
+                if value is not None and value.as_int() is not None:
+                    self.pl('identified counter', name, '=', value)
+                    return value
                 return None
-        self.pl(adds)
-        adds = fold_constant_factors(adds)
-        self.pl(adds)
-        # after constant folding, we are left with products containing
-        # variable names and constants, or just a single constant.
-        # There are two categories:
-        # 1) product factors referring to constants and/or external variables
-        # 2) addends whose product factors refer to the loop index
-        # Each category 1 addend gets the length/span of the loop added as a factor.
-        # Category 2 requires special handling. TODO.
-        for i, product in enumerate(adds):
-            # TODO I guess we should care about scope and not just check for
-            # lexicographical equality here.
-            powers_of_loop_var = len([x for x in product if type(x) == ast.Name and \
-                                      x.id == self.states[-1].for_target.id
-                                      ])
-            if powers_of_loop_var == 0:
-                adds[i].append(ast.Constant(self.states[-1].for_range["len"]))
-            elif powers_of_loop_var > 0:
-                adds[i] = list(filter(
-                    lambda x: getattr(x,'id',None) != self.states[-1].for_target.id,
-                    adds[i]))
-                const = self.states[-1].for_range.get(powers_of_loop_var, None)
-                if const:
-                    adds[i] += [ast.Constant(const)]
-                else:
-                    # category 2 with loopvar^n with n >= 12, this should
-                    # be handled in the future.
-                    # in the meantime we should abort the postprocessing
-                    # and set dont_optimize=True. TODO.
-                    self.pl(f'powers of {powers_of_loop_var} not implemented, not optimizing')
-                    self.states[-1].dont_optimize = True
+            if type(prev) not in (ast.Assign, ast.AugAssign, ast.Pass):
+                return None
+            for n in ast.walk(prev):
+                if type(n) == ast.Call or (type(n) == ast.Name and n.id == name):
                     return None
-                pass # category 2
-        self.pl(adds)
-        #
-        # Add the initial value of the counter: the 123 in
-        # (S = 123, for ... S += ..):
-        #
-        if self.states[-1].initial_value:
-            adds += [[self.states[-1].initial_value]]
-        #
-        # Final reduction step:
-        #
-        adds = fold_constant_factors(adds)
-        self.pl(adds)
-        #
-        # At the end we need to transform our [addends[products]] list into
-        # a nested AST node structure:
-        def mk_add(a,b):
-            # TODO if they are both 0 we should remove it entirely,
-            # instead of returning a ast.Constant(0):
-            if is_int(a) and a.value == 0: return b
-            if is_int(b) and b.value == 0: return a
-            return ast.BinOp(left=a, op=ast.Add(), right=b)
-        def mk_mult(a,b):
-            if is_int(a) and a.value == 0: return ast.Constant(0)
-            if is_int(b) and b.value == 0: return ast.Constant(0)
-            if is_int(a) and a.value == 1: return b
-            elif is_int(b) and b.value == 1: return a
-            return ast.BinOp(left=a, op=ast.Mult(), right=b)
-        adds = list(map(lambda addend: reduce(mk_mult, addend[:], ast.Constant(1)) , adds))
-        self.pl(adds)
-        expr = reduce(mk_add, adds, ast.Constant(0))
-        return expr
-
-    def postprocess_listcomp(self, node):
-        expr = self.postprocess_expr(node.elt)
-        self.pl('got a comprehension', node.elt, '===>', expr)
-        if not expr:
-            return node
-        ast.fix_missing_locations(expr)
-        self.states[-1].for_replacement = expr
-        return node
-
-    def postprocess_augassign(self, node):
-        self.pl('postprocess_augassign', node)
-        expr = self.postprocess_expr(node.value)
-        if not expr:
-            # failed to optimize for some reason
-            return Node
-        self.states[-1].for_replacement = ast.Assign(
-            targets=[node.target],
-            value=[ expr ],
-        )
-        ast.fix_missing_locations(self.states[-1].for_replacement)
-        self.pl(node)
-        self.pl('==>', self.states[-1].for_replacement)
-        return node
-
-    def visit_Name(self, node):
-        if node.id in self.local_counters:
-            if node in self.allowed_name_refs:
-                return node
-            # this gets triggered when we add the for_replacement to the tree,
-            # which is a problem if we want to do nested loops.
-            if self.states:
-                self.pl('not optimizing because', node.id,
-                    'is an accumulator and that is not supported yet.')
-                self.states[-1].dont_optimize = True
-        return node
+            prev = getattr(prev, 'previous', None)
+        return None
 
     def generic_visit(self, node):
         self.node_id += 1 # our unique ID for this node
 
-        if self.states and node is self.states[-1].node_iter:
+        if self.states and any(node is it for it in self.states[-1].node_iters):
             # (relevant for list comprehensions where the range() is inside
             # the expression to be optimized)
             self.pl('skipping our own range', node)
             return node
 
-        if type(node) == ast.For and not node.orelse:
-            self.pl('ast.For loop:', ast.unparse(node))
-            p_range = optimizable_range(node.iter)
-            self.states.append(StateMachine(node.target, p_range,
-                                            replacement_target=node,
-                                            node_iter=node.iter))
-            if not p_range:
-                self.states[-1].dont_optimize = True
-        elif type(node) == ast.Call and type(node.func) == ast.Name and 'sum'==node.func.id:
-            self.pl('ast.Call: sum()')
-            if not node.args:
-                self.pl('sum() without arguments TODO')
-                return node
-            initial_value = ast.Constant(0)
-            if (len(node.args) == 2 and [] == node.keywords):
-                initial_value = node.args[1]
-            elif len(node.args) == 1 and len(node.keywords) == 1 and 'start' == node.keywords[0].arg:
-                initial_value = node.keywords[0]
-            sum_args = node.args[0]
-            if type(sum_args) in [ast.ListComp, ast.GeneratorExp]:
-                # sum([ ... ]) or sum(( ... ))
-                # [a for a in range(2) for b in range(3)] has:
-                # len(.generators) == 2
-                # [ (for a in range(2)),  (for b in range(3)) ]
-                if len(sum_args.generators) != 1:
-                    self.pl('TODO handle nested comprehensions')
-                    if self.states: self.states[-1].dont_optimize = True
-                    return node
-                generator = sum_args.generators[0]
-                if type(generator) == ast.comprehension:
-                    # loop var: generator.target
-                    p_range = optimizable_range(generator.iter)
-                    loop_body = sum_args.elt
-                    self.states.append(StateMachine(
-                        generator.target, p_range,
-                        node_iter=generator.iter,
-                        replacement_target=node,
-                        initial_value=initial_value,
-                        accumulating_exprs=[loop_body]))
-                    if not p_range:
-                        self.states[-1].dont_optimize = True
-                    self.pl('sum', 'loop var:', generator.target,
-                            'range:', p_range,
-                            'loop_body:', loop_body,
-                            'initial_value:', initial_value)
-        elif type(node) == ast.AugAssign:
-            if self.states:
-                # TODO this is a massive dirty hack; we should capture these
-                # during BFS and set initial_value (PLURAL) depending on which
-                # ones were referenced. For now, though, we overwrite:
-                if self.states[-1].initial_value.value != 0:
-                    self.pl("more than one AugAssign seen in this state. not implemented.")
-                    self.states[-1].dont_optimize = True
-                    return node
-                self.states[-1].initial_value = self.local_counters[node.target.id]['value']
-            self.allowed_name_refs.add(node.target)
-
-        # TODO still_optimizing is a mess here.
-        # we want to test for dont_optimize being set in one of the
-        # descendants, but we also want it to be True if there are no
-        # states.
-        still_optimizing = True
-        if still_optimizing and self.states:
-            still_optimizing = not self.states[-1].dont_optimize
-        if still_optimizing:
-            self.level += 1
-            node = super().generic_visit(node)
-            self.level -= 1
-            if self.states:
-                still_optimizing = not self.states[-1].dont_optimize
+        # for known_value(), each statement is linked to the one before it:
+        for field in ('body', 'orelse', 'finalbody'):
+            stmts = getattr(node, field, None)
+            if type(stmts) is list:
+                for prev, stmt in zip(stmts, stmts[1:]):
+                    stmt.previous = prev
+
+        if type(node) in SCOPES:
+            names = scope_bindings(node)
+            if type(node) == ast.Module:
+                names |= self.rebound
+            self.scopes.append((type(node) == ast.ClassDef, names))
+        if type(node) == ast.Module:
+            self.constants = module_constants(node)
+            bindings = module_bindings(node)
+            self.math_shadowed = shadows_math(node, bindings) \
+                or self.guard and '*' in bindings
+        elif type(node) == ast.For:
+            self.enter_for(node)
+        elif reduction_call(node) is not None:
+            self.enter_sum(node)
+        conditions = None
+        if type(node) == ast.If and self.states:
+            # see indicator()
+            conditions = self.states[-1].conditions
+            conditions.append(node)
+
+        self.level += 1
+        scope = type(node) in SCOPES
+        node = super().generic_visit(node)
+        if scope:
+            self.scopes.pop()
+        self.level -= 1
+
+        if conditions is not None:
+            conditions.pop()
 
         if self.states and node is self.states[-1].replacement_target:
             # this is where we need to modify (node) to replace the For loop
-            if type(node) == ast.For and node.orelse:
-                self.pl('what to do about for.orelse?')
-                return node
             self.pl('ENDSUM')
-            finalstate = self.states.pop()
-            if finalstate.for_replacement and not finalstate.dont_optimize:
-                ast.fix_missing_locations(finalstate.for_replacement)
-                return finalstate.for_replacement
-        elif still_optimizing:
+            if type(node) == ast.For:
+                return self.leave_for(node)
+            return self.leave_sum(node)
+        elif self.states and not self.states[-1].dont_optimize:
             if type(node) == ast.UnaryOp:
-                if type(node.op) == ast.USub:
-                    # rewrite '-x' as '((-1) * x)', falling through to
-                    # the visit_BinOp_dfs(node) below with the rewritten node:
-                    self.pl('rewriting USub as BinOp.Mult:', node)
-                    node = ast.BinOp(left=ast.Constant(-1),
-                                     op=ast.Mult(),
-                                     right=node.operand)
-                else:
-                    self.pl('not optimizing; unhandled UnaryOp:', node)
-                    self.states[-1].dont_optimize = True
-            if type(node) == ast.BinOp:
+                self.visit_UnaryOp_dfs(node)
+            elif type(node) == ast.Compare:
+                self.visit_Compare_dfs(node)
+            elif type(node) == ast.BoolOp:
+                self.visit_BoolOp_dfs(node)
+            elif type(node) == ast.IfExp:
+                self.visit_IfExp_dfs(node)
+            elif type(node) == ast.BinOp:
                 self.pl('postvisit: visit_BinOp_dfs:',node)
                 node = self.visit_BinOp_dfs(node)
-            elif type(node) == ast.AugAssign and type(node.op) == ast.Add:
-                # TODO we could handle repeated
-                # S += abc...
-                # S += def...
-                # and do s_adds.extend(s2.adds) here. room for improvement :-)
-                if node.target.id in self.local_counters:
-                    node = self.postprocess_augassign(node)
-            elif type(node) in [ast.ListComp, ast.GeneratorExp]:
-                node = self.postprocess_listcomp(node)
+            elif type(node) == ast.AugAssign:
+                self.accumulate(node)
         return node
-    def visit_BinOp_dfs(self, node):
-        if is_add(node):
-            node.adds = []
-            left  = getattr(node.left, 'adds', [node.left])
-            right = getattr(node.right, 'adds', [node.right])
-            node.adds.extend(left)
-            node.adds.extend(right)
-            node.adds = fold_constant_factors(node.adds)
-            self.pl('Add.adds:', node.adds)
+
+    def enter_for(self, node):
+        self.pl('ast.For loop:', ast.unparse(node))
+        p_range, assumptions = None, []
+        if type(node.target) == ast.Name and not node.orelse:
+            p_range = optimizable_range(node.iter, self.facts(),
+                                        self.constants,
+                                        assumptions if self.guard else None)
+        if p_range is None or p_range.mentions(node.target.id):
+            # we can't sum over this loop, and then we can't sum over
+            # the loops enclosing it either:
+            self.fail('unhandled loop:', node.iter)
+            return
+        state = StateMachine([(node.target.id, p_range)],
+                             replacement_target=node,
+                             node_iters=[node.iter],
+                             facts=self.facts())
+        self.enter_guarded(state, node, assumptions)
+
+    def enter_guarded(self, state, node, assumptions):
+        '''pushes the (state) for the loops of (node), collecting what the
+        closed forms will assume with (guard)'''
+        if self.guard:
+            state.assumptions = assumptions
+            bound = {var for s in self.states for var, _ in s.loops} | {
+                n.id for n in ast.walk(node)
+                if type(n) == ast.Name and type(n.ctx) != ast.Load}
+            for operand in int_operands(node, bound):
+                if all(ast.dump(operand) != ast.dump(seen)
+                       for seen in state.int_operands):
+                    state.int_operands.append(operand)
+        self.states.append(state)
+
+    def enter_sum(self, node):
+        '''sum(), math.prod() or reduce(operator.mul, ...) of a comprehension;
+        see reduction_call()'''
+        self.pl('ast.Call:', node.func)
+        sum_args, initial_value, multiplicative, non_empty = reduction_call(node)
+        # sum([ ... ]) or sum(( ... ))
+        # [a for a in range(2) for b in range(3)] has:
+        # len(.generators) == 2
+        # [ (for a in range(2)),  (for b in range(3)) ]
+        # which we sum like the nested loops
+        # for a in range(2):
+        #     for b in range(3):
+        # so the range of (b) may depend on (a), but not the other way around.
+        targets = [generator.target.id for generator in sum_args.generators
+                   if type(generator.target) == ast.Name]
+        loops, assumptions = [], []
+        facts = list(self.facts())
+        for nth, generator in enumerate(sum_args.generators):
+            p_range = None
+            if type(generator.target) == ast.Name and not generator.is_async \
+               and not (generator.ifs and non_empty):
+                p_range = optimizable_range(generator.iter, facts,
+                                            self.constants,
+                                            assumptions if self.guard else None)
+            if p_range is None or any(p_range.mentions(target)
+                                      for target in targets[nth:]):
+                self.fail('unhandled comprehension:', generator)
+                return
+            if non_empty and not provably_nonnegative(
+                    p_range.length() - 1, facts,
+                    assumptions if self.guard else None):
+                self.fail('reduce() of a possibly empty sequence:', generator)
+                return
+            loops.append((generator.target.id, p_range))
+            facts += p_range.facts(generator.target.id)
+        if self.guard and Polynomial.from_ast(initial_value) is None:
+            # the guards would evaluate it again:
+            self.fail('the start value is not a polynomial:', initial_value)
+            return
+        self.enter_guarded(StateMachine(
+            loops,
+            node_iters=[generator.iter for generator in sum_args.generators],
+            replacement_target=node,
+            facts=self.facts(),
+            initial_value=initial_value,
+            multiplicative=multiplicative), node, assumptions)
+        self.pl('sum', 'loop vars:', ', '.join(var for var, _ in loops),
+                'ranges:', *sum_args.generators,
+                'loop_body:', sum_args.elt,
+                'initial_value:', initial_value)
+
+    def accumulate(self, node):
+        '''S += ... or P *= ... in the body of the innermost loop'''
+        if type(node.target) != ast.Name \
+           or type(node.op) not in (ast.Add, ast.Mult):
+            self.fail('unhandled AugAssign:', node)
+            return
+        state = self.states[-1]
+        condition = self.indicator(node)
+        if condition is None:
+            self.fail('unhandled condition for', node)
+            return
+        if type(node.op) == ast.Mult:
+            factors = self.factors(node.value)
+            if factors is None or node.target.id in state.accumulations:
+                self.fail('unhandled product:', node)
+                return
+            # P *= c if the condition holds is P *= c ** [condition]:
+            factors = [(base, exponent * condition)
+                       for base, exponent in factors]
+            state.products.setdefault(node.target.id, []).extend(factors)
+            self.pl('multiply', node.target, factors_str(factors))
+            return
+        poly = Polynomial.from_ast(node.value)
+        addends = [node.value]
+        if poly is None and self.partial:
+            # S += i*i + f(i) becomes S += i*i, which we sum, and S += f(i),
+            # which stays in a loop of its own; see leave_for():
+            split = split_addends(node.value)
+            if split is not None:
+                poly, addends, node.residual = split
+                if node.residual is not None and state.conditions:
+                    self.fail('residual in an if statement:', node)
+                    return
+                if node.residual is not None:
+                    state.residual_counters.add(node.target.id)
+                    self.pl('residual', node.target, node.residual)
+        if poly is None or node.target.id in state.products:
+            self.fail('the expression is not a polynomial:', node.value)
+            return
+        if not poly and addends != [node.value]:
+            return
+        accumulations = state.accumulations
+        accumulations[node.target.id] = accumulations.get(
+            node.target.id, Polynomial()) + poly * condition
+        if any(uses_true_division(addend) for addend in addends):
+            self.states[-1].floats.add(node.target.id)
+        self.pl('accumulate', node.target, poly)
+
+    def factors(self, node):
+        '''product_factors() of the expression (node) in the innermost loop,
+        or None unless all the exponents are provably non-negative: the
+        products of the powers, and their sums over the loops, are ints then.
+        it is enough to check that here, since the exponents of the closed
+        forms are sums of these.'''
+        factors = product_factors(node)
+        if factors is None or not all(provably_nonnegative(
+                exponent, self.facts(), self.assumptions())
+                                      for _, exponent in factors):
+            return None
+        return factors
+
+    def sum_loops(self, state, poly):
+        '''sums (poly) over the loops of (state), from the innermost outwards.
+        returns None if that isn't possible.'''
+        integers = self.state_integers(state)
+        for var, p_range in reversed(state.loops):
+            poly = p_range.sum_over(var, poly, integers)
+            if poly is None:
+                return None
+        return poly
+
+    def multiply_loops(self, state, factors):
+        '''multiplies the (base, exponent) pairs in (factors) over the loops
+        of (state), from the innermost outwards. returns the product as a
+        Polynomial, or None if that isn't possible.'''
+        integers = self.state_integers(state)
+        for var, p_range in reversed(state.loops):
+            factors = p_range.product_over(var, factors, integers)
+            if factors is None:
+                return None
+        product = Polynomial.constant(1)
+        for base, exponent in factors:
+            product *= power_atom(base, exponent, integers)
+        return product
+
+    def state_integers(self, state):
+        '''known_integers() inside the loops of (state)'''
+        integers = self.known_integers() | state.integers
+        integers.update(var for var, _ in state.loops)
+        return integers
+
+    def leave_for(self, node):
+        state = self.states.pop()
+        totals = {}
+        if not state.dont_optimize:
+            totals = self.for_totals(state, node)
+        if not totals:
+            self.fail('inner loop was not rewritten')
             return node
-        elif type(node.op) == ast.Sub:
-            node.adds = []
-            left  = getattr(node.left, 'adds', [node.left])
-            right = ([ast.Constant(-1)]+factors
-                     for factors in getattr(node.right, 'adds', [[node.right]]))
-            node.adds.extend(left)
-            node.adds.extend(right)
-            node.adds = fold_constant_factors(node.adds)
-            self.pl('Sub.adds:', node.adds)
+        integers = frozenset(state.integers)
+        # the counters whose value before the loop we don't know:
+        counters = set()
+        if self.states:
+            # a nested loop: the enclosing loop adds up our totals, but if it
+            # can't be rewritten we still get rid of this loop:
+            replacement = [ast.AugAssign(
+                target=ast.Name(id=name, ctx=ast.Store()), op=op(),
+                value=total.to_ast(integers=integers,
+                                   true_division=name in state.floats))
+                           for name, (op, total) in totals.items()]
+            counters = set(totals)
+        else:
+            replacement = []
+            for name, (op, total) in totals.items():
+                initial_value = self.known_value(node, name)
+                true_division = name in state.floats
+                if initial_value is None:
+                    counters.add(name)
+                    replacement.append(ast.AugAssign(
+                        target=ast.Name(id=name, ctx=ast.Store()), op=op(),
+                        value=total.to_ast(integers=integers,
+                                           true_division=true_division)))
+                else:
+                    if op == ast.Mult:
+                        total = initial_value * total
+                    else:
+                        total = initial_value + total
+                    replacement.append(ast.Assign(
+                        targets=[ast.Name(id=name, ctx=ast.Store())],
+                        value=total.to_ast(
+                            integers=integers, true_division=true_division)))
+        residual = self.residual_loop(node)
+        if residual is not None:
+            replacement.append(residual)
+        if self.math_shadowed and any(map(math_calls, replacement)):
+            self.fail('math is not the math module:', node)
+            return node
+        guarded = self.guarded(state, counters, replacement, node)
+        if guarded is None:
+            self.fail('the closed form can not be guarded:', node)
+            return node
+        if guarded is not replacement:
+            replacement = [guarded]
+        shadowed = self.shadowed_builtins(node, *replacement)
+        if shadowed:
+            self.fail('rebound builtins:', *shadowed)
+            return node
+        if self.states:
+            outer = self.states[-1]
+            condition = self.indicator(node)
+            if condition is None:
+                self.fail('unhandled condition for', node)
+                condition = Polynomial()
+            for name, (op, total) in totals.items():
+                if op == ast.Mult:
+                    outer.products.setdefault(name, []).extend(
+                        (base, exponent * condition)
+                        for base, exponent in monomial_factors(total))
+                else:
+                    outer.accumulations[name] = outer.accumulations.get(
+                        name, Polynomial()) + total * condition
+            outer.integers |= integers
+            outer.floats |= state.floats
+            outer.residual_counters |= state.residual_counters
+            outer.assumptions += state.assumptions
+        for stmt in replacement:
+            ast.fix_missing_locations(ast.copy_location(stmt, node))
+            self.pl('==>', stmt)
+        self.replacements.append((node, replacement))
+        return replacement
+
+    def residual_loop(self, node):
+        '''the loop over what is left of the body of the For loop (node)
+        when the sums have been peeled out of it, or None: the addends of
+        S += ... that aren't polynomials (see accumulate()), and the
+        residual loops nested in it.'''
+        body = []
+        for stmt in node.body:
+            if getattr(stmt, 'guarded', False):
+                # see guarded(): we are guarded by the same tests and more
+                body += [s for s in stmt.body
+                         if getattr(s, 'residual_loop', False)]
+            elif getattr(stmt, 'residual_loop', False):
+                body.append(stmt)
+            elif getattr(stmt, 'residual', None) is not None:
+                body.append(ast.AugAssign(target=stmt.target, op=ast.Add(),
+                                          value=stmt.residual))
+        if not body:
+            return None
+        loop = ast.For(target=node.target, iter=node.iter, body=body,
+                       orelse=[])
+        loop.residual_loop = True
+        return loop
+
+    def for_totals(self, state, node):
+        '''checks that the body of the For loop (node) consists of
+        nothing but S += ... and P *= ... statements, possibly in if
+        statements (after the loops nested in it have been rewritten),
+        and returns
+        {S: (ast.Add, the total added to S), P: (ast.Mult, the product P is
+        multiplied by)} with an entry for each counter.'''
+        stmts = list(node.body)
+        for stmt in stmts:
+            if getattr(stmt, 'guarded', False):
+                # a nested loop we rewrote, with the original in its else:
+                continue
+            if type(stmt) == ast.If:
+                # see indicator()
+                stmts += stmt.body + stmt.orelse
+            elif type(stmt) not in (ast.AugAssign, ast.Pass) \
+                 and not (getattr(stmt, 'residual_loop', False)
+                          and stmt in node.body):
+                self.pl('not optimizing loop body with', stmt)
+                return None
+        # the counters may not be referenced anywhere else in the loop,
+        # and loop variables are not counters:
+        loop_vars = {var for s in self.states + [state] for var, _ in s.loops}
+        counters = state.accumulations.keys() | state.products.keys() \
+            | state.residual_counters
+        for n in walk_unguarded(node):
+            if type(n) == ast.Name and n.id in counters:
+                if n.id in loop_vars or type(n.ctx) != ast.Store:
+                    self.pl('not optimizing because', n.id,
+                            'is an accumulator and that is not supported yet.')
+                    return None
+        totals = {}
+        for name, poly in state.accumulations.items():
+            total = self.sum_loops(state, poly)
+            if total is None:
+                self.pl('could not sum', poly)
+                return None
+            totals[name] = (ast.Add, total)
+        for name, factors in state.products.items():
+            total = self.multiply_loops(state, factors)
+            if total is None:
+                self.pl('could not multiply', factors_str(factors))
+                return None
+            totals[name] = (ast.Mult, total)
+        return totals
+
+    def leave_sum(self, node):
+        state = self.states.pop()
+        comprehension = reduction_call(node)[0]
+        elt = comprehension.elt
+        # the elements are filtered by the if clauses:
+        condition = Polynomial.constant(1)
+        for test in (test for generator in comprehension.generators
+                     for test in generator.ifs):
+            truth = self.truth(test)
+            if truth is None:
+                self.fail('unhandled condition:', test)
+                return node
+            condition *= truth
+        if state.multiplicative:
+            self.states.append(state)
+            factors = self.factors(elt)
+            self.states.pop()
+            if factors is not None:
+                factors = [(base, exponent * condition)
+                           for base, exponent in factors]
+        else:
+            factors = Polynomial.from_ast(elt)
+        addends, residual = [elt], None
+        if factors is None and not state.multiplicative and self.partial:
+            # sum(i*i + f(i) for ...) becomes ... + sum(f(i) for ...)
+            split = split_addends(elt)
+            if split is not None and split[1]:
+                factors, addends, residual = split
+        if factors is not None and not state.multiplicative:
+            factors *= condition
+        if factors is None:
+            self.fail('the expression is not a polynomial:', elt)
+            return node
+        total = None
+        if not state.dont_optimize and state.multiplicative:
+            total = self.multiply_loops(state, factors)
+        elif not state.dont_optimize:
+            total = self.sum_loops(state, factors)
+        if total is None:
+            self.fail('inner sum() was not rewritten')
+            return node
+        integers = frozenset(state.integers)
+        if self.states:
+            self.states[-1].integers |= integers
+        #
+        # Add the initial value of the counter: the 123 in
+        # sum(..., 123), or multiply by it for math.prod(..., start=123)
+        #
+        true_division = any(uses_true_division(addend) for addend in addends)
+        initial_poly = Polynomial.from_ast(state.initial_value)
+        op = state.multiplicative and ast.Mult or ast.Add
+        if initial_poly is None:
+            # sum(..., start=x) with a non-polynomial start value:
+            expr = ast.BinOp(left=state.initial_value, op=op(),
+                             right=total.to_ast(integers=integers,
+                                                true_division=true_division))
+        else:
+            if state.multiplicative:
+                total *= initial_poly
+            else:
+                total += initial_poly
+            expr = total.to_ast(integers=integers, true_division=true_division)
+            expr.poly = total
+        if residual is not None:
+            expr = ast.BinOp(left=expr, op=ast.Add(), right=ast.Call(
+                func=ast.Name(id='sum', ctx=ast.Load()),
+                args=[ast.GeneratorExp(elt=residual,
+                                       generators=comprehension.generators)],
+                keywords=[]))
+        if self.guard and true_division:
+            self.fail('the sums of floats may round differently:', node)
+            return node
+        if self.math_shadowed and math_calls(expr):
+            self.fail('math is not the math module:', node)
+            return node
+        guarded = self.guarded(state, (), expr, node)
+        if guarded is None:
+            self.fail('the closed form can not be guarded:', node)
+            return node
+        expr = guarded
+        shadowed = self.shadowed_builtins(node, expr)
+        if shadowed:
+            self.fail('rebound builtins:', *shadowed)
+            return node
+        if self.states:
+            self.states[-1].assumptions += state.assumptions
+        expr.true_division = true_division
+        self.pl('got a comprehension', node, '===>', expr)
+        self.replacements.append((node, expr))
+        return ast.fix_missing_locations(ast.copy_location(expr, node))
+
+    def visit_UnaryOp_dfs(self, node):
+        operand = Polynomial.from_ast(node.operand)
+        if operand is None:
+            # not a polynomial, and neither is (node): the accumulate() or
+            # leave_sum() that gets to it gives up on the loop
             return node
+        if type(node.op) == ast.USub:
+            # '-x' is '((-1) * x)':
+            node.poly = -operand
+        elif type(node.op) == ast.UAdd:
+            node.poly = operand
+        elif type(node.op) == ast.Not and self.truth(node) is not None:
+            node.poly = self.truth(node)
+            node.condition = True
+        else:
+            self.unhandled('unhandled UnaryOp:', node)
+        return node
+
+    def visit_Compare_dfs(self, node):
+        '''the condition a < b < c is the product of [a < b] and [b < c],
+        each of which is an indicator() of the remainders in a - b, or a
+        threshold_atom() for a loop variable.'''
+        operands = [Polynomial.from_ast(n) for n in [node.left, *node.comparators]]
+        if None in operands:
+            self.pl('not a condition:', node)
+            return
+        poly = Polynomial.constant(1)
+        for op, left, right in zip(node.ops, operands, operands[1:]):
+            condition = self.comparison(op, left - right)
+            if condition is None:
+                self.pl('not a condition:', node)
+                return
+            poly *= condition
+        node.poly = poly
+        node.condition = True
+        self.pl('Compare:', node.poly)
+
+    def comparison(self, op, difference):
+        '''the Polynomial for (difference) (op) 0, or None'''
+        test = COMPARISONS.get(type(op))
+        if test is None:
+            return None
+        poly = None
+        if difference.is_integral():
+            poly = indicator(difference, lambda value: test(value, 0))
+        if poly is not None or type(op) in (ast.Eq, ast.NotEq):
+            return poly
+        # find the innermost loop variable (var) in it, or else an int
+        # variable, and rewrite it as var (op) bound:
+        integers = self.known_integers()
+        loop_vars = [var for state in self.states for var, _ in state.loops]
+        candidates = [var for var in reversed(loop_vars)
+                      if difference.mentions(var)]
+        if not candidates:
+            candidates = sorted(var for var in difference.variables()
+                                if var.isidentifier() and var in integers)
+        if not candidates:
+            return None
+        var = candidates[0]
+        groups = difference.collect(var)
+        u = groups.get(1, Polynomial()).as_int()
+        bound = groups.get(0, Polynomial())
+        if not set(groups) <= {0, 1} or u not in (1, -1) \
+           or bound.mentions(var):
+            return None
+        op = type(op)
+        if u == 1:
+            # var + bound (op) 0
+            bound = -bound
+        else:
+            # bound - var (op) 0
+            op = {ast.Lt: ast.Gt, ast.LtE: ast.GtE,
+                  ast.Gt: ast.Lt, ast.GtE: ast.LtE}[op]
+        if bound.is_integral() and all(integer_variable(v, integers)
+                                       for v in bound.variables()):
+            # var > bound is var >= bound + 1 for ints
+            if op == ast.GtE: return threshold_atom(var, '>=', bound)
+            if op == ast.Gt: return threshold_atom(var, '>=', bound + 1)
+            if op == ast.LtE: return threshold_atom(var, '<', bound + 1)
+            return threshold_atom(var, '<', bound)
+        # the bound may be a float, and the int var is >= 2.5 when it is
+        # >= 3 == math.ceil(2.5), and > 2.5 when it is >= math.floor(2.5) + 1,
+        # which needs math to be the math module, see shadows_math():
+        if self.math_shadowed:
+            return None
+        rounded = {ast.GtE: 'ceil', ast.Lt: 'ceil'}.get(op, 'floor')
+        bound = Polynomial.variable(ast.unparse(ast.Call(
+            func=ast.Attribute(value=ast.Name(id='math', ctx=ast.Load()),
+                               attr=rounded, ctx=ast.Load()),
+            args=[bound.to_ast()], keywords=[])))
+        if op == ast.GtE: return threshold_atom(var, '>=', bound)
+        if op == ast.Gt: return threshold_atom(var, '>=', bound + 1)
+        if op == ast.LtE: return threshold_atom(var, '<', bound + 1)
+        return threshold_atom(var, '<', bound)
+
+    def visit_BoolOp_dfs(self, node):
+        '''a and b is the product of the conditions, when they are
+        conditions; otherwise it is one of the values, see truth()'''
+        if all(getattr(value, 'condition', False) for value in node.values):
+            node.poly = self.truth(node)
+            node.condition = True
+            self.pl('BoolOp:', node.poly)
+
+    def visit_IfExp_dfs(self, node):
+        '''a if c else b is [c] * a + (1 - [c]) * b'''
+        test = self.truth(node.test)
+        body = Polynomial.from_ast(node.body)
+        orelse = Polynomial.from_ast(node.orelse)
+        if test is not None and body is not None and orelse is not None:
+            node.poly = test * body + (1 - test) * orelse
+            self.pl('IfExp:', node.poly)
+
+    def truth(self, node):
+        '''the Polynomial that is 1 where the expression (node) is true and 0
+        where it is false, e.g. for the test of an if statement, or None'''
+        if type(node) == ast.BoolOp:
+            values = [self.truth(value) for value in node.values]
+            if None in values:
+                return None
+            if type(node.op) == ast.And:
+                return reduce(lambda a, b: a * b, values)
+            return 1 - reduce(lambda a, b: a * b, [1 - v for v in values])
+        if type(node) == ast.UnaryOp and type(node.op) == ast.Not:
+            operand = self.truth(node.operand)
+            if operand is None:
+                return None
+            return 1 - operand
+        if getattr(node, 'condition', False):
+            return node.poly
+        poly = Polynomial.from_ast(node)
+        if poly is None or not poly.is_integral():
+            return None
+        return indicator(poly, bool)
+
+    def indicator(self, stmt):
+        '''the truth() of the conditions under which the statement (stmt)
+        in the innermost loop runs, like [i % 2 == 1] for S += i in
+        if i % 2 == 1: S += i
+        or None when they aren't conditions we can handle'''
+        poly, child = Polynomial.constant(1), stmt
+        for if_node in reversed(self.states[-1].conditions):
+            test = self.truth(if_node.test)
+            if test is None:
+                return None
+            if any(child is s for s in if_node.body):
+                poly *= test
+            else:
+                poly *= 1 - test
+            child = if_node
+        return poly
+    def visit_BinOp_dfs(self, node):
+        left = Polynomial.from_ast(node.left)
+        right = Polynomial.from_ast(node.right)
+        if type(node.op) not in (ast.Add, ast.Sub, ast.Mult, ast.Pow,
+                                 ast.Div, ast.FloorDiv, ast.Mod):
+            self.unhandled('better safe than sorry:', type(node.op), node)
+        elif left is None or right is None:
+            # one of the operands is not a polynomial; we leave (node.poly)
+            # unset, so Polynomial.from_ast() returns None for (node) and
+            # accumulate() or leave_sum() gives up on the loop, or with
+            # --partial splits the addend off with split_addends().
+            self.pl('not a polynomial:', node)
+        elif type(node.op) == ast.Add:
+            node.poly = left + right
+            self.pl('Add:', node.poly)
+        elif type(node.op) == ast.Sub:
+            node.poly = left - right
+            self.pl('Sub:', node.poly)
         elif type(node.op) == ast.Mult:
-            left = getattr(node.left, 'adds', [node.left])
-            right = getattr(node.right, 'adds', [node.right])
-            self.pl('mult', left, right)
-            prod = []
-            # here we have the factors with nested lists:
-            # [5; [3;2]]
-            # and we want to flatten them, with the terrible code below:
-            for p in itertools.product(right, left):
-                prod.append([])
-                for t in p:
-                    if type(t) is list: prod[-1] += t
-                    else: prod[-1] += [t]
-            node.adds = fold_constant_factors(prod)
-            self.pl('prod', node.adds)
-        elif type(node.op) == ast.Pow and is_int(node.right):
-            # rewrite [x**y] to [[*([x]*y)]] when y is a constant.
-            self.pl("pow left.adds:", getattr(node.left, 'adds', node.left))
-            prod = []
-            for p in itertools.product(
-                    *([getattr(
-                        node.left,
-                        'adds', [node.left])]*node.right.value)
-            ):
-                # TODO this ends up creating rather many duplicates.
-                prod.append([])
-                for t in p:
-                    t = fold_constant_factors([t])
-                    assert len(t) == 1
-                    t = t[0]
-                    if type(t) is list: prod[-1] += t
-                    else: prod[-1] += [t]
-            node.adds = fold_constant_factors(prod)
-            if not node.adds:
-                node.adds = [ast.Constant(1)] # ^0, identity of multiplication is 1
+            node.poly = left * right
+            self.pl('Mult:', left, right, '=>', node.poly)
+        elif type(node.op) == ast.Pow and is_int(node.right) and node.right.value >= 0:
+            # expand [x**y] when y is a non-negative constant.
+            node.poly = left ** node.right.value
             self.pl("pow left:", node.left,
-                    "right:", node.right, "node.adds:", node.adds)
+                    "right:", node.right, "node.poly:", node.poly)
+        elif type(node.op) == ast.Pow and left.is_integral() \
+             and right.is_integral() \
+             and provably_nonnegative(right, self.facts(), self.assumptions()):
+            # c ** i is a variable that RangeSums.sum_over() can sum
+            # as a geometric series. it is only an int when i >= 0:
+            # 2 ** -1 is 0.5.
+            node.poly = power_atom(left, right)
+            self.pl('Pow:', node.poly)
+        elif type(node.op) == ast.Div and right.as_int():
+            # exact, unlike the float it stands for; see for_totals()
+            node.poly = left * Fraction(1, right.as_int())
+            self.pl('Div:', node.poly)
+        elif type(node.op) in (ast.FloorDiv, ast.Mod) and right.as_int() \
+             and left.is_integral() \
+             and all(integer_variable(var, self.known_integers())
+                     for var in left.variables()):
+            # the remainder is a variable that RangeSums.sum_over() can
+            # sum by splitting the range into residue classes, and
+            # x // c == (x - x % c) / c
+            remainder = mod_atom(left, right.as_int())
+            if type(node.op) == ast.Mod:
+                node.poly = remainder
+            else:
+                node.poly = (left - remainder) * Fraction(1, right.as_int())
+            self.pl(type(node.op).__name__ + ':', node.poly)
         else:
-            self.pl('better safe than sorry, not optimizing because', type(node.op), node)
-            self.states[-1].dont_optimize = True
+            self.unhandled('better safe than sorry:', type(node.op), node)
         return node
 
-def optimizable_range(iterable):
+# sum_over() splits a range into this many residue classes at most to sum
+# x % c and x // c; for symbolic bounds the closed form grows with each one.
+MAX_RESIDUE_CLASSES = 16
+MAX_RESIDUE_CLASSES_CONSTANT = 1024
+
+@lru_cache(maxsize=4096)
+def range_power_sum(begin, end, step, k):
+    '''equivalent to sum(i**k for i in range(begin, end, step)).
+    memoized, since the same ranges tend to show up over and over.
+    stepped ranges are mapped onto a unit-stride sum by substituting
+    i = begin + step*j:
+             k                                  len-1
+     ⅀ i**k = ⅀ comb(k,m) * begin**(k-m) * step**m * ⅀ j**m
+    i        m=0                                  j=0
+    '''
+    if step == 1:
+        end = max(begin, end) # empty ranges
+        if k == 0:
+            return end - begin
+        return power_from_to(k, begin, end)
+    length = len(range(begin, end, step))
+    return sum(math.comb(k, m) * begin**(k-m) * step**m * power_to(m, length)
+               for m in range(k+1))
+
+class RangeSums():
+    '''describes a range(begin, end, step) whose sums of powers
+    ⅀ i**k we can compute. they are computed lazily, when
+    sum_over() asks for them.
+    (begin) and (end) are ints, or Polynomials in the range arguments;
+    in the latter case the power sums are Polynomials too.
+    (step) is always a non-zero int.'''
+    __slots__ = ('begin', 'end', 'step', 'count', 'outer_facts', 'assumptions')
+
+    def __init__(self, begin, end, step=1, facts=(), assumptions=None):
+        self.begin = begin
+        self.end = end
+        self.step = step
+        # for symbolic bounds, (count) is the Polynomial for the number of
+        # elements of the range. (facts) bound the enclosing loop variables,
+        # which may tell us that the range isn't empty; see
+        # provably_nonnegative().
+        self.count = None
+        self.outer_facts = facts
+        # what we may assume rather than refuse; see provably_nonnegative():
+        self.assumptions = assumptions
+        if not self.is_constant():
+            begin, end = Polynomial.of(begin), Polynomial.of(end)
+            length = (end - begin).as_int()
+            if length is not None:
+                self.count = Polynomial.constant(len(range(0, length, step)))
+            elif step != 1:
+                # this is O(1), and never negative:
+                self.count = Polynomial.variable(ast.unparse(ast.Call(
+                    func=ast.Name(id='len', ctx=ast.Load()),
+                    args=[ast.Call(func=ast.Name(id='range', ctx=ast.Load()),
+                                   args=[begin.to_ast(), end.to_ast(),
+                                         ast.Constant(step)],
+                                   keywords=[])],
+                    keywords=[])))
+            elif provably_nonnegative(end - begin, facts):
+                # e.g. range(len(xs)), or range(i) inside 'for i in range(n)'
+                self.count = end - begin
+            else:
+                # range(a, b) is empty when b < a:
+                self.count = Polynomial.variable(ast.unparse(ast.Call(
+                    func=ast.Name(id='max', ctx=ast.Load()),
+                    args=[end.to_ast(), begin.to_ast()], keywords=[]))) - begin
+
+    def __repr__(self):
+        return f'RangeSums({self.begin}, {self.end}, {self.step})'
+
+    def is_constant(self):
+        return type(self.begin) is int and type(self.end) is int
+
+    @property
+    def integers(self):
+        '''the variables that the power sums are integer-valued
+        polynomials of; see Polynomial.to_ast()'''
+        if self.is_constant():
+            return frozenset()
+        return frozenset(Polynomial.of(self.begin).variables()
+                         | Polynomial.of(self.end).variables()
+                         | self.count.variables())
+
+    def mentions(self, name):
+        if self.is_constant():
+            return False
+        return Polynomial.of(self.begin).mentions(name) \
+            or Polynomial.of(self.end).mentions(name)
+
+    def facts(self, var):
+        '''(var, Polynomial) pairs whose Polynomials are non-negative for
+        every (var) in the range; see provably_nonnegative()'''
+        i = Polynomial.variable(var)
+        if self.step > 0:
+            # begin <= i < end
+            return [(var, i - self.begin), (var, self.end - 1 - i)]
+        # begin >= i > end
+        return [(var, self.begin - i), (var, i - self.end - 1)]
+
+    @property
+    def len(self):
+        return self.power_sum(0)
+
+    def sum_over(self, var, poly, integers=frozenset()):
+        '''⅀ poly for (var) in the range.
+        The terms of the polynomial fall in two categories:
+        1) terms referring to constants and/or external variables
+        2) terms whose factors refer to the loop variable
+        Each category 1 term gets the length/span of the loop added as a factor.
+        Category 2 terms var**k get replaced by the sum of var**k over the range.
+        Remainders p(var) % c (see mod_atom()) only depend on var % c, so
+        the range is split into the residue classes, range(begin + step*k,
+        end, step*c) for k < c, and they are constants in each of those.
+        Terms with powers c ** (u*var + w) (see power_atom()) are summed as
+        geometric series; (integers) names the variables known to hold ints.
+        Conditions var >= b and var < b (see threshold_atom()) restrict the
+        range for the terms they are factors of.
+        Returns None if (poly) refers to (var) in other ways, e.g. max(var, 0).
+        '''
+        moduli, thresholds = [], []
+        for name in poly.variables():
+            if name == var or not variable_mentions(name, var) \
+               or parse_geometric(name, var):
+                continue
+            if (parse_threshold(name) or [None])[0] == var:
+                thresholds.append(name)
+                continue
+            mod = parse_mod_atom(name)
+            if mod is None or any(v != var and variable_mentions(v, var)
+                                  for v in mod[0].variables()):
+                return None
+            moduli.append(abs(mod[1]))
+        if moduli:
+            return self.sum_residue_classes(var, poly, math.lcm(*moduli),
+                                            integers)
+        if thresholds:
+            return self.sum_threshold(var, poly, thresholds[0], integers)
+        plain, result = {}, Polynomial()
+        for mono, coeff in poly.terms.items():
+            powers_of_var = [(name, exp) for name, exp in mono
+                             if name != var and variable_mentions(name, var)]
+            if not powers_of_var:
+                plain[mono] = coeff
+                continue
+            # (c ** (u*var + w)) ** e == c ** (u*e*var + w*e)
+            powers, term = [], Polynomial.constant(coeff)
+            for name, exp in mono:
+                if (name, exp) in powers_of_var:
+                    base, u, w = parse_geometric(name, var)
+                    powers.append((base, u * exp, w * exp))
+                elif name != var:
+                    term *= Polynomial.variable(name) ** exp
+            total = self.geometric_sum(dict(mono).get(var, 0), powers, integers)
+            if total is None:
+                return None
+            result += term * total
+        for power, coefficient in Polynomial(plain).collect(var).items():
+            if coefficient.mentions(var):
+                return None
+            result += coefficient * self.power_sum(power)
+        return result
+
+    def product_over(self, var, factors, integers=frozenset()):
+        '''the product of the (base, exponent) pairs in (factors) for (var)
+        in the range, as a list of (base, exponent) pairs, or None.
+        the exponents must be non-negative; see ProductWalker.factors().
+        Π c ** e(var) == c ** ⅀ e(var) for bases c not depending on (var),
+        and a base u*var + a with u*step == ±1 runs through consecutive
+        ints from (lo), so for a constant exponent e:
+        Π (u*var + a) ** e == math.perm(lo + len - 1, len) ** e
+        which is math.factorial(len) ** e when lo == 1. lo must be
+        provably positive, since the product is 0 when it isn't.'''
+        count = self.length()
+        result = []
+        for base, exponent in factors:
+            if not base.mentions(var):
+                total = self.sum_over(var, exponent, integers)
+                if total is None:
+                    return None
+                result.append((base, total))
+                continue
+            groups = base.collect(var)
+            if exponent.mentions(var) or not set(groups) <= {0, 1}:
+                return None
+            u = groups.get(1, Polynomial()).as_int()
+            a = groups.get(0, Polynomial())
+            if not u or abs(u * self.step) != 1 or a.mentions(var) \
+               or not all(integer_variable(v, integers | self.integers)
+                          for v in a.variables()):
+                return None
+            if u * self.step == 1:
+                lo = base.substitute(var, Polynomial.of(self.begin))
+            else:
+                lo = base.substitute(var, Polynomial.of(self.begin)) \
+                    - count + 1
+            if lo.as_int() is not None and count.as_int() is not None:
+                if count.as_int() == 0:
+                    continue
+                if lo.as_int() <= 0:
+                    # range(-3, 4) contains 0, and then so does the product:
+                    if lo.as_int() + count.as_int() <= 0:
+                        return None
+                    result.append((Polynomial.constant(0), exponent))
+                    continue
+            elif not provably_nonnegative(lo - 1, self.outer_facts,
+                                          self.assumptions):
+                return None
+            if lo.as_int() == 1:
+                call, args = 'factorial', [count]
+            else:
+                call, args = 'perm', [lo + count - 1, count]
+            product = Polynomial.variable(ast.unparse(ast.Call(
+                func=ast.Attribute(value=ast.Name(id='math', ctx=ast.Load()),
+                                   attr=call, ctx=ast.Load()),
+                args=[arg.to_ast(integers=integers | self.integers)
+                      for arg in args],
+                keywords=[])))
+            result.append((product, exponent))
+        return result
+
+    def length(self):
+        '''the number of elements, as a Polynomial'''
+        if self.is_constant():
+            return Polynomial.constant(len(range(self.begin, self.end, self.step)))
+        return self.count
+
+    def geometric_sum(self, k, powers, integers=frozenset()):
+        '''the sum of i**k * c**(u*i + w) * ... over the range, for the
+        (c, u, w) triples in (powers), or None.
+        the us must have the same sign. we sum from the element (first)
+        where the exponents are the smallest, in steps of (step) towards
+        the other end of the range, so with i = first + step*j for j < len:
+        ⅀ i**k * c**(u*i + w) = c**(u*first + w) *
+                                  ⅀ comb(k,m) * first**(k-m) * step**m
+                                  m       * ⅀ j**m * (c**(u*step))**j
+                                            j
+        see geometric_power_sum() for the inner sums. the exponents
+        u*first + w must be provably non-negative: 2 ** -1 isn't an int.'''
+        count = self.length()
+        if count.as_int() == 0:
+            return Polynomial()
+        if len({u > 0 for _, u, _ in powers}) != 1:
+            return None
+        first, step = Polynomial.of(self.begin), self.step
+        if (step > 0) != (powers[0][1] > 0):
+            # start from the other end of the range:
+            first += step * (count - 1)
+            step = -step
+        ratio, factor = Polynomial.constant(1), Polynomial.constant(1)
+        for base, u, w in powers:
+            exponent = u * first + w
+            if not provably_nonnegative(exponent, self.outer_facts,
+                                        self.assumptions):
+                return None
+            ratio *= base ** (u * step)
+            factor *= power_atom(base, exponent)
+        return factor * Polynomial.sum_of(
+            math.comb(k, m) * first ** (k - m) * step ** m
+            * geometric_power_sum(m, ratio, count, integers)
+            for m in range(k + 1))
+
+    def sum_threshold(self, var, poly, name, integers=frozenset()):
+        '''see sum_over(); (name) is a threshold_atom() for (var)'''
+        _, op, bound = parse_threshold(name)
+        part = self.restrict(op, bound)
+        if part is None:
+            return None
+        groups = poly.collect(name)
+        outside = groups.pop(0, Polynomial())
+        # the condition is 0 or 1, so it is its own square:
+        inside = sum(groups.values(), Polynomial())
+        total = self.sum_over(var, outside, integers)
+        part_total = part.sum_over(var, inside, integers)
+        if total is None or part_total is None:
+            return None
+        return total + part_total
+
+    def restrict(self, op, bound):
+        '''the RangeSums for the elements i of the range with i >= (bound)
+        or i < (bound), depending on (op); see threshold_atom(). returns None
+        if we can't tell where that is.'''
+        if self.is_constant() and bound.as_int() is not None:
+            elements, bound = range(self.begin, self.end, self.step), bound.as_int()
+            if self.step > 0:
+                # the index of the first element >= bound:
+                k = max(0, -((self.begin - bound) // self.step))
+                part = elements[k:] if op == '>=' else elements[:k]
+            else:
+                # the number of elements >= bound:
+                k = max(0, (self.begin - bound) // -self.step + 1)
+                part = elements[:k] if op == '>=' else elements[k:]
+            return RangeSums(part.start, part.stop, part.step,
+                             self.outer_facts, self.assumptions)
+        if self.step < 0:
+            return None
+        begin, end = Polynomial.of(self.begin), Polynomial.of(self.end)
+        if op == '>=' and provably_nonnegative(begin - bound, self.outer_facts) \
+           or op == '<' and provably_nonnegative(bound - end, self.outer_facts):
+            return self
+        if op == '>=' and provably_nonnegative(bound - end, self.outer_facts) \
+           or op == '<' and provably_nonnegative(begin - bound, self.outer_facts):
+            return RangeSums(0, 0)
+        if op == '>=':
+            start = bound
+            if not provably_nonnegative(bound - begin, self.outer_facts):
+                start = Polynomial.variable(ast.unparse(ast.Call(
+                    func=ast.Name(id='max', ctx=ast.Load()),
+                    args=[bound.to_ast(), begin.to_ast()], keywords=[])))
+            # the first element >= start:
+            begin = start + mod_atom(begin - start, self.step)
+        elif provably_nonnegative(end - bound, self.outer_facts):
+            end = bound
+        else:
+            end = Polynomial.variable(ast.unparse(ast.Call(
+                func=ast.Name(id='min', ctx=ast.Load()),
+                args=[bound.to_ast(), end.to_ast()], keywords=[])))
+        return RangeSums(begin, end, self.step, self.outer_facts,
+                         self.assumptions)
+
+    def sum_residue_classes(self, var, poly, period, integers=frozenset()):
+        '''see sum_over(); (period) is a multiple of each modulus'''
+        if period > (MAX_RESIDUE_CLASSES_CONSTANT if self.is_constant()
+                     else MAX_RESIDUE_CLASSES):
+            return None
+        result = Polynomial()
+        for k in range(period):
+            first = Polynomial.of(self.begin) + self.step * k
+            residue_class = RangeSums(
+                self.begin + self.step * k, self.end, self.step * period)
+            residue_class.outer_facts = self.outer_facts
+            residue_class.assumptions = self.assumptions
+            class_poly = poly
+            for name in poly.variables():
+                mod = parse_mod_atom(name)
+                if mod is not None and variable_mentions(name, var):
+                    remainder = mod_atom(mod[0].substitute(var, first), mod[1])
+                    class_poly = class_poly.substitute(name, remainder)
+            total = residue_class.sum_over(var, class_poly, integers)
+            if total is None:
+                return None
+            result += total
+        return result
+
+    def power_sum(self, k):
+        '''the sum of i**k over the range; for k == 0 that is the length.'''
+        if self.is_constant():
+            return range_power_sum(self.begin, self.end, self.step, k)
+        begin = Polynomial.of(self.begin)
+        if self.step == 1:
+            return (faulhaber_polynomial(k, begin + self.count)
+                    - faulhaber_polynomial(k, begin))
+        # see range_power_sum()
+        return Polynomial.sum_of(math.comb(k, m) * self.step**m * begin**(k-m)
+                                 * faulhaber_polynomial(m, self.count)
+                                 for m in range(k+1))
+
+class SequenceSums():
+    '''like RangeSums, for a loop over a sequence of int constants,
+    like [0, 1, 2, 3] or a module-level constant tuple. the sums of the
+    powers of the loop variable are computed from the (elements) when
+    sum_over() asks for them.'''
+    __slots__ = ('elements', 'outer_facts')
+
+    def __init__(self, elements, facts=()):
+        self.elements = elements
+        self.outer_facts = facts
+
+    def __repr__(self):
+        return f'SequenceSums({self.elements})'
+
+    integers = frozenset()
+
+    def mentions(self, name):
+        return False
+
+    def facts(self, var):
+        '''see RangeSums.facts()'''
+        if not self.elements:
+            return []
+        i = Polynomial.variable(var)
+        return [(var, i - min(self.elements)), (var, max(self.elements) - i)]
+
+    def length(self):
+        return Polynomial.constant(len(self.elements))
+
+    def sum_over(self, var, poly, integers=frozenset()):
+        '''⅀ poly for (var) in the elements: the terms with remainders,
+        powers and conditions of (var) are added up for each element,
+        so there may not be too many of them. returns None if (poly)
+        refers to (var) in other ways.'''
+        plain, special = Polynomial(), Polynomial()
+        for mono, coeff in poly.terms.items():
+            if any(name != var and variable_mentions(name, var)
+                   for name, _ in mono):
+                special.terms[mono] = coeff
+            else:
+                plain.terms[mono] = coeff
+        result = Polynomial.sum_of(
+            coefficient * sum(e ** power for e in self.elements)
+            for power, coefficient in plain.collect(var).items())
+        if not special:
+            return result
+        if len(self.elements) > MAX_RESIDUE_CLASSES_CONSTANT:
+            return None
+        for e in self.elements:
+            term = substitute_value(special, var, e)
+            if term is None:
+                return None
+            result += term
+        return result
+
+    def product_over(self, var, factors, integers=frozenset()):
+        '''see RangeSums.product_over(); the bases that depend on (var) are
+        multiplied element by element'''
+        result = []
+        for base, exponent in factors:
+            if not base.mentions(var):
+                total = self.sum_over(var, exponent, integers)
+                if total is None:
+                    return None
+                result.append((base, total))
+                continue
+            if exponent.mentions(var) \
+               or len(self.elements) > MAX_RESIDUE_CLASSES_CONSTANT:
+                return None
+            for e in self.elements:
+                value = substitute_value(base, var, e)
+                if value is None:
+                    return None
+                result.append((value, exponent))
+        return result
+
+def compare_value(value, op, bound):
+    '''the Polynomial for (value) >= (bound) or (value) < (bound), for an
+    int (value): a constant, or a threshold_atom() for a variable of (bound),
+    or None'''
+    if bound.as_int() is not None:
+        test = op == '>=' and operator.ge or operator.lt
+        return Polynomial.constant(int(test(value, bound.as_int())))
+    for name in sorted(bound.variables()):
+        groups = bound.collect(name)
+        u = groups.get(1, Polynomial()).as_int()
+        rest = groups.get(0, Polynomial())
+        if not name.isidentifier() or not set(groups) <= {0, 1} \
+           or u not in (1, -1):
+            continue
+        # value >= u*name + rest, or value < u*name + rest:
+        if op == '>=' and u == 1:
+            return threshold_atom(name, '<', value - rest + 1)
+        if op == '>=':
+            return threshold_atom(name, '>=', rest - value)
+        if u == 1:
+            return threshold_atom(name, '>=', value + 1 - rest)
+        return threshold_atom(name, '<', rest - value)
+    return None
+
+def substitute_value(poly, var, value):
+    '''(poly) with the loop variable (var) replaced by the int (value),
+    also in the remainders, powers and conditions that mention it; see
+    mod_atom(), power_atom() and threshold_atom(). returns None when
+    (poly) refers to (var) in other ways.'''
+    result = poly.substitute(var, Polynomial.constant(value))
+    for name in result.variables():
+        if not variable_mentions(name, var):
+            continue
+        mod = parse_mod_atom(name)
+        power = parse_power_atom(name)
+        threshold = parse_threshold(name)
+        replacement = None
+        if mod is not None:
+            left = substitute_value(mod[0], var, value)
+            if left is not None:
+                replacement = mod_atom(left, mod[1])
+        elif threshold is not None and threshold[0] != var:
+            bound = substitute_value(threshold[2], var, value)
+            if bound is not None:
+                replacement = threshold_atom(threshold[0], threshold[1], bound)
+        elif threshold is not None:
+            replacement = compare_value(value, threshold[1], threshold[2])
+        elif power is not None:
+            base = substitute_value(power[0], var, value)
+            exponent = substitute_value(power[1], var, value)
+            # 2 ** -1 is a float:
+            if base is not None and exponent is not None \
+               and (exponent.as_int() is None or exponent.as_int() >= 0):
+                replacement = power_atom(base, exponent)
+        if replacement is None:
+            return None
+        result = result.substitute(name, replacement)
+    return result
+
+@lru_cache(maxsize=None)
+def geometric_numerator(m):
+    '''the numerator N of
+    L-1
+     ⅀ j**m * r**j  ==  N / (r - 1)**(m+1)
+    j=0
+    as a Polynomial in r, L and R == r**L, named '#r', '#L' and '#R'.
+    for m == 0 this is the geometric series, N = R - 1, and each further
+    m applies r * d/dr to the sum, where r * dR/dr == L * R:
+    N' = (r * dN/dr + L * R * dN/dR) * (r - 1) - m * r * N
+    '''
+    r, L, R = (Polynomial.variable(name) for name in ('#r', '#L', '#R'))
+    if m == 0:
+        return R - 1
+    N = geometric_numerator(m - 1)
+    return ((r * N.derivative('#r') + L * R * N.derivative('#R')) * (r - 1)
+            - m * r * N)
+
+def geometric_power_sum(m, ratio, count, integers=frozenset()):
+    '''the Polynomial for ⅀ j**m * ratio**j for j < (count), where (ratio)
+    and (count) are Polynomials. For ratio == 1 that is a power sum, and
+    otherwise we divide geometric_numerator() by (ratio - 1)**(m+1).
+    For a symbolic ratio the result is a variable holding the source of
+    the closed form, guarded for ratio == 1:
+    ((x ** n - 1) // (x - 1) if x != 1 else n)
+    the division is exact when (ratio) is an int, and a true division
+    when it isn't, so unless we know that it is, we check.'''
+    numerator = geometric_numerator(m)
+    numerator = numerator.substitute('#L', count).substitute(
+        '#R', power_atom(ratio, count)).substitute('#r', ratio)
+    r = ratio.as_int()
+    if r == 1:
+        return faulhaber_polynomial(m, count)
+    if r is not None:
+        return numerator * Fraction(1, (r - 1) ** (m + 1))
+    quotient = ast.BinOp(left=numerator.to_ast(), op=ast.FloorDiv(),
+                         right=((ratio - 1) ** (m + 1)).to_ast())
+    powers = faulhaber_polynomial(m, count).to_ast(integers=integers)
+    if not all(integer_variable(var, integers) for var in ratio.variables()):
+        # the ratio may be a float, like a discount factor. then the
+        # ratio == 1 case is a float too, so we multiply by the ratio:
+        powers = ast.BinOp(left=powers, op=ast.Mult(), right=ratio.to_ast())
+        quotient = ast.IfExp(
+            test=ast.Call(func=ast.Name(id='isinstance', ctx=ast.Load()),
+                          args=[ratio.to_ast(),
+                                ast.Name(id='int', ctx=ast.Load())],
+                          keywords=[]),
+            body=quotient,
+            orelse=ast.BinOp(left=quotient.left, op=ast.Div(),
+                             right=quotient.right))
+    return Polynomial.variable(ast.unparse(ast.IfExp(
+        test=ast.Compare(left=ratio.to_ast(), ops=[ast.NotEq()],
+                         comparators=[ast.Constant(1)]),
+        body=quotient, orelse=powers)))
+
+def faulhaber_polynomial(k, x):
+    '''power_to(k, x) for a Polynomial (x)'''
+    numerators, denominator = faulhaber(k)
+    acc = Polynomial()
+    for c in reversed(numerators): # Horner's method
+        acc = acc * x + c
+    return acc * Fraction(1, denominator)
+
+@lru_cache(maxsize=None)
+def nonnegative_variable(var):
+    '''whether the Polynomial variable (var) is never negative: lengths,
+    and the max(..., 0) of our closed forms'''
+    if var.startswith('len('):
+        return True
+    if not var.startswith('max('):
+        return False
+    node = var_ast(var)
+    return type(node) == ast.Call and any(
+        is_int(arg) and arg.value >= 0 for arg in node.args)
+
+def provably_nonnegative(poly, facts=(), assumptions=None):
+    '''tries to show that (poly) is never negative. (facts) are
+    (loop variable, Polynomial) pairs, outermost loop first, where each
+    Polynomial is known to be non-negative and bounds the loop variable:
+    i and n - 1 - i for 'for i in range(n)'.
+    The loop variables are eliminated from the innermost outwards by
+    replacing each with its lower or upper bound, whichever can only make
+    (poly) smaller:
+    n - i  >=  n - i - (n - 1 - i)  ==  1
+    What remains must be a non-negative constant plus non-negative
+    multiples of lengths, len(xs) and len(range(..)), and of max(.., 0),
+    which are never negative either.
+    returns False when we can't tell, unless (assumptions) is a list: then
+    we add what remains to it, for a guarded rewrite to check before the
+    loops, and return True.'''
+    for var, _ in reversed(facts):
+        groups = poly.collect(var)
+        if not set(groups) <= {0, 1}:
+            return False
+        coeff = groups.get(1, Polynomial()).as_int()
+        if coeff is None:
+            return False
+        for fact_var, fact in reversed(facts):
+            fact_coeff = fact.collect(var).get(1, Polynomial()).as_int()
+            if fact_var == var and fact_coeff and coeff * fact_coeff > 0:
+                poly = poly - fact * Fraction(coeff, fact_coeff)
+                break
+    constant = poly.terms.get((), 0)
+    if constant >= 0 and all(
+            coeff > 0 and all(nonnegative_variable(var) for var, _ in mono)
+            for mono, coeff in poly.terms.items() if mono):
+        return True
+    if assumptions is not None:
+        assumptions.append(poly)
+        return True
+    return False
+
+def optimizable_range(iterable, facts=(), constants={}, assumptions=None):
     '''Looks for sequential ranges whose length
     we can compute, and/or their sum.
-    Currently only handles constants. TODO.
-    '''
-    if type(iterable) == ast.Call:
-        if type(iterable.func) == ast.Name:
-            if iterable.func.id == 'range':
-                if len(iterable.args) >= 1:
-                    begin = 0
-                    end = 0
-                    length = 0
-                    if is_int(iterable.args[0]):
-                        if len(iterable.args) == 1:
-                            end = iterable.args[0].value
-                            length = iterable.args[0].value
-                        else:
-                            begin = iterable.args[0].value
-                    else:
-                        raise Exception("range(x) for non-constant x: "+str(ast.unparse(iterable)))
-                    if len(iterable.args) == 2:
-                        if is_int(iterable.args[1]):
-                            end = iterable.args[1].value
-                            length = iterable.args[1].value - iterable.args[0].value
-                        else:
-                            # TODO really ough to deal with this case
-                            raise Exception("range(x,y) for non-constant y: "+str(ast.unparse(iterable)))
-                    if len(iterable.args) > 2:
-                        return {}
-                    return {
-                        'len': length,
-                        1: range_from_to(begin, end),
-                        2: square_from_to(begin, end),
-                        3: cube_from_to(begin, end),
-                        4: power_from_to_4(begin, end),
-                        5: power_from_to_5(begin, end),
-                        6: power_from_to_6(begin, end),
-                        7: power_from_to_7(begin, end),
-                        8: power_from_to_8(begin, end),
-                        9: power_from_to_9(begin, end),
-                        10: power_from_to_10(begin, end),
-                        11: power_from_to_11(begin, end),
-                    }
-    return {}
+    Returns a RangeSums, or None if we can't handle (iterable).
+    The range start and stop can be int constants, or polynomials in
+    names, attributes and len() calls (see is_atom()); the step must be
+    a non-zero int constant.
+    Literal lists, tuples and sets of ints, and the names of the
+    module-level (constants) defined before (iterable), return a
+    SequenceSums instead.
+    reversed(range(...)) has the same elements, so the same sums.
+    (facts) bound the loop variables where the range is evaluated,
+    and (assumptions) collects what we assume about them; see
+    provably_nonnegative().
+    '''
+    if type(iterable) == ast.Name and iterable.id in constants \
+       and constants[iterable.id].lineno < iterable.lineno:
+        iterable = constants[iterable.id]
+    if type(iterable) in (ast.List, ast.Tuple, ast.Set):
+        elements = [Polynomial.from_expr(elt) for elt in iterable.elts]
+        if any(elt is None or elt.as_int() is None for elt in elements):
+            return None
+        elements = [elt.as_int() for elt in elements]
+        if type(iterable) == ast.Set:
+            elements = sorted(set(elements))
+        return SequenceSums(elements, facts)
+    if type(iterable) != ast.Call or type(iterable.func) != ast.Name \
+       or iterable.keywords:
+        return None
+    if iterable.func.id == 'reversed' and len(iterable.args) == 1 \
+       and type(iterable.args[0]) != ast.Set:
+        return optimizable_range(iterable.args[0], facts, constants,
+                                 assumptions)
+    if iterable.func.id != 'range' or len(iterable.args) not in (1, 2, 3):
+        return None
+    if len(iterable.args) == 1:
+        begin, end, step = ast.Constant(0), iterable.args[0], 1
+    elif len(iterable.args) == 2:
+        (begin, end), step = iterable.args, 1
+    else:
+        begin, end, step = iterable.args
+        step = Polynomial.from_expr(step)
+        step = step is not None and step.as_int() or None
+        if not step:
+            # symbolic step, or range(a, b, 0) which raises ValueError
+            return None
+    begin = Polynomial.from_expr(begin)
+    end = Polynomial.from_expr(end)
+    if begin is None or end is None:
+        return None
+    if begin.as_int() is not None and end.as_int() is not None:
+        return RangeSums(begin.as_int(), end.as_int(), step, facts,
+                         assumptions)
+    if step == -1:
+        # range(a, b, -1) has the same elements as range(b+1, a+1):
+        return RangeSums(end + 1, begin + 1, 1, facts, assumptions)
+    return RangeSums(begin, end, step, facts, assumptions)
 
 ### examples of patterns to match to identify relevant ast subtrees:
 #
@@ -698,26 +2645,791 @@ def optimizable_range(iterable):
 
 
 
-def optimize(code, filename='filename.py', verbose=True):
+def module_constants(tree):
+    '''the names that are assigned a tuple at the top level of the module
+    (tree), and not bound anywhere else in it, mapped to the ast.Tuple.
+    a loop over one of them is a loop over the same constants every time,
+    see optimizable_range().'''
+    bindings = module_bindings(tree)
+    if '*' in bindings:
+        return {}
+    candidates = {}
+    for stmt in tree.body:
+        if type(stmt) == ast.Assign and len(stmt.targets) == 1 \
+           and type(stmt.targets[0]) == ast.Name \
+           and type(stmt.value) == ast.Tuple:
+            candidates[stmt.targets[0].id] = stmt.value
+    return {name: value for name, value in candidates.items()
+            if bindings[name] == 1}
+
+def bound_names(n):
+    '''the names that the node (n) itself binds; a star import binds '*'.'''
+    if type(n) == ast.Name and type(n.ctx) != ast.Load:
+        return [n.id]
+    if type(n) == ast.arg:
+        return [n.arg]
+    if type(n) in (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef):
+        return [n.name]
+    if type(n) == ast.alias and n.name == '*':
+        return ['*']
+    if type(n) == ast.alias:
+        return [(n.asname or n.name).split('.')[0]]
+    if type(n) in (ast.Global, ast.Nonlocal):
+        return n.names
+    if type(n) in (ast.ExceptHandler, ast.MatchAs, ast.MatchStar, ast.MatchMapping):
+        name = n.rest if type(n) == ast.MatchMapping else n.name
+        return name and [name] or []
+    return []
+
+def module_bindings(tree):
+    '''the number of times each name is bound anywhere in the module
+    (tree), in any scope; see bound_names().'''
+    bindings = {}
+    for n in ast.walk(tree):
+        for name in bound_names(n):
+            bindings[name] = bindings.get(name, 0) + 1
+    return bindings
+
+SCOPES = (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef,
+          ast.Lambda)
+
+def scope_bindings(scope):
+    '''the names bound in (scope), one of SCOPES, leaving out those bound in
+    the scopes nested in it; for a module, with those that its functions
+    declare global'''
+    if type(scope) in (ast.Module, ast.ClassDef):
+        todo = list(scope.body)
+    else:
+        args = scope.args
+        todo = args.posonlyargs + args.args + args.kwonlyargs + [
+            arg for arg in (args.vararg, args.kwarg) if arg is not None]
+        todo += type(scope.body) == list and scope.body or [scope.body]
+    names = set()
+    while todo:
+        n = todo.pop()
+        names.update(bound_names(n))
+        if type(n) not in SCOPES:
+            todo += ast.iter_child_nodes(n)
+    if type(scope) == ast.Module:
+        names.update(name for n in ast.walk(scope) if type(n) == ast.Global
+                     for name in n.names)
+    return names
+
+# the builtins that the loops we rewrite and our closed forms call: where a
+# scope binds any of them, they may not be the builtins; see
+# ProductWalker.shadowed_builtins()
+CLOSED_FORM_BUILTINS = ('float', 'int', 'isinstance', 'len', 'max', 'min',
+                        'range', 'reversed', 'sum')
+# and those of the guards; see ProductWalker.guard_tests():
+GUARD_BUILTINS = ('type',)
+
+def shadows_math(tree, bindings):
+    '''whether the module (tree), with the module_bindings() (bindings),
+    binds the name math to something other than the math module that the
+    math.factorial() and such of our closed forms call: anything but
+    "import math" does, in any scope'''
+    imports = sum(alias.name == 'math' and alias.asname is None
+                  for n in ast.walk(tree) if type(n) == ast.Import
+                  for alias in n.names)
+    return bindings.get('math', 0) > imports
+
+def walk_unguarded(node):
+    '''ast.walk(), without going into the if statements and conditional
+    expressions of guarded rewrites; see ProductWalker.guarded()'''
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        yield node
+        todo += [child for child in ast.iter_child_nodes(node)
+                 if not getattr(child, 'guarded', False)]
+
+def int_operands(node, bound):
+    '''the names and attributes that (node) uses as numbers, other than
+    those whose name is in (bound): what the closed forms of a guarded
+    rewrite need to be ints'''
+    if type(node) == ast.Name:
+        return type(node.ctx) == ast.Load and node.id not in bound \
+            and [node] or []
+    if type(node) == ast.Attribute and is_atom(node):
+        root = node
+        while type(root) == ast.Attribute:
+            root = root.value
+        return root.id not in bound and [node] or []
+    if type(node) == ast.AugAssign:
+        # the target is a counter:
+        return int_operands(node.value, bound)
+    children = list(ast.iter_child_nodes(node))
+    if type(node) == ast.Call:
+        func = dotted_name(node.func)
+        if func in ('reduce', 'functools.reduce'):
+            children = node.args[1:]
+        elif func in ('range', 'reversed', 'sum', 'prod', 'math.prod'):
+            children = node.args + node.keywords
+        else:
+            # len(xs), and the calls that aren't polynomials:
+            return []
+    return [operand for child in children
+            for operand in int_operands(child, bound)]
+
+def math_calls(tree):
+    '''the number of calls in (tree) to the functions in the math module
+    that our closed forms use'''
+    return sum(type(n) == ast.Attribute
+               and n.attr in ('factorial', 'perm', 'ceil', 'floor')
+               and dotted_name(n) == 'math.' + n.attr for n in ast.walk(tree))
+
+def import_math(tree):
+    '''adds "import math" to the module (tree) for the closed forms that
+    need it, after the docstring and __future__ imports, unless it is
+    already imported there. returns its position in (tree.body), or None.'''
+    if any(type(stmt) == ast.Import and ('math', None) in
+           [(alias.name, alias.asname) for alias in stmt.names]
+           for stmt in tree.body):
+        return None
+    position = 0
+    if ast.get_docstring(tree, clean=False) is not None:
+        position = 1
+    while position < len(tree.body) \
+          and type(tree.body[position]) == ast.ImportFrom \
+          and tree.body[position].module == '__future__':
+        position += 1
+    tree.body.insert(position, ast.Import(names=[ast.alias(name='math')]))
+    ast.fix_missing_locations(tree)
+    return position
+
+def rewrite_module(tree, verbose=False, partial=False, guard=False,
+                   rebound=()):
+    '''rewrites the module (tree) in place, returning the ProductWalker with
+    its (replacements), and the position of the "import math" we added to
+    (tree.body) in its (math_import). the module scope is taken to bind the
+    names in (rebound) too.'''
+    before = math_calls(tree)
+    pw = ProductWalker(verbose=verbose, partial=partial, guard=guard,
+                       rebound=rebound)
+    pw.visit(tree)
+    pw.math_import = None
+    if math_calls(tree) > before:
+        pw.math_import = import_math(tree)
+    return pw
+
+def rewrite(tree, verbose=False, partial=False, guard=False):
+    '''rewrites the module (tree) in place, returning the number of loops
+    and sum() calls that were replaced'''
+    return len(rewrite_module(tree, verbose, partial, guard).replacements)
+
+# the replacement of a sum() call goes in parentheses, unless it is an atom
+# or is the whole of a statement's value, an argument or an element:
+ATOMS = (ast.Name, ast.Call, ast.Attribute, ast.Subscript)
+DELIMITED = (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.Return, ast.Expr,
+             ast.keyword, ast.List, ast.Tuple, ast.Set)
+
+def splice(text, tree, pw):
+    '''the source (text) of the module (tree) with the replacements made by
+    ProductWalker (pw) put in place of the code they replace, leaving
+    everything else as it was: comments, blank lines and formatting'''
+    line_ends = list(re.finditer(r'\r\n|\r|\n', text))
+    newline = line_ends and line_ends[0].group() or '\n'
+    starts = [0] + [m.end() for m in line_ends] + [len(text)]
+    def offset(lineno, col_offset):
+        # (col_offset) counts the bytes of the line in UTF-8:
+        line = text[starts[lineno - 1]:starts[lineno]]
+        return starts[lineno - 1] + len(
+            line.encode('utf-8')[:col_offset].decode('utf-8'))
+    parents = {child: parent for parent in ast.walk(tree)
+               for child in ast.iter_child_nodes(parent)}
+    edits = []
+    for node, new in pw.replacements:
+        start = offset(node.lineno, node.col_offset)
+        end = offset(node.end_lineno, node.end_col_offset)
+        if type(new) == list:
+            # a For loop, which starts its line:
+            indent = text[starts[node.lineno - 1]:start]
+            code = '\n'.join(ast.unparse(stmt) for stmt in new)
+            code = (newline + indent).join(code.split('\n'))
+        else:
+            code = ast.unparse(new)
+            parent = parents.get(new)
+            if not (type(new) in ATOMS
+                    or type(new) == ast.Constant
+                    and type(parent) != ast.Attribute
+                    or type(parent) in DELIMITED
+                    or type(parent) == ast.Call and new is not parent.func):
+                code = '(%s)' % code
+        edits.append((start, end, code))
+    if pw.math_import is not None:
+        if pw.math_import + 1 < len(tree.body):
+            stmt = tree.body[pw.math_import + 1]
+            if getattr(stmt, 'decorator_list', None):
+                start = starts[stmt.decorator_list[0].lineno - 1]
+            else:
+                start = offset(stmt.lineno, stmt.col_offset)
+            edits.append((start, start, 'import math' + newline))
+        else:
+            edits.append((len(text), len(text), (
+                text and not text.endswith(('\n', '\r')) and newline or '')
+                          + 'import math' + newline))
+    # the outer loops come after the loops and sum() calls inside them, and
+    # replace them too:
+    pieces, position = [], 0
+    for start, end, code in sorted(edits):
+        if start < position:
+            continue
+        pieces += [text[position:start], code]
+        position = end
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+def rewrite_source(text, filename='filename.py', verbose=False,
+                   partial=False, guard=False):
+    '''the source (text) with the closed forms spliced in, or None when
+    there is nothing to rewrite. with (verbose), the splice is checked
+    against the rewritten tree, which parses the result again.'''
+    tree = ast.parse(text, filename)
+    pw = rewrite_module(tree, verbose=verbose, partial=partial, guard=guard)
+    if not pw.replacements:
+        return None
+    result = splice(text, tree, pw)
+    # the splice has to mean what the rewritten tree means:
+    if verbose and ast.dump(ast.parse(result)) \
+       != ast.dump(ast.parse(ast.unparse(tree))):
+        raise ValueError('the rewrite of %s could not be spliced into the'
+                         ' source' % filename)
+    return result
+
+def source_text(content):
+    '''the text of the source file bytes (content), and its encoding'''
+    encoding = tokenize.detect_encoding(io.BytesIO(content).readline)[0]
+    return content.decode(encoding), encoding
+
+def optimize(code, filename='filename.py', verbose=True, partial=False,
+             guard=False):
     # verbose defaults to True for tests
     tree = ast.parse(code, filename)
-    pw = ProductWalker(verbose=verbose)
-    pw.visit(tree)
+    rewrite(tree, verbose=verbose, partial=partial, guard=guard)
     return tree
 
-def optimize_file(filename, verbose):
-    content = open(filename, 'r').read()
-    original = ast.parse(content)
-    optimized = optimize(content, filename=filename, verbose=verbose)
-    original_str = ast.unparse(original)
-    optimized_str = ast.unparse(optimized)
-    if original_str != optimized_str:
-        uni_diff = difflib.unified_diff(
-            original_str.split('\n'),
-            optimized_str.split('\n'),
-            filename, filename, n=4)
-        for uni_line in uni_diff:
-            print(uni_line)
+class ClosedFormLoader(importlib.machinery.SourceFileLoader):
+    '''loads a module from its source with the closed forms rewritten in,
+    caching the code next to the .pyc of the module, with its own
+    optimization tag so it doesn't mix with the .pyc itself. the cached
+    code is checked against the hash of the source and the tool_version().'''
+    def __init__(self, fullname, path, partial=False, guard=False):
+        super().__init__(fullname, path)
+        self.partial = partial
+        self.guard = guard
+    def source_hash(self, data):
+        return importlib.util.source_hash(
+            tool_version().encode()
+            + repr((self.partial, self.guard)).encode() + data)
+    def get_code(self, fullname):
+        path = self.get_filename(fullname)
+        data = self.get_data(path)
+        # a hash-based .pyc, see PEP 552: the magic number, the flags saying
+        # it's checked against the source hash, the hash, then the code
+        header = importlib.util.MAGIC_NUMBER + (3).to_bytes(4, 'little') \
+            + self.source_hash(data)
+        try:
+            cache_path = importlib.util.cache_from_source(
+                path, optimization='lilsumthing')
+        except NotImplementedError:
+            cache_path = None # sys.implementation.cache_tag is None
+        if cache_path is not None:
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = f.read()
+            except OSError:
+                cached = b''
+            if cached[:len(header)] == header:
+                return marshal.loads(cached[len(header):])
+        tree = ast.parse(data, path)
+        rewrite(tree, partial=self.partial, guard=self.guard)
+        code = compile(tree, path, 'exec', dont_inherit=True)
+        if cache_path is not None and not sys.dont_write_bytecode:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                temporary = '%s.%d' % (cache_path, os.getpid())
+                with open(temporary, 'wb') as f:
+                    f.write(header + marshal.dumps(code))
+                os.replace(temporary, cache_path)
+            except OSError:
+                pass # a read-only tree only costs us the rewrite next time
+        return code
+
+class ClosedFormFinder:
+    '''the sys.meta_path finder of install_import_hook(): the modules whose
+    names match one of the globs (patterns) and which would be loaded from
+    their source are loaded by a ClosedFormLoader instead'''
+    def __init__(self, patterns, partial=False, guard=False):
+        self.patterns = patterns
+        self.partial = partial
+        self.guard = guard
+    def find_spec(self, fullname, path=None, target=None):
+        if not any(fnmatch.fnmatchcase(fullname, pattern)
+                   for pattern in self.patterns):
+            return None
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path)
+        if spec is None \
+           or type(spec.loader) != importlib.machinery.SourceFileLoader:
+            return None
+        spec.loader = ClosedFormLoader(fullname, spec.origin,
+                                       partial=self.partial, guard=self.guard)
+        return spec
+    def invalidate_caches(self):
+        pass
+
+def install_import_hook(*patterns, partial=False, guard=False):
+    '''rewrites the modules whose names match one of the globs (patterns)
+    when they are imported from now on, until uninstall_import_hook() of
+    the finder we return'''
+    finder = ClosedFormFinder(patterns, partial=partial, guard=guard)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+def uninstall_import_hook(finder):
+    sys.meta_path.remove(finder)
+
+@lru_cache(maxsize=None)
+def closed_form_code(source, filename, firstlineno, freevars, partial=False,
+                     guard=False, rebound=()):
+    '''the code of the function defined by (source), starting at line
+    (firstlineno) of (filename), with the closed forms rewritten in; or None
+    when there is nothing to rewrite. the function is compiled inside
+    another one binding its (freevars), so its closure is the same. (rebound)
+    are the builtins that the globals of the function bind, see
+    ProductWalker.shadowed_builtins().'''
+    tree = ast.parse(source, filename)
+    function = tree.body[0]
+    if len(tree.body) != 1 or type(function) not in (
+            ast.FunctionDef, ast.AsyncFunctionDef):
+        return None
+    # it's already decorated, by us and the decorators below us:
+    function.decorator_list = []
+    pw = rewrite_module(tree, partial=partial, guard=guard, rebound=rebound)
+    if not pw.replacements:
+        return None
+    if pw.math_import is not None:
+        # the function runs in the globals of its module, which may not
+        # have the math module as math, so it imports it itself:
+        del tree.body[pw.math_import]
+        position = int(ast.get_docstring(function, clean=False) is not None)
+        function.body.insert(position, ast.copy_location(
+            ast.Import(names=[ast.alias(name='math')]), function.body[0]))
+    if freevars:
+        tree.body = [ast.copy_location(ast.FunctionDef(
+            name='closed_form_closure',
+            args=ast.arguments(posonlyargs=[], args=[
+                ast.arg(arg=name) for name in freevars], kwonlyargs=[],
+                               kw_defaults=[], defaults=[]),
+            body=[function, ast.Return(value=ast.Name(id=function.name,
+                                                      ctx=ast.Load()))],
+            decorator_list=[], returns=None), function)]
+    ast.increment_lineno(ast.fix_missing_locations(tree), firstlineno - 1)
+    code = compile(tree, filename, 'exec', dont_inherit=True)
+    while code.co_name != function.name:
+        code = next(const for const in code.co_consts
+                    if type(const) == types.CodeType)
+    return code
+
+# the arguments verify=True calls the functions with: the ints below, for
+# each of their positional parameters without defaults
+VERIFY_SAMPLES = (-1, 0, 1, 2, 5)
+MAX_VERIFY_CALLS = 125
+
+def outcome(func, args):
+    '''what func(*args) returns, or the type of exception it raises'''
+    try:
+        return 'returns', func(*args)
+    except Exception as e:
+        return 'raises', type(e)
+
+def closed_form(func=None, *, partial=False, guard=False, verify=False,
+                samples=None):
+    '''decorator recompiling (func) with the closed forms of its loops and
+    sum() calls, in its own globals and closure; (func) itself when there
+    is nothing to rewrite, or we can't get its source. with (verify), the
+    rewritten function is called with each of the argument tuples in
+    (samples), by default combinations of VERIFY_SAMPLES, and if it doesn't
+    do what (func) does, we warn and return (func).
+
+        @closed_form(verify=True)
+        def f(n):
+            ...
+    '''
+    if func is None:
+        return functools.partial(closed_form, partial=partial, guard=guard,
+                                 verify=verify, samples=samples)
+    if type(func) != types.FunctionType or hasattr(func, '__wrapped__'):
+        return func
+    try:
+        source = textwrap.dedent(inspect.getsource(func))
+        filename = inspect.getsourcefile(func) or func.__code__.co_filename
+        code = closed_form_code(source, filename,
+                                func.__code__.co_firstlineno,
+                                func.__code__.co_freevars, partial, guard,
+                                frozenset(name for name in CLOSED_FORM_BUILTINS
+                                          + GUARD_BUILTINS
+                                          if name in func.__globals__))
+    except (OSError, TypeError, SyntaxError):
+        return func
+    if code is None or code.co_freevars != func.__code__.co_freevars:
+        return func
+    rewritten = types.FunctionType(code, func.__globals__, func.__name__,
+                                   func.__defaults__, func.__closure__)
+    rewritten.__kwdefaults__ = func.__kwdefaults__
+    functools.update_wrapper(rewritten, func)
+    if verify:
+        if samples is None:
+            parameters = [p for p in inspect.signature(func).parameters.values()
+                          if p.default is p.empty and p.kind in (
+                                  p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+            samples = itertools.islice(itertools.product(
+                VERIFY_SAMPLES, repeat=len(parameters)), MAX_VERIFY_CALLS)
+        for args in samples:
+            if outcome(func, args) != outcome(rewritten, args):
+                warnings.warn('the closed form of %s differs for the'
+                              ' arguments %r, keeping the original' % (
+                                  func.__qualname__, args))
+                return func
+    return rewritten
+
+def diff_lines(text):
+    '''the lines of (text) for difflib: a final newline doesn't start
+    another line'''
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+def file_rewrite(filename, verbose, partial=False, content=None,
+                 guard=False):
+    '''the lines of the unified diff between (filename), which has (content)
+    if we already read it, and its rewrite, with the bytes of the rewrite;
+    or [] and None when there is nothing to rewrite'''
+    if content is None:
+        with open(filename, 'rb') as f:
+            content = f.read()
+    text, encoding = source_text(content)
+    rewritten = rewrite_source(text, filename=filename, verbose=verbose,
+                               partial=partial, guard=guard)
+    if rewritten is None or rewritten == text:
+        return [], None
+    return list(difflib.unified_diff(
+        diff_lines(text), diff_lines(rewritten), filename, filename, n=4,
+        lineterm='')), rewritten.encode(encoding)
+
+def write_source(filename, content):
+    '''replaces the file (filename) with (content) at once, through a file
+    next to it, so that it is never left half written'''
+    path = os.path.realpath(filename)
+    temporary = '%s.%d' % (path, os.getpid())
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(content)
+        shutil.copymode(path, temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def file_diff(filename, verbose, partial=False, content=None, write=False,
+              guard=False):
+    '''the lines of file_rewrite()'s diff; with (write), the rewrite is
+    written to (filename).'''
+    lines, rewritten = file_rewrite(filename, verbose, partial, content, guard)
+    if write and rewritten is not None:
+        write_source(filename, rewritten)
+    return lines
+
+@lru_cache(maxsize=None)
+def tool_version():
+    '''the hash of our own source: a cached diff is only good for the
+    version of lilsumthing that made it'''
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class DiffCache:
+    '''the diffs of file_diff() on disk in (directory), keyed by the hash of
+    the file content, the tool_version() and the options. an empty diff
+    marks a file with nothing to rewrite.'''
+    def __init__(self, directory, partial=False, guard=False):
+        self.directory = directory
+        self.partial = partial
+        self.guard = guard
+    def key(self, content):
+        h = hashlib.sha256(tool_version().encode())
+        h.update(repr((self.partial, self.guard)).encode())
+        h.update(content)
+        return h.hexdigest()
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+    def get(self, key, filename):
+        '''the diff for (filename) if we have it, otherwise None'''
+        try:
+            with open(self.path(key), 'r') as f:
+                hunks = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not hunks:
+            return []
+        # the headers name the file, and the same content can have another
+        # name, so only the hunks are stored:
+        return ['--- %s' % filename, '+++ %s' % filename] + hunks
+    def put(self, key, lines):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # other runs can look at it while we write it:
+        temporary = '%s.%d' % (path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(lines[2:], f)
+        os.replace(temporary, path)
+
+def default_cache_directory():
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'lilsumthing')
+
+def optimize_file(filename, verbose, partial=False, guard=False):
+    for uni_line in file_diff(filename, verbose, partial, guard=guard):
+        print(uni_line)
+
+class FileTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    raise FileTimeout()
+
+def file_job(filename, verbose, partial, timeout=None, content=None,
+             write=False, guard=False):
+    '''file_diff() for the process pool of optimize_files(): returns
+    (diff lines, None), or (None, error message) instead of raising, and
+    gives up on the file after (timeout) seconds, so a pathological file
+    doesn't hold on to its worker. the timeout is over before (write)
+    writes the file.'''
+    if timeout:
+        previous = signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        try:
+            lines, rewritten = file_rewrite(filename, verbose, partial,
+                                            content, guard)
+        finally:
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+        if write and rewritten is not None:
+            write_source(filename, rewritten)
+        return lines, None
+    except FileTimeout:
+        return None, 'gave up after %g seconds' % timeout
+    except (OSError, SyntaxError, ValueError, RecursionError) as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+# every loop we rewrite adds up with += or *=, and every comprehension is
+# the argument of sum(), prod() or reduce(); a file without either is
+# skipped before it's even parsed. this also matches comments and strings,
+# which is fine: they only cost us a parse.
+REDUCTION_CALL = re.compile(rb'\b(?:sum|prod|reduce)\s*\(')
+FOR_LOOP = re.compile(rb'\bfor\b')
+ACCUMULATION = re.compile(rb'[+*]=')
+
+def worth_parsing(content):
+    '''whether the source bytes (content) may have something to rewrite'''
+    return bool(REDUCTION_CALL.search(content)
+                or FOR_LOOP.search(content) and ACCUMULATION.search(content))
+
+def gitignore_regex(pattern):
+    '''the regex for a .gitignore (pattern), without its leading and
+    trailing slashes: * and ? don't match /, and ** matches any number of
+    directories'''
+    regex, i = [], 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            regex.append('[%s]' % chars.replace('\\', '\\\\'))
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile(''.join(regex))
+
+@lru_cache(maxsize=None)
+def gitignore_rules(directory):
+    '''the patterns of the .gitignore in (directory), as tuples of
+    (directory, regex, negated, only directories, anchored); patterns with
+    a slash other than at the end are relative to (directory), the others
+    match a name at any depth below it'''
+    rules = []
+    try:
+        with open(os.path.join(directory, '.gitignore'), 'r') as f:
+            lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return ()
+    for line in lines:
+        line = line.rstrip(' ')
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        if negated or line.startswith('\\'):
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        anchored = '/' in line
+        if line:
+            rules.append((directory, gitignore_regex(line.lstrip('/')),
+                          negated, dir_only, anchored))
+    return tuple(rules)
+
+def outer_gitignore_rules(directory):
+    '''the .gitignore rules from the directories above (directory), up to
+    the top of its git work tree'''
+    directory = os.path.abspath(directory)
+    parents = []
+    while not os.path.exists(os.path.join(directory, '.git')):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return () # not in a git work tree
+        directory = parent
+        parents.append(directory)
+    return tuple(rule for parent in reversed(parents)
+                 for rule in gitignore_rules(parent))
+
+def ignored(path, is_dir, rules):
+    '''whether the last of the .gitignore (rules) matching (path) ignores
+    it'''
+    result = False
+    for directory, regex, negated, dir_only, anchored in rules:
+        if dir_only and not is_dir:
+            continue
+        relative = os.path.relpath(path, directory).replace(os.sep, '/')
+        if relative.startswith('../'):
+            continue
+        if regex.fullmatch(anchored and relative or os.path.basename(path)):
+            result = not negated
+    return result
+
+DEFAULT_EXCLUDES = ('.git', '.hg', '.svn', '__pycache__')
+
+def python_files(paths, excludes=DEFAULT_EXCLUDES, gitignore=True):
+    '''yields the files in (paths), and the .py files in the directories
+    in (paths) and below them, in sorted order. those whose path relative
+    to the directory, or whose name, matches one of the globs (excludes)
+    are skipped, and so are the files ignored by .gitignore files when
+    (gitignore) is true.'''
+    def scan(directory, root, rules):
+        if gitignore:
+            rules = rules + gitignore_rules(directory)
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError:
+            return
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            relative = os.path.relpath(entry.path, root).replace(os.sep, '/')
+            if any(fnmatch.fnmatch(relative, glob)
+                   or fnmatch.fnmatch(entry.name, glob) for glob in excludes) \
+               or ignored(entry.path, is_dir, rules):
+                continue
+            if is_dir:
+                yield from scan(entry.path, root, rules)
+            elif entry.name.endswith('.py') and entry.is_file():
+                yield entry.path
+    for path in paths:
+        if os.path.isdir(path):
+            yield from scan(path, path, gitignore
+                            and outer_gitignore_rules(path) or ())
+        else:
+            yield path
+
+def optimize_files(filenames, verbose=False, partial=False, jobs=1,
+                   timeout=None, progress=None, cache=None, write=False,
+                   guard=False):
+    '''yields (filename, diff lines, error) for each of (filenames), in
+    order. with (jobs) > 1 the files are rewritten by a pool of that many
+    processes; results that finish early are held back until the files
+    before them are done. (progress)(done, total, filename) is called as
+    each file finishes. the files that aren't worth_parsing(), and those
+    whose content is in the DiffCache (cache), are not parsed at all.
+    with (write), the rewritten files are written.'''
+    filenames = list(filenames)
+    finished, keys, contents = {}, {}, {}
+    for position, filename in enumerate(filenames):
+        try:
+            with open(filename, 'rb') as f:
+                contents[position] = f.read()
+        except OSError:
+            continue # file_job() reports it
+        if not worth_parsing(contents[position]):
+            finished[position] = [], None
+            del contents[position]
+            continue
+        if cache is None:
+            continue
+        keys[position] = cache.key(contents[position])
+        lines = cache.get(keys[position], filename)
+        # the cache only has the diff, and we need the rewrite to write it:
+        if lines is not None and not (write and lines):
+            finished[position] = lines, None
+            del keys[position]
+    done, next_position = 0, 0
+    def results(position, result):
+        '''the results up to (position) that are ready, in order'''
+        nonlocal done, next_position
+        finished[position] = result
+        lines, error = result
+        if position in keys and error is None:
+            cache.put(keys.pop(position), lines)
+        done += 1
+        if progress:
+            progress(done, len(filenames), filenames[position])
+        while next_position in finished:
+            yield (filenames[next_position], *finished.pop(next_position))
+            next_position += 1
+    todo = [position for position in range(len(filenames))
+            if position not in finished]
+    for position, result in list(finished.items()):
+        yield from results(position, result)
+    if jobs == 1 or len(todo) < 2:
+        for position in todo:
+            yield from results(position, file_job(
+                filenames[position], verbose, partial, timeout,
+                contents.pop(position, None), write, guard))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(file_job, filenames[position], verbose,
+                               partial, timeout, contents.pop(position, None),
+                               write, guard):
+                   position for position in todo}
+        for future in concurrent.futures.as_completed(futures):
+            yield from results(futures[future], future.result())
+
+def print_progress(done, total, filename):
+    print('[%d/%d] %s' % (done, total, filename), file=sys.stderr, flush=True)
+
+def job_count(text):
+    '''the argparse type of --jobs: an int >= 0, 0 being one per CPU'''
+    jobs = int(text)
+    if jobs < 0:
+        raise argparse.ArgumentTypeError('%r is not >= 0' % text)
+    return jobs
 
 if '__main__' == __name__:
     aparser = argparse.ArgumentParser(
@@ -725,8 +3437,55 @@ if '__main__' == __name__:
         description='Try to rewrite for-loop based summations'
         ' to use closed-form expressions',)
     aparser.add_argument('-v', '--verbose', action='store_true', default=False)
+    aparser.add_argument('-p', '--partial', action='store_true', default=False,
+                         help='rewrite the polynomial part of loops that'
+                         ' also add up other things, keeping a loop for those')
+    aparser.add_argument('-g', '--guard', action='store_true', default=False,
+                         help='check that the closed forms hold when they'
+                         ' run, keeping the original loops for when they'
+                         " don't")
+    aparser.add_argument('-w', '--write', action='store_true', default=False,
+                         help='rewrite the files in place')
+    aparser.add_argument('-j', '--jobs', type=job_count, default=1, metavar='N',
+                         help='rewrite files in N processes'
+                         ' (0: one per CPU)')
+    aparser.add_argument('-t', '--timeout', type=float, default=None,
+                         metavar='SECONDS',
+                         help='give up on a file after SECONDS')
+    aparser.add_argument('--cache-dir', metavar='DIR',
+                         default=default_cache_directory(),
+                         help='where to keep the diffs of files by content,'
+                         ' so unchanged files are not rewritten again'
+                         ' (default: %(default)s)')
+    aparser.add_argument('--no-cache', action='store_true', default=False,
+                         help='rewrite every file, without the cache')
+    aparser.add_argument('-x', '--exclude', metavar='GLOB', action='append',
+                         default=list(DEFAULT_EXCLUDES),
+                         help='skip the files and directories below the'
+                         ' directory arguments whose name or relative path'
+                         ' matches GLOB (default: %s)' % ' '.join(
+                             DEFAULT_EXCLUDES))
+    aparser.add_argument('--no-gitignore', action='store_true', default=False,
+                         help="don't skip the files ignored by .gitignore")
     aparser.add_argument('filenames', metavar='FILE', nargs='+',
-                         help='python module files to examine')
+                         help='python module files to examine, or'
+                         ' directories to look for them in')
     args = aparser.parse_args()
-    for filename in args.filenames:
-        optimize_file(filename, verbose=args.verbose)
+    jobs = args.jobs or os.cpu_count() or 1
+    failed = False
+    for filename, lines, error in optimize_files(
+            python_files(args.filenames, excludes=args.exclude,
+                         gitignore=not args.no_gitignore),
+            verbose=args.verbose, partial=args.partial,
+            jobs=jobs, timeout=args.timeout,
+            progress=jobs > 1 and print_progress or None,
+            cache=not args.no_cache and DiffCache(
+                args.cache_dir, partial=args.partial, guard=args.guard) or None,
+            write=args.write, guard=args.guard):
+        if error:
+            print('%s: %s' % (filename, error), file=sys.stderr)
+            failed = True
+            continue
+        for uni_line in lines:
+            print(uni_line, flush=True)
+    sys.exit(failed)
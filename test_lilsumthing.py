@@ -1,5 +1,9 @@
 import lilsumthing
 import ast
+import math
+import os
+import sys
+import pytest
 
 def test_constant_folding_0():
     #assert all(a.value == a.value for (a,b) in
@@ -665,18 +669,25 @@ for i in range(1000000):
     unparsed = ast.unparse(o)
     assert unparsed == 'S = 0\nS = -1500000999995500002000000'
 
+def assert_equivalent(orig_src, optimized, envs, result='S'):
+    '''runs the original and the optimized code with each of the dicts in
+    (envs) as globals, comparing the resulting values of (result)'''
+    for env in envs:
+        expected, actual = dict(env), dict(env)
+        exec(orig_src, expected)
+        exec(optimized, actual)
+        assert expected[result] == actual[result], (env, optimized)
+
 def test_variable_range():
     orig_src = '''
 S = 0
 for i in range(a,b):
     S += i'''
-    try:
-        o = lilsumthing.optimize(orig_src)
-    except Exception as e:
-        assert str(e) == 'range(x) for non-constant x: range(a, b)'
-        return
+    o = lilsumthing.optimize(orig_src)
     unparsed = ast.unparse(o)
-    assert unparsed == 'S = 0\nS += b*(b+1)//2 - a*(a+1)//2'
+    assert unparsed == 'S = 0\nS = (a - max(b, a) - a ** 2 + max(b, a) ** 2) // 2', unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'a': a, 'b': b} for a in range(-5, 5) for b in range(-5, 8)])
 
 def test_sum_expr_0():
     '''
@@ -743,3 +754,1648 @@ def test_sum_expr_4_generator():
 def test_range_equiv():
     '''∀x, x>=0: range_from(x) == range_from_to(0, x)'''
     pass
+
+def test_polynomial_0():
+    from lilsumthing import Polynomial
+    i, n = Polynomial.variable('i'), Polynomial.variable('n')
+    assert (i + 1) * (i - 1) == i*i - 1
+    assert (i + n) ** 2 == i*i + 2*i*n + n*n
+    assert (i + n) ** 0 == 1
+    assert i - i == 0
+    assert not (i - i)
+    assert -(i*3) == i*(-3)
+    assert (i*i*n + 3*i + 5).collect('i') == {2: n, 1: 3, 0: 5}
+    assert Polynomial.sum_of([i, n, 2, -i, n * 3]) == n * 4 + 2
+    assert Polynomial.sum_of(i * k for k in range(1000)) == i * 499500
+
+def test_polynomial_to_ast():
+    from lilsumthing import Polynomial
+    n = Polynomial.variable('n')
+    assert ast.unparse(Polynomial().to_ast()) == '0'
+    assert ast.unparse((7 + n*5 - n*n*3).to_ast()) == '7 + n * 5 - n ** 2 * 3'
+    assert ast.unparse((-n).to_ast()) == '-n'
+    assert ast.unparse((n*-2 + n*n).to_ast()) == 'n * -2 + n ** 2'
+
+def test_sum5_powers():
+    orig_src = '''
+S = 0
+for i in range(1000):
+    S += n * (n*5 - 2 * i * n) ** 3 - n * (i * 7 * n - 10*n) ** 2
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = n ** 3 * -16239011500 - n ** 4 * 1976106790000', unparsed
+
+def test_negative_power():
+    '''i**-1 is not a polynomial'''
+    orig_src = '''
+S = 0
+for i in range(1, 4):
+    S += i ** -1
+'''
+    o = lilsumthing.optimize(orig_src)
+    assert ast.unparse(o) == ast.unparse(ast.parse(orig_src))
+
+def test_sum_expr_5_keyword_start():
+    orig_src = '''sum((i for i in range(10)), start=x)'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == '45 + x', unparsed
+
+def test_pow_expansion_0():
+    from lilsumthing import Polynomial
+    i, n, m = (Polynomial.variable(x) for x in 'inm')
+    assert (i*n*3) ** 3 == i**3 * n**3 * 27
+    assert (i - 1) ** 3 == i*i*i - 3*i*i + 3*i - 1
+    assert (i + n + m) ** 2 == i*i + n*n + m*m + 2*i*n + 2*i*m + 2*n*m
+    base = i + n*2 + m - 3
+    expected = Polynomial.constant(1)
+    for _ in range(7):
+        expected = expected * base
+    assert base ** 7 == expected
+
+def test_pow_expansion_1():
+    '''the number of terms in (1+i+n+m+k)**16 is comb(20,4) == 4845,
+    which we should be able to produce without visiting 5**16 products.'''
+    from lilsumthing import Polynomial
+    i, n, m, k = (Polynomial.variable(x) for x in 'inmk')
+    assert len(((1 + i + n + m + k) ** 16).terms) == 4845
+
+def test_pow_expansion_2():
+    '''README example 6, with a third addend in the base'''
+    orig_src = '''
+S = 0
+for i in range(1000):
+    S += (2 + i*n + m)**9 * (n - i + 3)**2
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src, verbose=False))
+    assert unparsed.startswith('S = 0\nS = '), unparsed
+    n, m = 3, -2
+    expected = sum((2 + i*n + m)**9 * (n - i + 3)**2 for i in range(1000))
+    assert eval(unparsed.split('S = ')[-1]) == expected
+
+def test_faulhaber_fast_path():
+    '''the hand-written formulas must agree with Faulhaber's formula'''
+    for k, power_from_to_k in lilsumthing.POWER_FROM_TO.items():
+        for f in range(-10, 20):
+            for t in range(f, 30):
+                assert power_from_to_k(f, t) == \
+                    lilsumthing.power_to(k, t) - lilsumthing.power_to(k, f), (k, f, t)
+
+def test_faulhaber_0():
+    for k in range(0, 30):
+        assert lilsumthing.power_from_to(k, -3, 17) == sum(i**k for i in range(-3, 17)), k
+
+def test_factors15():
+    '''>>> sum([i**12 for i in range(1,50)])
+    821811325571313280665
+    '''
+    orig_src = '''
+S = 0
+for i in range(1,50):
+  S += i**12
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = 821811325571313280665', unparsed.replace('\n', ';')
+
+def test_factors16():
+    orig_src = '''
+S = 0
+for i in range(10000000):
+  S += i**40 * n + 3*i**17
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    expected = (lilsumthing.power_to(17, 10000000) * 3,
+                lilsumthing.power_to(40, 10000000))
+    assert unparsed == 'S = 0\nS = %d + n * %d' % expected, unparsed.replace('\n', ';')
+
+def test_range_sums_lazy():
+    '''only the power sums the loop body needs are computed, and they are
+    cached across loops over the same range'''
+    lilsumthing.range_power_sum.cache_clear()
+    lilsumthing.optimize('''
+S = 0
+for i in range(3, 50000000):
+  S += 5
+''')
+    assert lilsumthing.range_power_sum.cache_info().currsize == 1
+    o = lilsumthing.optimize('''
+T = 0
+for j in range(3, 50000000):
+  T += 5 + j*j
+''')
+    assert ast.unparse(o) == 'T = 0\nT = 41666665416666924999980'
+    info = lilsumthing.range_power_sum.cache_info()
+    assert (info.hits, info.currsize) == (1, 2)
+
+def test_variable_range_1():
+    orig_src = '''
+S = 0
+for i in range(n):
+    S += i*i*x + 3
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'x': x} for n in range(-3, 12) for x in (1, 7, 0.5)])
+
+def test_variable_range_2():
+    '''the length of range(n, n+5) does not depend on n'''
+    orig_src = '''
+S = 0
+for i in range(n, n+5):
+    S += i*x
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = x * 10 + n * x * 5', unparsed
+
+def test_variable_range_3():
+    orig_src = '''
+S = 3
+for i in range(len(xs)):
+    S += i**13 + i*n
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'max' not in unparsed and 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'xs': [0]*k, 'n': 3} for k in range(10)])
+
+def test_variable_range_4():
+    orig_src = '''S = sum(i*n for i in range(n+1, 2*m))'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'm': m} for n in range(-4, 6) for m in range(-4, 9)])
+
+def test_variable_range_5():
+    '''range(f(x)) might have side effects'''
+    orig_src = '''
+S = 0
+for i in range(f(x)):
+    S += i
+'''
+    o = lilsumthing.optimize(orig_src)
+    assert ast.unparse(o) == ast.unparse(ast.parse(orig_src))
+
+def test_empty_range():
+    orig_src = '''
+S = 0
+for i in range(10, 5):
+    S += i*i + 1
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = 0', unparsed
+
+def test_stepped_range_0():
+    for r in ['0, 100, 2', '1, 100, 7', '99, -1, -1', '50, -50, -3', '5, 10, -1', '-7, 30, 4']:
+        orig_src = f'''
+S = 0
+for i in range({r}):
+    S += i**3 - 2*i + 5
+'''
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed, [{}])
+
+def test_stepped_range_1():
+    '''>>> sum(i for i in range(0, 20, 2))
+    90
+    '''
+    orig_src = '''S = sum(i*x for i in reversed(range(0, 20, 2)))'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = x * 90', unparsed
+
+def test_stepped_range_2():
+    '''range(N-1, -1, -1) is range(N) backwards'''
+    orig_src = '''
+S = 0
+for i in range(N-1, -1, -1):
+    S += i*i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = (max(N, 0) - max(N, 0) ** 2 * 3 + max(N, 0) ** 3 * 2) // 6', unparsed
+    assert_equivalent(orig_src, unparsed, [{'N': n} for n in range(-3, 10)])
+
+def test_stepped_range_3():
+    for r in ['a, b, 3', 'b, a, -2', 'a, 2*b, 5', 'a, b, -1']:
+        orig_src = f'''
+S = 0
+for i in range({r}):
+    S += i*i*x + i
+'''
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'a': a, 'b': b, 'x': 3} for a in range(-7, 7) for b in range(-7, 9)])
+
+def test_stepped_range_4():
+    '''symbolic and zero steps are left alone'''
+    for r in ['0, 10, k', '0, 10, 0']:
+        orig_src = f'''
+S = 0
+for i in range({r}):
+    S += i
+'''
+        o = lilsumthing.optimize(orig_src)
+        assert ast.unparse(o) == ast.unparse(ast.parse(orig_src))
+
+def test_nested_0():
+    '''>>> sum(j for i in range(3) for j in range(4))
+    18
+    '''
+    orig_src = '''
+S = 0
+for i in range(3):
+    for j in range(4):
+        S += j
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = 18', unparsed
+
+def test_nested_1():
+    orig_src = '''
+S = 0
+for x in range(W):
+    for y in range(H):
+        S += x*y + x*x*c - 2*y + 1
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'W': w, 'H': h, 'c': 3} for w in range(-2, 7) for h in range(-2, 7)])
+
+def test_nested_2():
+    '''three levels, with a statement between the loops'''
+    orig_src = '''
+S = 5
+for x in range(1, 20, 3):
+    S += x
+    for y in range(H):
+        for z in range(-3, 4):
+            S += x*y*z*z + z
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed, [{'H': h} for h in range(-2, 7)])
+
+def test_nested_3():
+    '''the inner loop is rewritten even if the outer loop can't be'''
+    orig_src = '''
+S = 0
+for i in xs:
+    for j in range(4):
+        S += j * i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nfor i in xs:\n    S += i * 6', unparsed
+
+def test_nested_4():
+    '''neither loop may be rewritten as S = ... when the inner loop body
+    refers to S'''
+    orig_src = '''
+S = 0
+for i in range(3):
+    for j in range(4):
+        S += S + j
+'''
+    o = lilsumthing.optimize(orig_src)
+    assert ast.unparse(o) == ast.unparse(ast.parse(orig_src))
+
+def test_loop_body_0():
+    '''the loop body does more than summing'''
+    orig_src = '''
+S = 0
+for i in range(10):
+    S += i
+    print(i)
+'''
+    o = lilsumthing.optimize(orig_src)
+    assert ast.unparse(o) == ast.unparse(ast.parse(orig_src))
+
+def test_loop_body_1():
+    '''i.real is not loop-invariant'''
+    orig_src = '''
+S = 0
+for i in range(10):
+    S += i.real
+'''
+    o = lilsumthing.optimize(orig_src)
+    assert ast.unparse(o) == ast.unparse(ast.parse(orig_src))
+
+def test_initial_value_0():
+    '''we can only use the initial value when nothing happens to S in between'''
+    orig_src = '''
+S = 0
+S = f(S)
+b = 10
+for i in range(10):
+    S += i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = f(S)\nb = 10\nS += 45', unparsed
+    orig_src = '''
+S = 0
+b = 10
+for i in range(10):
+    S += i + b
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nb = 10\nS = 45 + b * 10', unparsed
+
+def test_nested_sum_expr():
+    orig_src = '''
+S = 0
+for i in range(3):
+    S += sum(j*i for j in range(n))
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 7)])
+
+def test_triangular_0():
+    orig_src = '''
+S = 0
+for i in range(n):
+    for j in range(i):
+        S += 1
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 9)])
+
+def test_triangular_1():
+    '''j starts after i'''
+    orig_src = '''
+S = 0
+for i in range(n):
+    for j in range(i+1, n):
+        S += i*j
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 9)])
+
+def test_triangular_2():
+    '''three levels deep, and through sum()'''
+    for orig_src in ('''
+S = 0
+for i in range(1, n+1):
+    for j in range(1, i+1):
+        for k in range(j):
+            S += i*k
+''', '''
+S = sum(sum(j for j in range(i)) for i in range(n))
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n} for n in range(-2, 9)])
+
+def test_triangular_3():
+    '''we can't tell whether i < m, so only the inner loop goes'''
+    orig_src = '''
+S = 0
+for i in range(n):
+    for j in range(i, m):
+        S += j
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed.count('for') == 1, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'm': m}
+                       for n in range(-2, 6) for m in range(-2, 6)])
+
+def test_provably_nonnegative():
+    n, i, j = (lilsumthing.Polynomial.variable(x) for x in 'nij')
+    facts = [('i', i), ('i', n - 1 - i), ('j', j), ('j', i - 1 - j)]
+    assert lilsumthing.provably_nonnegative(n - i, facts)
+    assert lilsumthing.provably_nonnegative(n - 2 - j, facts)
+    assert not lilsumthing.provably_nonnegative(n - 3 - j, facts)
+    assert not lilsumthing.provably_nonnegative(n - i)
+    assert not lilsumthing.provably_nonnegative(j - i, facts)
+    assert lilsumthing.provably_nonnegative(i - j, facts)
+
+def test_multi_generator_0():
+    orig_src = '''
+S = sum(a*b for a in range(n) for b in range(m))
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'm': m}
+                       for n in range(-2, 6) for m in range(-2, 6)])
+
+def test_multi_generator_1():
+    '''later generators may refer to earlier targets'''
+    for orig_src in (
+            'S = sum([a*b for a in range(n) for b in range(a, n)], 7)',
+            'S = sum(a+b+c for a in range(n) for b in range(a)'
+            ' for c in range(b, a))',
+            'S = sum(b for a in range(len(xs)) for b in range(len(xs) - a))'):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n, 'xs': [0] * n} for n in range(-2, 8)])
+
+def test_multi_generator_2():
+    '''in 'for a in range(b) for b in ...' the first (b) is not the
+    second, so we leave it alone'''
+    orig_src = 'S = sum(1 for a in range(b) for b in range(n))'
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_multiple_counters_0():
+    '''count, sum and sum of squares in one pass'''
+    orig_src = '''
+c = 0
+S = 0
+Q = 0
+for i in range(n):
+    c += 1
+    S += i
+    Q += i*i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert unparsed.splitlines()[3:] == [
+        'c = max(n, 0)',
+        'S = (-max(n, 0) + max(n, 0) ** 2) // 2',
+        'Q = (max(n, 0) - max(n, 0) ** 2 * 3 + max(n, 0) ** 3 * 2) // 6'], unparsed
+    for result in 'cSQ':
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n} for n in range(-2, 8)], result=result)
+
+def test_multiple_counters_1():
+    '''counters incremented at several nesting levels'''
+    orig_src = '''
+S = 0
+T = 5
+for i in range(n):
+    S += i
+    for j in range(i):
+        T += j
+        S += 2
+    S += 1
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    for result in 'ST':
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n} for n in range(-2, 8)], result=result)
+
+def test_multiple_counters_2():
+    '''T depends on the running value of S'''
+    orig_src = '''
+S = 0
+T = 0
+for i in range(n):
+    S += i
+    T += S
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_true_division():
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    S += (3*i)/4
+''', '''
+S = sum(sum(j/2 for j in range(i)) for i in range(n))
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        for n in range(2, 30):
+            orig_env, opt_env = {'n': n}, {'n': n}
+            exec(orig_src, orig_env)
+            exec(unparsed, opt_env)
+            assert type(opt_env['S']) is float
+            assert opt_env['S'] == pytest.approx(orig_env['S'])
+
+def test_true_division_int_counter():
+    '''only the counter that adds up floats becomes a float'''
+    orig_src = '''
+S = 0
+T = 0
+for i in range(n):
+    S += (2*i)/2
+    T += i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed.splitlines()[2:] == [
+        'S = (-max(n, 0) + max(n, 0) ** 2) / 2',
+        'T = (-max(n, 0) + max(n, 0) ** 2) // 2'], unparsed
+
+def test_modulo_0():
+    orig_src = '''
+S = 0
+for i in range(100):
+    S += i % 7
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = 295', unparsed
+
+def test_modulo_1():
+    for orig_src in ('''
+S = 0
+for i in range(3, n, 2):
+    S += (3*i) // 4 + i % 3
+''', '''
+S = 0
+for i in range(n):
+    S += i // -3 + (i*i) % -4
+''', '''
+S = 0
+for i in range(a, n):
+    S += i % 3
+''', '''
+S = 0
+for i in range(n):
+    for j in range(a):
+        S += (i + 2*j) % 5
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n, 'a': a}
+                           for n in range(-2, 30) for a in range(-2, 6)])
+
+def test_floor_division_exact():
+    '''i*(i+1) is always even, so no residue classes are needed'''
+    orig_src = '''
+S = 0
+for i in range(n):
+    S += i*(i+1)//2
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = (-max(n, 0) + max(n, 0) ** 3) // 6', unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 20)])
+
+def test_modulo_unhandled():
+    '''x may not be an int, and division by zero must still raise'''
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    S += (i + x) % 3
+''', '''
+S = 0
+for i in range(n):
+    S += i // 0
+''', '''
+S = 0
+for i in range(n):
+    S += (i % 7) % 3
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_integer_valued():
+    P = lilsumthing.Polynomial
+    n, m = P.variable('n'), P.variable('m')
+    assert ((n*n - n) * lilsumthing.Fraction(1, 2)).integer_valued()
+    assert ((n*n*m - n*m) * lilsumthing.Fraction(1, 2)).integer_valued()
+    assert not ((n*n - n) * lilsumthing.Fraction(1, 4)).integer_valued()
+    assert not (n * lilsumthing.Fraction(1, 2)).integer_valued()
+
+def test_geometric_0():
+    for orig_src, expected in (
+            ('S = 0\nfor i in range(n):\n    S += 2**i\n',
+             'S = 0\nS = -1 + 2 ** max(n, 0)'),
+            ('S = 0\nfor i in range(n):\n    S += 3**i\n',
+             'S = 0\nS = (-1 + 3 ** max(n, 0)) // 2'),
+            ('S = 0\nfor i in range(20):\n    S += 5**i * i\n',
+             'S = 0\nS = 447034835815430')):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == expected, unparsed
+        assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 20)])
+
+def test_geometric_1():
+    '''arithmetic-geometric series, negative ratios and stepped ranges'''
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    S += i * 3**i
+''', '''
+S = 0
+for i in range(2, n, 3):
+    S += i**2 * 2**(i+1)
+''', '''
+S = 0
+for i in range(n):
+    S += (-2)**i + 0**i + i % 2 * 2**i
+''', '''
+S = sum(2**(2*i) * 3**i + i for i in range(n))
+''', '''
+S = 0
+for i in range(n):
+    for j in range(m):
+        S += 2**(i+j)
+''', '''
+S = 0
+for i in range(n):
+    for j in range(i):
+        S += 2 ** (i - j)
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n, 'm': m}
+                           for n in range(-2, 16) for m in range(-2, 5)])
+
+def test_geometric_descending():
+    '''the exponent decreases, as in a polynomial rolling hash'''
+    orig_src = '''
+S = 0
+for i in range(len(xs)):
+    S += 31**(len(xs) - 1 - i) * i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed, [{'xs': [0] * n} for n in range(10)])
+
+def test_geometric_symbolic():
+    '''the ratio may be an int, 1, or a float'''
+    orig_src = '''
+S = 0
+for i in range(n):
+    S += i * x**i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'x': x}
+                       for n in range(-2, 12) for x in (-3, 0, 1, 2, 7)])
+    for n in range(1, 12):
+        for x in (0.5, 1.0, 1.25):
+            orig_env, opt_env = {'n': n, 'x': x}, {'n': n, 'x': x}
+            exec(orig_src, orig_env)
+            exec(unparsed, opt_env)
+            assert type(opt_env['S']) is float
+            assert opt_env['S'] == pytest.approx(orig_env['S'])
+
+def test_geometric_negative_exponent():
+    '''2 ** -1 is a float, so these are left alone'''
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    S += 2**(i-1)
+''', '''
+S = 0
+for i in range(a, n):
+    S += 2**i
+''', '''
+S = 0
+for i in range(n):
+    S += 2**i * 3**(n - i)
+''', '''
+S = 0
+for i in range(n):
+    S += i * 2 ** m
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_symbolic_exponent_guard():
+    '''2 ** m is only an int for m >= 0, which --guard checks'''
+    orig_src = '''
+S = 0
+for i in range(n):
+    S += i * 2 ** m
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src, guard=True))
+    assert '(m >= 0)' in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'm': m} for n in range(-1, 5)
+                       for m in range(-3, 4)])
+    assert not lilsumthing.integer_variable('2 ** m', {'m'})
+    assert lilsumthing.integer_variable('2 ** max(m, 0)', {'m'})
+
+def test_product_0():
+    orig_src = '''
+P = 1
+for i in range(n):
+    P *= 3
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'P = 1\nP = 3 ** max(n, 0)', unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-3, 10)],
+                      result='P')
+
+def test_product_triangular():
+    orig_src = '''
+P = 2
+for i in range(n):
+    for j in range(i):
+        P *= x ** j
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'x': x}
+                       for n in range(-2, 10) for x in (-2, 0, 1, 3)],
+                      result='P')
+
+def test_product_factorial():
+    orig_src = '''
+P = 1
+for i in range(1, len(xs) + 1):
+    P *= i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'import math\nP = 1\nP = math.factorial(len(xs))', unparsed
+    assert_equivalent(orig_src, unparsed, [{'xs': [0] * n} for n in range(10)],
+                      result='P')
+
+def test_product_perm():
+    '''products of consecutive ints, times powers'''
+    orig_src = '''
+"""docstring"""
+import os
+import sys
+P = 1
+for i in range(n):
+    P *= (i + 3) ** 2 * -x * 2 ** i
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'for' not in unparsed, unparsed
+    assert unparsed.startswith('"""docstring"""\nimport math\n'), unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'x': x}
+                       for n in range(-2, 10) for x in (-2, 0, 1, 3)],
+                      result='P')
+
+def test_product_zero():
+    orig_src = '''
+P = 1
+for i in range(-3, 4):
+    P *= i
+'''
+    assert ast.unparse(lilsumthing.optimize(orig_src)) == 'P = 1\nP = 0'
+
+def test_math_prod():
+    for orig_src in ('''
+import math
+P = math.prod(i + 1 for i in range(n))
+''', '''
+from math import prod
+P = prod((2 ** i for i in range(n)), start=5)
+''', '''
+import operator
+from functools import reduce
+P = reduce(operator.mul, [-i for i in range(1, n + 1)], 1)
+''', '''
+import functools, operator
+P = functools.reduce(operator.mul, (i + 1 for i in range(len(xs) + 1)))
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n, 'xs': [0] * n} for n in range(-2, 10)],
+                          result='P')
+
+def test_product_unhandled():
+    for orig_src in ('''
+P = 1
+for i in range(n):
+    P *= xs[i]
+''', '''
+P = 1
+for i in range(n):
+    P *= 2 ** (i - 1)
+''', '''
+P = 1
+for i in range(n):
+    P *= i
+''', '''
+P = 1
+for i in range(n):
+    P *= i
+    P += 1
+''', '''
+from functools import reduce
+from operator import mul
+P = reduce(mul, [i for i in range(1, n)])
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_partial_0():
+    orig_src = '''
+S = 0
+for i in range(n):
+    S += i * i + math.sin(i) - xs[i % 3] * 2
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src, partial=True))
+    assert unparsed == '''S = 0
+S = (max(n, 0) - max(n, 0) ** 2 * 3 + max(n, 0) ** 3 * 2) // 6
+for i in range(n):
+    S += math.sin(i) - xs[i % 3] * 2''', unparsed
+    for n in range(-2, 10):
+        expected, actual = {'n': n, 'xs': [5, 7, 11], 'math': math}, {}
+        actual.update(expected)
+        exec(orig_src, expected)
+        exec(unparsed, actual)
+        assert actual['S'] == pytest.approx(expected['S'])
+
+def test_partial_nested():
+    '''the residual loops nest like the original ones'''
+    for orig_src in ('''
+S = 0
+T = 0
+for i in range(n):
+    S += i
+    for j in range(i):
+        S += xs[(i + j) % 3] + j
+        T += j
+''', '''
+S = sum(i * i + xs[i % 3] for i in range(n))
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src, partial=True))
+        assert unparsed.count('for') == orig_src.count('for'), unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'n': n, 'xs': [5, 7, 11]} for n in range(-2, 10)])
+
+def test_partial_unhandled():
+    '''the residual addends can't use the counters, or assign names'''
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    S += S + i
+''', '''
+S = 0
+for i in range(n):
+    S += (k := i) + i
+''', '''
+S = 0
+for i in range(n):
+    S += xs[i]
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src, partial=True))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_filtered_sum_0():
+    orig_src = '''
+S = sum(i for i in range(n) if i % 3 == 0)
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = (len(range(0, n, 3)) * -3 + len(range(0, n, 3)) ** 2 * 3) // 2', unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 20)])
+
+def test_filtered_sum_1():
+    '''if statements, elif, else, and conditional expressions'''
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    if i % 2:
+        S += i * i
+''', '''
+S = 0
+for i in range(n):
+    if i % 4 == 1 or not i % 3:
+        S += i
+    elif n % 2 == 0:
+        S += 2
+    else:
+        S += i if i % 2 else 7
+''', '''
+P = 1
+for i in range(n):
+    if i % 2 != 0:
+        P *= 3
+''', '''
+S = 0
+for i in range(n):
+    if i % 2 == 0:
+        for j in range(i):
+            S += j
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 20)],
+                          result='P' if 'P' in orig_src else 'S')
+
+def test_filtered_sum_threshold():
+    '''the bounds may be floats, and then the range is cut at math.ceil()'''
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    if i >= k:
+        S += i
+''', '''
+S = 0
+for i in range(a, n):
+    if k < i <= m:
+        S += i * i
+    else:
+        S += 1
+''', '''
+S = sum(i for i in range(1, n, 3) if i < k if i % 2 == 0)
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed,
+                          [{'a': a, 'n': n, 'k': k, 'm': m}
+                           for a in (-1, 2) for n in range(-2, 12)
+                           for k in (-1.5, 0, 2.5, 4) for m in (3, 6.5)])
+
+def test_filtered_sum_threshold_constant():
+    '''constant ranges are cut into constant ranges, which may be empty'''
+    for orig_src in (
+            # nothing kept:
+            'S = sum(a for i in range(4) if i >= 10)\n',
+            'S = sum(a for i in range(4, -4, -2) if i < -10)\n',
+            # everything kept:
+            'S = sum(a * i for i in range(4) if i < 10)\n',
+            'S = sum(a * i for i in range(4, -4, -2) if i >= -10)\n',
+            # both sides of the range:
+            'S = sum(a * i + 1 for i in range(-5, 9, 3) if -2 <= i < 6)\n',
+            'S = sum(a * i + 1 for i in range(9, -5, -3) if -2 < i <= 6)\n'):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed, [{'a': a} for a in (-1, 3)])
+    assert ast.unparse(lilsumthing.optimize(
+        'S = sum(a for i in range(4) if i >= 10)\n')) == 'S = 0'
+
+def test_filtered_sum_threshold_shadowed_math():
+    '''float bounds are only cut at math.ceil() where math is the module'''
+    orig_src = '''
+S = 0
+for i in range(n):
+    if i >= k:
+        S += i
+'''
+    assert 'math.ceil' in ast.unparse(lilsumthing.optimize(orig_src))
+    for shadowing in ('import numpy as math\n', 'import math\nmath = 3\n'):
+        unparsed = ast.unparse(lilsumthing.optimize(shadowing + orig_src))
+        assert 'for i in' in unparsed and 'math.' not in unparsed, unparsed
+        # int bounds don't need math:
+        unparsed = ast.unparse(lilsumthing.optimize(shadowing + '''
+S = 0
+for k in range(m):
+    for i in range(n):
+        if i >= k:
+            S += i
+'''))
+        assert 'for i in' not in unparsed, unparsed
+        assert 'math.' not in unparsed, unparsed
+
+def test_filtered_sum_triangular():
+    '''j < i inside range(n) is range(i), since i < n'''
+    orig_src = '''
+S = 0
+for i in range(n):
+    for j in range(n):
+        if j < i:
+            S += j
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = (max(n, 0) * 2 - max(n, 0) ** 2 * 3 + max(n, 0) ** 3) // 6', unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-2, 12)])
+
+def test_filtered_sum_unhandled():
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    if xs[i]:
+        S += i
+''', '''
+S = 0
+for i in range(n):
+    if 2 * i < n:
+        S += i
+''', '''
+S = 0
+for i in range(n):
+    if i % 2:
+        S += i
+    else:
+        break
+''', '''
+from functools import reduce
+from operator import mul
+P = reduce(mul, [i for i in range(1, 10) if i % 2])
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_literal_sequence_0():
+    orig_src = '''
+S = 0
+for i in [1, 5, 8]:
+    S += i * n
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = n * 14', unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-3, 5)])
+
+def test_literal_sequence_1():
+    '''tuples, sets, reversed(), conditions and products'''
+    for orig_src, result in (('''
+S = sum(i * i + n for i in (3, 4, 4))
+''', 'S'), ('''
+S = 0
+for i in {3, 4, 4, -2}:
+    if i % 2 == 0:
+        S += i * n
+''', 'S'), ('''
+S = 0
+for i in range(n):
+    for j in [1, 5]:
+        if j < i:
+            S += i - j
+''', 'S'), ('''
+P = 1
+for i in reversed((2, 3, 5)):
+    P *= i + n
+''', 'P'), ('''
+P = 1
+for i in [1, 2, 7]:
+    P *= 2 ** i
+''', 'P')):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert 'for' not in unparsed, unparsed
+        assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-3, 12)],
+                          result=result)
+
+def test_literal_sequence_table():
+    '''a large constant table is folded into a single constant'''
+    table = tuple(range(0, 3000, 7))
+    orig_src = 'S = 0\nfor x in %r:\n    S += x * x - 3 * x\n' % (table,)
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert unparsed == 'S = 0\nS = %d' % sum(x * x - 3 * x for x in table), unparsed
+
+def test_module_constant():
+    orig_src = '''
+PRIMES = (2, 3, 5, 7)
+
+def f(n):
+    S = 0
+    for p in PRIMES:
+        S += p * n
+    return S
+S = f(n)
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'S = n * 17' in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed, [{'n': n} for n in range(-3, 5)])
+
+def test_module_constant_unhandled():
+    '''constants that are rebound, and sequences of non-int constants'''
+    for orig_src in ('''
+PRIMES = (2, 3, 5, 7)
+def f(n, PRIMES=(1,)):
+    S = 0
+    for p in PRIMES:
+        S += p * n
+    return S
+''', '''
+PRIMES = (2, 3, 5, 7)
+PRIMES = (1,)
+S = 0
+for p in PRIMES:
+    S += p
+''', '''
+S = 0
+for p in PRIMES:
+    S += p
+PRIMES = (2, 3)
+''', '''
+S = 0
+for i in [1, n]:
+    S += i
+''', '''
+S = 0
+for i in [1, 2.5]:
+    S += i
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_optimize_files(tmp_path):
+    '''the diffs come in input order, with or without a process pool'''
+    filenames = []
+    for k in range(6):
+        filenames.append(str(tmp_path / ('f%d.py' % k)))
+        with open(filenames[-1], 'w') as f:
+            f.write('S = 0\nfor i in range(n):\n    S += i ** %d\n' % k)
+    filenames.insert(2, str(tmp_path / 'missing.py'))
+    progress = []
+    sequential = list(lilsumthing.optimize_files(filenames, jobs=1))
+    parallel = list(lilsumthing.optimize_files(
+        filenames, jobs=3, progress=lambda *args: progress.append(args)))
+    assert sequential == parallel
+    assert [filename for filename, _, _ in parallel] == filenames
+    assert sorted(filename for _, _, filename in progress) == sorted(filenames)
+    assert [done for done, _, _ in progress] == list(range(1, 8))
+    assert parallel[2][1] is None and 'FileNotFoundError' in parallel[2][2]
+    assert all(lines and not error
+               for filename, lines, error in parallel if filename != filenames[2])
+
+def test_optimize_files_timeout(tmp_path):
+    slow, fast = str(tmp_path / 'slow.py'), str(tmp_path / 'fast.py')
+    with open(slow, 'w') as f:
+        f.write('S = 0\nfor i in range(n):\n    S += (i + n) ** 5000\n')
+    with open(fast, 'w') as f:
+        f.write('S = 0\nfor i in range(n):\n    S += i\n')
+    (_, lines, error), (_, fast_lines, _) = lilsumthing.optimize_files(
+        [slow, fast], jobs=2, timeout=0.5)
+    assert lines is None and 'gave up' in error
+    assert fast_lines
+
+def test_job_count():
+    assert lilsumthing.job_count('0') == 0
+    assert lilsumthing.job_count('4') == 4
+    with pytest.raises(lilsumthing.argparse.ArgumentTypeError):
+        lilsumthing.job_count('-1')
+    with pytest.raises(ValueError):
+        lilsumthing.job_count('many')
+
+def test_rewrite_count():
+    tree = ast.parse('S = 0\nfor i in range(n):\n    S += i\nT = f(n)\n')
+    assert lilsumthing.rewrite(tree) == 1
+    tree = ast.parse('T = 0\nfor i in range(n):\n    T += f(i)\n')
+    assert lilsumthing.rewrite(tree) == 0
+
+def test_diff_cache(tmp_path):
+    a, b = str(tmp_path / 'a.py'), str(tmp_path / 'b.py')
+    with open(a, 'w') as f:
+        f.write('S = 0\nfor i in range(n):\n    S += i\n')
+    with open(b, 'w') as f:
+        f.write('T = 0\nfor i in range(n):\n    T += f(i)\n')
+    cache = lilsumthing.DiffCache(str(tmp_path / 'cache'))
+    uncached = list(lilsumthing.optimize_files([a, b]))
+    assert list(lilsumthing.optimize_files([a, b], cache=cache)) == uncached
+    assert uncached[1][1] == []
+    # the second run takes the diffs from the cache, without parsing:
+    for filename in (a, b):
+        with open(filename, 'rb') as f:
+            key = cache.key(f.read())
+        with open(cache.path(key), 'w') as f:
+            f.write('["@@ -1 +1 @@", "-cached"]')
+    progress = []
+    cached = list(lilsumthing.optimize_files(
+        [b, a], jobs=2, cache=cache,
+        progress=lambda *args: progress.append(args)))
+    assert cached == [(filename, ['--- %s' % filename, '+++ %s' % filename,
+                                  '@@ -1 +1 @@', '-cached'], None)
+                      for filename in (b, a)]
+    assert len(progress) == 2
+    # other options and other content are other keys:
+    assert lilsumthing.DiffCache(cache.directory, partial=True).key(b'') \
+        != cache.key(b'')
+    assert cache.get(cache.key(b'x = 1\n'), a) is None
+
+def test_worth_parsing():
+    for content in (b'S = sum(i for i in range(n))',
+                    b'for i in xs:\n    P *= i\n',
+                    b'from math import prod\nP = prod ([i for i in xs])'):
+        assert lilsumthing.worth_parsing(content), content
+    for content in (b'x = 1\n', b'for i in xs:\n    print(i)\n',
+                    b'S = 0\nS += 1\n', b'summary(xs)'):
+        assert not lilsumthing.worth_parsing(content), content
+
+def test_python_files(tmp_path):
+    for path in ('.git/hooks/h.py', 'a.py', 'notes.txt', 'build/b.py',
+                 'pkg/c.py', 'pkg/c_gen.py', 'pkg/keep_gen.py', 'pkg/top.py',
+                 'pkg/sub/d.py', 'pkg/sub/e.py', 'top.py', 'vendor/v.py'):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('x = 1\n')
+    (tmp_path / '.gitignore').write_text(
+        '# comment\nbuild/\n*_gen.py\n!keep_gen.py\n/top.py\n')
+    (tmp_path / 'pkg' / 'sub' / '.gitignore').write_text('/d.py\n')
+    def found(*args, **kwargs):
+        return [os.path.relpath(path, tmp_path) for path in
+                lilsumthing.python_files(*args, **kwargs)]
+    assert found([str(tmp_path)]) == [
+        'a.py', 'pkg/c.py', 'pkg/keep_gen.py', 'pkg/sub/e.py', 'pkg/top.py',
+        'vendor/v.py']
+    # the .gitignore files above the directory apply too:
+    assert found([str(tmp_path / 'pkg')], excludes=('sub',)) == [
+        'pkg/c.py', 'pkg/keep_gen.py', 'pkg/top.py']
+    assert found([str(tmp_path)], excludes=('.git', 'pkg/*', 'v*'),
+                 gitignore=False) == ['a.py', 'build/b.py', 'top.py']
+    # files are taken as they are:
+    assert found([str(tmp_path / 'top.py'), str(tmp_path / 'vendor')],
+                 excludes=('top.py',)) == ['top.py', 'vendor/v.py']
+
+def test_rewrite_source():
+    '''only the loops and sum() calls are replaced, in parentheses where
+    they need them'''
+    orig_src = '''"""docstring"""
+from __future__ import annotations
+# comment
+@decorator
+def f(n,  k) :
+\tP = 1
+\tfor i in range(k):   # the loop goes
+\t\tP *= i + 1
+\ty = ["é", 2 * sum(i for i in range( n )),sum(i for i in [3]).bit_length()] # stays
+\treturn P,y
+'''
+    assert lilsumthing.rewrite_source(orig_src) == '''"""docstring"""
+from __future__ import annotations
+# comment
+import math
+@decorator
+def f(n,  k) :
+\tP = 1
+\tP = math.factorial(max(k, 0))
+\ty = ["é", 2 * ((-max(n, 0) + max(n, 0) ** 2) // 2),(3).bit_length()] # stays
+\treturn P,y
+'''
+    assert lilsumthing.rewrite_source('S = 0\r\nfor i in range(n):\r\n'
+                                      '    S += i\r\n    S += f(i)\r\n',
+                                      partial=True) == (
+        'S = 0\r\nS = (-max(n, 0) + max(n, 0) ** 2) // 2\r\n'
+        'for i in range(n):\r\n    S += f(i)\r\n')
+    assert lilsumthing.rewrite_source('S = 0\nfor i in xs:\n    S += i\n') \
+        is None
+    # negative closed forms are -(55), not a -55 that binds looser than **:
+    for orig_src, rewritten in (
+            ('S = sum(i for i in range(-10, 0)) ** 2\n', 'S = (-55) ** 2\n'),
+            ('S = sum(i for i in range(-10, 0)).real\n', 'S = (-55).real\n'),
+            ('S = 2 ** sum(i for i in range(-3, 0))\n', 'S = 2 ** (-6)\n')):
+        assert lilsumthing.rewrite_source(orig_src, verbose=True) == rewritten
+        assert_equivalent(orig_src, rewritten, [{}])
+
+def test_write(tmp_path):
+    filename = str(tmp_path / 'a.py')
+    content = '# -*- coding: latin-1 -*-\nS = 0 # \xe9\nfor i in range(n):\n' \
+        '    S += i\nT = 0\n'
+    with open(filename, 'wb') as f:
+        f.write(content.encode('latin-1'))
+    (_, lines, error), = lilsumthing.optimize_files([filename], write=True)
+    assert error is None and lines[2:] == [
+        '@@ -1,5 +1,4 @@', ' # -*- coding: latin-1 -*-', ' S = 0 # \xe9',
+        '-for i in range(n):', '-    S += i',
+        '+S = (-max(n, 0) + max(n, 0) ** 2) // 2', ' T = 0']
+    with open(filename, 'rb') as f:
+        assert f.read().decode('latin-1') == '# -*- coding: latin-1 -*-\n' \
+            'S = 0 # \xe9\nS = (-max(n, 0) + max(n, 0) ** 2) // 2\nT = 0\n'
+    assert list(lilsumthing.optimize_files([filename], write=True)) == [
+        (filename, [], None)]
+
+def test_write_atomic(tmp_path, monkeypatch):
+    '''the file is replaced at once, keeping its mode, or not at all'''
+    filename = str(tmp_path / 'a.py')
+    content = 'S = 0\nfor i in range(n):\n    S += i\n'
+    with open(filename, 'w') as f:
+        f.write(content)
+    os.chmod(filename, 0o750)
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'replace', fail)
+    (_, lines, error), = lilsumthing.optimize_files([filename], write=True)
+    assert lines is None and 'disk full' in error
+    assert os.listdir(str(tmp_path)) == ['a.py']
+    with open(filename) as f:
+        assert f.read() == content
+    monkeypatch.undo()
+    (_, lines, error), = lilsumthing.optimize_files([filename], write=True,
+                                                     timeout=5)
+    assert error is None and lines
+    assert os.listdir(str(tmp_path)) == ['a.py']
+    assert os.stat(filename).st_mode & 0o777 == 0o750
+
+def test_import_hook(tmp_path, monkeypatch):
+    (tmp_path / 'lilsumthing_hooked.py').write_text('''
+def f(n):
+    S = 0
+    for i in range(n):
+        S += i * i
+    return S
+''')
+    (tmp_path / 'lilsumthing_unhooked.py').write_text(
+        (tmp_path / 'lilsumthing_hooked.py').read_text())
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    finder = lilsumthing.install_import_hook('lilsumthing_hooked')
+    try:
+        import lilsumthing_hooked, lilsumthing_unhooked
+        assert 'range' not in lilsumthing_hooked.f.__code__.co_names
+        assert 'range' in lilsumthing_unhooked.f.__code__.co_names
+        assert [lilsumthing_hooked.f(n) for n in range(10)] \
+            == [lilsumthing_unhooked.f(n) for n in range(10)]
+        # the second import takes the code from the cache:
+        del sys.modules['lilsumthing_hooked']
+        monkeypatch.setattr(lilsumthing, 'rewrite', None)
+        import lilsumthing_hooked
+        assert 'range' not in lilsumthing_hooked.f.__code__.co_names
+        assert lilsumthing_hooked.f(100) == 328350
+    finally:
+        lilsumthing.uninstall_import_hook(finder)
+        sys.modules.pop('lilsumthing_hooked', None)
+        sys.modules.pop('lilsumthing_unhooked', None)
+
+K = 3
+
+def test_closed_form_decorator():
+    @lilsumthing.closed_form(verify=True)
+    def f(n, k=2):
+        S = 0
+        for i in range(n):
+            S += i * i * k + K
+        return S
+    assert 'range' not in f.__code__.co_names
+    assert [f(n) for n in range(10)] == [f.__wrapped__(n) for n in range(10)]
+    assert f(10, k=1) == 315
+    def outer(m):
+        @lilsumthing.closed_form
+        def g(n):
+            return sum(i * m for i in range(n))
+        return g
+    g = outer(4)
+    assert 'range' not in g.__code__.co_names and g(10) == 180
+    # memoized by source:
+    assert outer(5).__code__ is g.__code__
+    @lilsumthing.closed_form
+    def h(xs):
+        return sum(x for x in xs)
+    assert not hasattr(h, '__wrapped__')
+
+def test_closed_form_decorator_verify():
+    '''range(2.5) raises TypeError, the closed form doesn't'''
+    def f(n):
+        return sum(i for i in range(n))
+    with pytest.warns(UserWarning, match='differs'):
+        assert lilsumthing.closed_form(f, verify=True,
+                                       samples=[(3,), (2.5,)]) is f
+    assert lilsumthing.closed_form(f, verify=True, samples=[(3,)]) is not f
+
+def test_guard():
+    orig_src = '''
+S = 0
+for i in range(n):
+    S += i * x
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src, guard=True))
+    assert unparsed.startswith('S = 0\nif type(n) is int and type(x) is int:\n'), unparsed
+    assert unparsed.endswith('else:\n    for i in range(n):\n        S += i * x'), unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'x': x} for n in range(-2, 5)
+                       for x in (-1, 3, 2.5, True)])
+    with pytest.raises(TypeError):
+        exec(unparsed, {'n': 2.5, 'x': 1})
+
+def test_guard_assumption():
+    '''the closed form of the product needs k >= 1, which is checked instead
+    of proven'''
+    orig_src = '''
+P = 1
+for i in range(k, n):
+    P *= i
+'''
+    assert ast.unparse(lilsumthing.optimize(orig_src)) \
+        == ast.unparse(ast.parse(orig_src))
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src, guard=True))
+    assert 'k >= 1' in unparsed and 'math.perm' in unparsed, unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'k': k, 'n': n} for k in range(-3, 5)
+                       for n in range(-3, 8)], result='P')
+
+def test_guard_nested():
+    '''the inner loop is guarded on its counter, the outer one is left alone'''
+    orig_src = '''
+T = 0
+for i in range(n):
+    S = 0
+    for j in range(i):
+        S += j
+    T += f(S)
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src, guard=True))
+    assert 'if type(S) is int:' in unparsed, unparsed
+    assert unparsed.startswith('T = 0\nfor i in range(n):'), unparsed
+    assert_equivalent(orig_src, unparsed,
+                      [{'n': n, 'f': f} for n in range(-1, 6)
+                       for f in (abs, lambda s: s * 0.5)], result='T')
+
+def test_guard_unhandled():
+    '''floats are refused rather than guarded, and so are modules that
+    rebind the builtins the closed forms use'''
+    for orig_src in ('''
+S = 0
+for i in range(n):
+    S += i * 0.5
+''', '''
+range = 3
+S = 0
+for i in range(n):
+    S += i
+''', '''
+S = 0
+for i in range(n):
+    S += i
+def max(*a): return 0
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src, guard=True))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_benchmark_speedup():
+    import benchmark
+    rows = benchmark.speedup('case', '''
+def f(n, k=2):
+    S = 0
+    for i in range(n):
+        S += i * k
+    return S
+T = 0
+for i in range(n):
+    T += i * i
+print(T)
+''', sizes=(0, 100), repeat=1, min_time=0)
+    assert [(r['target'], r['loops'], r['size']) for r in rows] == [
+        ('<module>', 1, 0), ('<module>', 1, 100), ('f', 1, 0), ('f', 1, 100)]
+    assert all(r['equal'] and r['speedup'] > 0 and not r['error']
+               for r in rows), rows
+    assert benchmark.speedup('case', 'S = 0\nfor i in range(n):\n    S += f(i)\n') \
+        == []
+    rows = benchmark.speedup('case', '''
+S = 0
+for i in range(n):
+    for j in range(n):
+        S += i * j
+''', sizes=(10 ** 9, 10 ** 10), timeout=0.1)
+    assert [(r['size'], r['error']) for r in rows] == [(10 ** 9, 'timeout')]
+    assert rows[0]['speedup'] > 1
+
+def test_benchmark_corpus(tmp_path):
+    import benchmark
+    readme = str(tmp_path / 'README.md')
+    with open(readme, 'w') as f:
+        f.write('''text
+```python
+S = sum(i for i in range(n))
+```
+```diff
+ S = 0
+-for i in range(n):
+-    S += i
++S = (-max(n, 0) + max(n, 0) ** 2) // 2
+```
+```python
+S = sum((i for i in range(n)))
+```
+''')
+    assert list(benchmark.corpus([readme])) == [
+        (readme + ':3', 'S = sum(i for i in range(n))'),
+        (readme + ':6', 'S = 0\nfor i in range(n):\n    S += i')]
+
+def test_benchmark_scaling():
+    import benchmark
+    for axis in ('depth', 'addends', 'exponent', 'variables', 'functions'):
+        source = benchmark.synthetic(axis, 3)
+        assert lilsumthing.rewrite(ast.parse(source)) == source.count('for ')
+    rows, growths = benchmark.scaling({'functions': (1, 2, 4, 8),
+                                       'power': (1, 2)}, repeat=1)
+    assert [(r['axis'], r['value'], r['terms']) for r in rows] == [
+        ('functions', 1, 9), ('functions', 2, 18), ('functions', 4, 36),
+        ('functions', 8, 72), ('power', 1, 3), ('power', 2, 6)]
+    assert all(r['seconds'] > 0 and r['peak'] > 0 for r in rows[:4])
+    assert growths['functions']['terms'] == pytest.approx(1)
+    rows = [{'value': v, 'seconds': v ** 3 + 1000} for v in (1, 2, 10, 20)]
+    assert benchmark.growth(rows, 'seconds') == pytest.approx(
+        math.log(9000 / 2000) / math.log(2))
+    assert benchmark.growth(rows[:1], 'seconds') is None
+    assert benchmark.regressions(
+        {'power': {'seconds': 3.5, 'terms': 2.5}},
+        {'power': {'seconds': 3.4, 'terms': 2}}, 0.25) \
+        == [('power', 'terms', 2.5, 2)]
+
+def test_shadowed_math():
+    '''math.factorial() is only emitted where math is the math module'''
+    orig_src = '''
+P = 1
+for i in range(1, n + 1):
+    P *= i
+'''
+    assert 'math.factorial' in ast.unparse(lilsumthing.optimize(orig_src))
+    for shadowing in ('import numpy as math\n', 'from x import math\n',
+                      'import math\ndef f(math=3):\n    pass\n',
+                      'import math\nmath = 3\n'):
+        unparsed = ast.unparse(lilsumthing.optimize(shadowing + orig_src))
+        assert 'for i in' in unparsed, unparsed
+    # a loop that doesn't need math is rewritten all the same:
+    unparsed = ast.unparse(lilsumthing.optimize('''
+math = 3
+S = 0
+for i in range(n):
+    S += i
+'''))
+    assert 'for i in' not in unparsed, unparsed
+    for name, body in (('isinstance', 'x ** i'), ('int', 'x ** i'),
+                       ('float', '2 * i / 1')):
+        orig_src = '''
+def %s(*args):
+    return 1
+S = 0
+for i in range(n):
+    S += %s
+''' % (name, body)
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_shadowed_builtins():
+    '''a rewrite is only refused when it, or the loop it replaces, uses a
+    builtin that a scope it sees binds to something else'''
+    # the closed form calls no builtin:
+    orig_src = '''
+sum = 0
+for i in range(10):
+    sum += i
+'''
+    assert ast.unparse(lilsumthing.optimize(orig_src)) == 'sum = 0\nsum = 45'
+    assert_equivalent(orig_src, 'sum = 45\n', [{}], result='sum')
+    # the sum of mean() is no other function's:
+    orig_src = '''
+def mean(xs):
+    sum = 0
+    for x in xs:
+        sum += x
+    return sum / len(xs)
+def f(n):
+    return sum(i for i in range(n)) + max(n, 0)
+class C:
+    max = 3
+    def g(self, n):
+        return sum(i for i in range(n))
+'''
+    unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+    assert 'sum(i for i in range(n))' not in unparsed, unparsed
+    assert 'for x in xs' in unparsed, unparsed
+    for orig_src in ('''
+def f(n):
+    sum = g
+    return sum(i for i in range(n))
+''', '''
+def f(n, max=min):
+    def g():
+        S = 0
+        for i in range(n):
+            S += i
+        return S
+    return g()
+''', '''
+class C:
+    range = g
+    S = sum(i for i in range(n))
+''', '''
+global_max = 1
+def f():
+    global max
+    max = g
+def h(n):
+    return sum(i for i in range(n))
+'''):
+        unparsed = ast.unparse(lilsumthing.optimize(orig_src))
+        assert unparsed == ast.unparse(ast.parse(orig_src)), unparsed
+
+def test_closed_form_decorator_math(tmp_path, monkeypatch):
+    '''the module of the function doesn't import math, or binds it to
+    something else'''
+    with open(str(tmp_path / 'nomath.py'), 'w') as f:
+        f.write('''
+import lilsumthing
+math = None
+
+@lilsumthing.closed_form
+def factorial(n):
+    P = 1
+    for i in range(1, n + 1):
+        P *= i
+    return P
+''')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import nomath
+    assert hasattr(nomath.factorial, '__wrapped__')
+    assert [nomath.factorial(n) for n in range(6)] == [1, 1, 2, 6, 24, 120]
+
+def test_closed_form_decorator_builtins(tmp_path, monkeypatch):
+    '''only the functions whose closed forms use a builtin that the globals
+    rebind are kept as they are'''
+    with open(str(tmp_path / 'rebound.py'), 'w') as f:
+        f.write('''
+import lilsumthing
+min = None
+max = None
+
+@lilsumthing.closed_form
+def constant():
+    S = 0
+    for i in range(10):
+        S += i
+    return S
+
+@lilsumthing.closed_form
+def triangle(n):
+    S = 0
+    for i in range(n):
+        S += i
+    return S
+''')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import rebound
+    assert hasattr(rebound.constant, '__wrapped__')
+    assert rebound.constant() == 45
+    # its closed form calls max():
+    assert not hasattr(rebound.triangle, '__wrapped__')